@@ -0,0 +1,353 @@
+# Reference for the tree algorithm:
+# J. Barnes & P. Hut, Nature 324, 446 (1986)
+#
+# The quadtree is stored level by level in flat arrays. Bodies are sorted along
+# a Morton (Z-order) curve, so that every node of the tree is a contiguous run
+# of sorted bodies sharing a key prefix. The tree walk is performed for small
+# groups of neighbouring bodies (J. Barnes, J. Comp. Phys. 87, 161 (1990)),
+# all at once as a list of (group, node) pairs that is refined level by level.
+
+import sys
+import argparse
+from time import perf_counter
+from functools import partial
+
+from numpy import add, amax, append, arange, argsort, bincount, \
+                  concatenate, cos, cumsum, empty, flatnonzero, full, inf, \
+                  int64, maximum, minimum, ones, pi, repeat, searchsorted, \
+                  sin, sqrt, zeros, zeros_like
+from numpy.random import default_rng
+
+from rknopar import convG
+from integrators import rk4_step
+from rkvec import calc_accels as direct_accels
+
+# Maximum depth of the tree, limited by the 64 bit Morton keys.
+maxDepth  = 24
+# Largest number of bodies that share a walk of the tree.
+groupSize = 16
+
+def morton_keys(posits, corner, width, depth):
+    """Return the Morton key and the (x, y) index of the cell at 'depth'
+    containing each body."""
+    nCells = 2**depth
+    cells  = ((posits - corner) / width * nCells).astype(int64)
+    cells  = minimum(cells, nCells - 1)
+    keys   = zeros(len(posits), dtype=int64)
+    for bit in range(depth):
+        keys |= ((cells[:, 0] >> bit) & 1) << (2*bit)
+        keys |= ((cells[:, 1] >> bit) & 1) << (2*bit + 1)
+    return keys, cells
+
+def build_tree(bodyMasses, posits):
+    """Build the quadtree for the current positions of all bodies.
+
+    Arguments:
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+
+    Returns:
+    tree -- a dictionary holding the Morton ordering 'order' of the bodies, the
+            sorted 'rank' of each body, and a list 'levels' with one dictionary
+            per level of the tree. Each level gives, for every node, the first
+            sorted body 'start' and one past the last 'end', the total 'mass',
+            the centre of mass 'com', its distance 'offset' from the geometric
+            centre of the node, the side length 'width' of the nodes and the
+            range of child nodes 'child0':'child1' in the next level.
+    """
+
+    numBodies = len(bodyMasses)
+    corner = posits.min(axis=0)
+    width  = amax(posits.max(axis=0) - corner)
+    width  = width*(1 + 1e-9) if width > 0. else 1.
+
+    keys, cells = morton_keys(posits, corner, width, maxDepth)
+    order = argsort(keys, kind='stable')
+    keys  = keys[order]
+    cells = cells[order]
+    rank  = empty(numBodies, dtype=int64)
+    rank[order] = arange(numBodies)
+
+    sortedMass  = bodyMasses[order]
+    sortedMoms  = sortedMass[:, None] * posits[order]
+    sortedPosit = posits[order]
+
+    levels = []
+    for depth in range(maxDepth + 1):
+        prefix = keys >> (2*(maxDepth - depth))
+        start  = append(0, flatnonzero(prefix[1:] != prefix[:-1]) + 1)
+        end    = append(start[1:], numBodies)
+        mass   = add.reduceat(sortedMass, start)
+        com    = add.reduceat(sortedMoms, start)
+        # Nodes without mass keep their geometric centre of bodies instead
+        massive = mass > 0.
+        com[massive] /= mass[massive, None]
+        if not massive.all():
+            counts = (end - start)[~massive, None]
+            com[~massive] = add.reduceat(sortedPosit, start)[~massive] / counts
+        nodeWidth = width / 2**depth
+        centre = corner + ((cells[start] >> (maxDepth - depth)) + 0.5)*nodeWidth
+        offset = sqrt(((com - centre)**2).sum(axis=1))
+        levels.append({'start': start, 'end': end, 'mass': mass, 'com': com,
+                       'offset': offset, 'width': nodeWidth})
+        if len(start) == numBodies:
+            break
+
+    # Children of each node are the nodes of the next level starting inside it
+    for parent, child in zip(levels[:-1], levels[1:]):
+        parent['child0'] = searchsorted(child['start'], parent['start'])
+        parent['child1'] = searchsorted(child['start'], parent['end'])
+
+    return {'order': order, 'rank': rank, 'levels': levels}
+
+def expand_ranges(first, counts):
+    """Expand ranges [first, first+counts) into one flat array of indices,
+    also returning the index of the range that each element came from."""
+    total  = counts.sum()
+    source = repeat(arange(len(first)), counts)
+    offset = arange(total) - repeat(cumsum(counts) - counts, counts)
+    return source, first[source] + offset
+
+def find_groups(tree, sortedPosit):
+    """Find the groups of bodies that walk the tree together.
+
+    A group is the largest node holding no more than 'groupSize' bodies, such
+    that the groups cover every body exactly once. The bodies of each group
+    share a single list of nodes, which is opened according to the bounding
+    circle of the group rather than the position of each body.
+
+    Returns:
+    groups -- a dictionary of the 'depth', 'node', first sorted body 'start',
+              one past the last 'end', bounding 'centre' and 'radius' of each
+              group, in order of their sorted bodies.
+    """
+
+    depths, nodes = [], []
+    for depth, level in enumerate(tree['levels']):
+        counts = level['end'] - level['start']
+        isGroup = counts <= groupSize
+        if depth > 0:
+            parent  = tree['levels'][depth - 1]
+            parents = searchsorted(parent['start'], level['start'],
+                                   side='right') - 1
+            isGroup &= (parent['end'] - parent['start'])[parents] > groupSize
+        nodes.append(flatnonzero(isGroup))
+        depths.append(full(len(nodes[-1]), depth))
+
+    depths = concatenate(depths)
+    nodes  = concatenate(nodes)
+    start  = concatenate([tree['levels'][depth]['start'][nodes[depths == depth]]
+                          for depth in range(len(tree['levels']))])
+    order  = argsort(start)
+    depths, nodes, start = depths[order], nodes[order], start[order]
+    end    = append(start[1:], len(sortedPosit))
+
+    lower  = minimum.reduceat(sortedPosit, start)
+    upper  = maximum.reduceat(sortedPosit, start)
+    centre = (lower + upper)/2
+    radius = sqrt(((upper - lower)**2).sum(axis=1))/2
+
+    return {'depth': depths, 'node': nodes, 'start': start, 'end': end,
+            'centre': centre, 'radius': radius}
+
+def add_accels(accels, bods, bodX, bodY, srcX, srcY, srcMass):
+    """Accumulate the accelerations of the given bodies, at positions (bodX,
+    bodY), due to point masses srcMass at positions (srcX, srcY)."""
+    rX = srcX - bodX
+    rY = srcY - bodY
+    rSumSq = rX*rX + rY*rY
+    weight = convG * srcMass / (rSumSq*sqrt(rSumSq))
+    accels[:, 0] += bincount(bods, weight*rX, minlength=len(accels))
+    accels[:, 1] += bincount(bods, weight*rY, minlength=len(accels))
+
+def calc_accels(numBodies, bodyMasses, posits, theta=0.5, targets=None):
+    """Calculate the gravitational acceleration of every body by walking a
+    Barnes-Hut quadtree.
+
+    A node of side length w, whose centre of mass is a distance d from a group
+    of bodies with bounding radius r, and offset by a distance b from the
+    centre of the node, is treated as a single point mass if w/theta + b + r
+    < d and the node does not contain the group, otherwise it is opened and
+    its children are considered. The offset guards against large errors from
+    nodes whose mass sits in one corner. Bodies within the same group are
+    summed directly.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+    theta      -- the opening angle, theta = 0 reproduces direct summation.
+    targets    -- an optional NumPy ndarray of the indices of the bodies whose
+                  accelerations are wanted, by default every body. Only the
+                  groups holding a target walk the tree.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, or of the
+              targets in the order given, each element of which has in turn
+              two dimensions: [x, y].
+    """
+
+    tree   = build_tree(bodyMasses, posits)
+    levels = tree['levels']
+    sortedMass  = bodyMasses[tree['order']]
+    sortedPosit = posits[tree['order']]
+    groups = find_groups(tree, sortedPosit)
+    # Separate x and y coordinates make the gathers below contiguous
+    sortedX = sortedPosit[:, 0].copy()
+    sortedY = sortedPosit[:, 1].copy()
+
+    # Accelerations are accumulated in sorted order, then unsorted at the end
+    accels = zeros_like(posits)
+
+    # Only the groups holding a target are needed
+    counts = groups['end'] - groups['start']
+    grps   = arange(len(counts))
+    if targets is not None:
+        isTarget = zeros(numBodies, dtype=int64)
+        isTarget[tree['rank'][targets]] = 1
+        grps = grps[add.reduceat(isTarget, groups['start']) > 0]
+
+    # Direct summation between the bodies of each group
+    pair, bods = expand_ranges(groups['start'][grps], counts[grps])
+    pair, members = expand_ranges(groups['start'][grps][pair],
+                                  counts[grps][pair])
+    bods = bods[pair]
+    notSelf = bods != members
+    bods, members = bods[notSelf], members[notSelf]
+    add_accels(accels, bods, sortedX[bods], sortedY[bods],
+               sortedX[members], sortedY[members], sortedMass[members])
+
+    # Every group begins the walk at the root node
+    nodes = zeros(len(grps), dtype=int64)
+    for depth, level in enumerate(levels):
+        last   = depth == len(levels) - 1
+        start  = level['start'][nodes]
+        end    = level['end'][nodes]
+        overlap = (start < groups['end'][grps]) & (groups['start'][grps] < end)
+        leaf    = end - start == 1 if not last else ones(len(nodes), dtype=bool)
+
+        rVec   = level['com'][nodes] - groups['centre'][grps]
+        accept = ~overlap & (leaf | (level['width']
+                 + theta*(level['offset'][nodes] + groups['radius'][grps])
+                 < theta*sqrt((rVec**2).sum(axis=1))))
+        if accept.any():
+            pair, bods = expand_ranges(groups['start'][grps[accept]],
+                                       counts[grps[accept]])
+            accNodes = nodes[accept][pair]
+            add_accels(accels, bods, sortedX[bods], sortedY[bods],
+                       level['com'][:, 0][accNodes], level['com'][:, 1][accNodes],
+                       level['mass'][accNodes])
+
+        # Open every node that was neither accepted, a leaf, nor the group
+        opened = ~accept & ~leaf \
+               & ~(overlap & (groups['depth'][grps] == depth))
+        if last or not opened.any():
+            break
+        child0 = level['child0'][nodes[opened]]
+        pair, nodes = expand_ranges(child0,
+                                    level['child1'][nodes[opened]] - child0)
+        grps = grps[opened][pair]
+
+    accels[tree['order']] = accels.copy()
+    return accels if targets is None else accels[targets]
+
+def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+              theta=0.5):
+    """Perform a forward step using the fourth-order Runge-Kutta method, with
+    the forces at each stage from a Barnes-Hut quadtree.
+
+    Arguments and returns are as for rkvec.make_step, with the addition of:
+    theta -- the opening angle of the tree walk, see calc_accels.
+    """
+    return rk4_step(stepSize, numBodies, bodyMasses, currentPosits,
+                    currentVels, partial(calc_accels, theta=theta))
+
+def check_accuracy(bodyMasses, posits, thetas, nSample=2000,
+                   outFile=sys.stdout):
+    """Compare the tree accelerations against direct summation.
+
+    For each opening angle the median, 99th percentile and maximum relative
+    error of the acceleration are printed, together with the time taken by
+    the tree walk, so that theta can be chosen for a given workload. For large
+    numbers of bodies the direct sum is only evaluated for a random sample.
+
+    Arguments:
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies.
+    thetas     -- a list of opening angles to test.
+    nSample    -- the largest number of bodies to check against the direct sum.
+    outFile    -- the file to write the comparison to.
+
+    Returns:
+    errors -- a list of (theta, median, 99th percentile, maximum error, time)
+              tuples.
+    """
+
+    numBodies = len(bodyMasses)
+    clock = perf_counter()
+    if numBodies <= nSample:
+        sample = arange(numBodies)
+        direct = direct_accels(numBodies, bodyMasses, posits)
+    else:
+        sample = default_rng(0).choice(numBodies, nSample, replace=False)
+        direct = empty((nSample, 2))
+        chunk  = max(1, 2**22 // numBodies)
+        for first in range(0, nSample, chunk):
+            bods   = sample[first:first + chunk]
+            rVec   = posits[None, :, :] - posits[bods, None, :]
+            rSumSq = (rVec**2).sum(axis=2)
+            rSumSq[arange(len(bods)), bods] = inf
+            direct[first:first + chunk] = convG * (
+                (bodyMasses / (rSumSq*sqrt(rSumSq)))[:, :, None] * rVec
+                ).sum(axis=1)
+    directTime = perf_counter() - clock
+    norm = sqrt((direct**2).sum(axis=1))
+
+    print("Direct summation for {0} of {1} bodies took {2:.3e} s."
+          .format(len(sample), numBodies, directTime), file=outFile)
+    print("{0:>8}{1:>12}{2:>12}{3:>12}{4:>12}".format("theta", "median",
+          "99%", "max", "time (s)"), file=outFile)
+    errors = []
+    for theta in thetas:
+        clock  = perf_counter()
+        accels = calc_accels(numBodies, bodyMasses, posits, theta=theta)
+        treeTime = perf_counter() - clock
+        relErr = sqrt(((accels[sample] - direct)**2).sum(axis=1)) / norm
+        relErr.sort()
+        errors.append((theta, relErr[len(sample)//2],
+                       relErr[int(0.99*(len(sample) - 1))], relErr[-1],
+                       treeTime))
+        print("{0:8.3f}{1:12.3e}{2:12.3e}{3:12.3e}{4:12.3e}".format(*errors[-1]),
+              file=outFile)
+    return errors
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser(description=
+            "Check the accuracy of the Barnes-Hut engine against direct "
+            "summation, for the bodies of an input file or a random disk.")
+    parse.add_argument('-i', '--infile', default=None, type=str, help=
+                       "Input file to take the bodies from, '.inp' suffix.")
+    parse.add_argument('-n', '--nbodies', default=2000, type=int, help=
+                       "Number of bodies in the random disk if no input file.")
+    parse.add_argument('-t', '--theta', default=[0.3, 0.5, 0.7, 1.0],
+                       type=float, nargs='+', help="Opening angles to test.")
+    args = parse.parse_args()
+
+    if args.infile:
+        from readinput import input_reader
+        with open(args.infile, 'r') as inFile:
+            bods = input_reader(inFile, sys.stdout)[0]
+        bodyMasses = bods.masses
+        posits     = bods.posits
+    else:
+        rng = default_rng(0)
+        radius = rng.exponential(1., args.nbodies)
+        angle  = rng.uniform(0., 2*pi, args.nbodies)
+        posits = empty((args.nbodies, 2))
+        posits[:, 0] = radius*cos(angle)
+        posits[:, 1] = radius*sin(angle)
+        bodyMasses = rng.uniform(0.5, 1.5, args.nbodies)
+
+    check_accuracy(bodyMasses, posits, args.theta)
@@ -0,0 +1,373 @@
+# Benchmarks of the force engines, time integrators and step file writers, on
+# synthetic disks of bodies around a star, for measuring whether a change
+# makes the code faster or slower.
+#
+# Each engine is timed for a force evaluation and a full Runge-Kutta step, and
+# the compiled engines also for compiling, or loading from the cache, their
+# kernels. The accelerations of every engine are compared against the direct
+# sum. The results are written as JSON or CSV, and can be compared with the
+# results of an earlier run, flagging every time that has grown by more than
+# a threshold.
+#
+#   python benchmark.py -n 10 100 1000 -j before.json
+#   python benchmark.py -n 10 100 1000 -j after.json --compare before.json
+
+import argparse
+import csv
+from datetime import datetime, timezone
+from functools import partial
+import json
+import os
+import platform
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy
+from numpy import arange, concatenate, sqrt, zeros
+from numpy.random import default_rng
+
+import distributions
+from integrators import schemes
+
+# The engines, and the power of the number of bodies their times grow as,
+# from which the time for more bodies is estimated to skip those that would
+# take longer than the budget
+engineScaling = {'rknopar': 2., 'rungekutta': 2., 'rkvec': 2., 'rkpar': 2.,
+                 'barneshut': 1.2, 'fmm': 1.1, 'pm': 1.}
+# The integrators whose steps are timed, with the direct sum engine
+integratorNames = ['rk4', 'leapfrog', 'yoshida4', 'yoshida6', 'wh',
+                   'encounter']
+# The step file formats whose writing is timed
+formatNames = ['text', 'binary', 'compressed']
+
+def make_system(numBodies, seed=0):
+    """Return the masses, positions and velocities of a star at the origin
+    and numBodies - 1 bodies in an exponential disk around it, in circular
+    orbits."""
+    rng    = default_rng(seed)
+    nDisk  = numBodies - 1
+    masses = concatenate(([332946.],
+                          distributions.mass_function(rng, nDisk, 0.01, 10.)))
+    posits = concatenate((zeros((1, 2)),
+                          distributions.exponential_disk(rng, nDisk, 5., 50.)))
+    vels   = zeros((numBodies, 2))
+    vels[1:] = distributions.circular_vels(posits[1:], masses[1:], masses[0])
+    return masses, posits, vels
+
+def load_engine(name):
+    """Return the force function of an engine, or for the original engines
+    without one its step function, and the function compiling its kernels,
+    or raise ImportError if the engine is not available."""
+    if name == 'rknopar':
+        from rknopar import make_step
+        return None, make_step, None
+    if name == 'rungekutta':
+        from rungekutta import make_step_par
+        return None, make_step_par, None
+    if name == 'rkvec':
+        from rkvec import calc_accels
+        return calc_accels, None, None
+    if name == 'rkpar':
+        from rkpar import calc_accels, compile_kernels
+        return calc_accels, None, compile_kernels
+    if name == 'barneshut':
+        from barneshut import calc_accels
+    elif name == 'fmm':
+        from fmm import calc_accels
+    else:
+        from pm import calc_accels
+    return calc_accels, None, None
+
+def best_time(func, repeat):
+    """Return the shortest of repeat timings of func()."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+def relative_errors(accels, reference):
+    """Return the median and maximum relative error of accels."""
+    norm = sqrt((reference**2).sum(axis=1))
+    error = sqrt(((accels - reference)**2).sum(axis=1))/norm
+    return float(numpy.median(error)), float(error.max())
+
+def sampled_direct(masses, posits, sample):
+    """Return the direct sum accelerations of the bodies in sample, found in
+    tiles of rows of the sample against all bodies, so that memory grows as
+    the number of bodies rather than its square."""
+    from rkvec import target_accels
+    return target_accels(len(masses), masses, posits, sample)
+
+class Budget:
+    """Estimate the time of a measurement from the last one of the same
+    engine, to skip those that would take longer than 'seconds'."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.last    = {}
+
+    def allows(self, name, numBodies, outFile):
+        if self.seconds is None or name not in self.last:
+            return True
+        lastBodies, lastTime = self.last[name]
+        estimate = lastTime*(numBodies/lastBodies)**engineScaling.get(name, 2.)
+        if estimate <= self.seconds:
+            return True
+        print("{0:>11} N = {1:<7} skipped, estimated at {2:.1e} s"
+              .format(name, numBodies, estimate), file=outFile)
+        return False
+
+    def spent(self, name, numBodies, seconds):
+        self.last[name] = (numBodies, seconds)
+
+def bench_engines(sizes, engines, repeat, maxSample, budget, outFile):
+    """Time every engine for every number of bodies, returning a list of
+    result dictionaries with the 'group', 'name', 'n', 'metric', 'seconds'
+    and for accelerations the median and maximum relative 'error'."""
+    results = []
+    for name in engines:
+        try:
+            calc_accels, make_step, compile_kernels = load_engine(name)
+        except ImportError as error:
+            print("Skipping engine '{0}': {1}".format(name, error),
+                  file=outFile)
+            continue
+        if compile_kernels is not None:
+            results.append({'group': 'engine', 'name': name, 'n': None,
+                            'metric': 'compile',
+                            'seconds': compile_kernels()})
+        for numBodies in sizes:
+            if not budget.allows(name, numBodies, outFile):
+                continue
+            clock = perf_counter()
+            masses, posits, vels = make_system(numBodies)
+            dt = 1.
+            record = partial(dict, group='engine', name=name, n=numBodies)
+
+            if calc_accels is None:
+                # The original engines are timed for whole steps only, the
+                # first step of a compiled engine compiles it
+                start = perf_counter()
+                make_step(dt, numBodies, masses, posits, vels)
+                first = perf_counter() - start
+                step  = best_time(lambda: make_step(dt, numBodies, masses,
+                                                    posits, vels), repeat)
+                compile = max(first - step, 0.) if name == 'rungekutta' \
+                          else 0.
+                if name == 'rungekutta':
+                    results.append(record(metric='compile', seconds=compile))
+                results.append(record(metric='step', seconds=step))
+                print("{0:>11} N = {1:<7} step {2:.3e} s"
+                      .format(name, numBodies, step), file=outFile)
+                budget.spent(name, numBodies,
+                             perf_counter() - clock - compile)
+                continue
+
+            calc_accels(numBodies, masses, posits)
+            force = best_time(lambda: calc_accels(numBodies, masses, posits),
+                              repeat)
+            accels = calc_accels(numBodies, masses, posits)
+            runge_kutta = schemes['rk4'][0]
+            step = best_time(lambda: runge_kutta(dt, numBodies, masses, posits,
+                                                 vels, accels, calc_accels),
+                             repeat)
+
+            # The accelerations of a sample of bodies against the direct sum
+            if numBodies <= maxSample:
+                sample = arange(numBodies)
+            else:
+                sample = default_rng(1).choice(numBodies, maxSample,
+                                               replace=False)
+            median, largest = relative_errors(
+                accels[sample], sampled_direct(masses, posits, sample))
+            results.append(record(metric='force', seconds=force,
+                                  error=[median, largest]))
+            results.append(record(metric='step', seconds=step))
+            print("{0:>11} N = {1:<7} force {2:.3e} s, step {3:.3e} s, "
+                  "error median {4:.1e} max {5:.1e}"
+                  .format(name, numBodies, force, step, median, largest),
+                  file=outFile)
+            budget.spent(name, numBodies, perf_counter() - clock)
+    return results
+
+def bench_integrators(sizes, integrators, repeat, budget, outFile):
+    """Time a step of every integrator with the NumPy direct sum engine."""
+    from rkvec import calc_accels
+
+    results = []
+    for numBodies in sizes:
+        masses, posits, vels = make_system(numBodies)
+        accels = calc_accels(numBodies, masses, posits)
+        for name in integrators:
+            if not budget.allows(name, numBodies, outFile):
+                continue
+            clock = perf_counter()
+            integrate = schemes[name][0]
+            step = best_time(lambda: integrate(1., numBodies, masses, posits,
+                                               vels, accels, calc_accels),
+                             repeat)
+            results.append({'group': 'integrator', 'name': name,
+                            'n': numBodies, 'metric': 'step', 'seconds': step})
+            print("{0:>11} N = {1:<7} step {2:.3e} s"
+                  .format(name, numBodies, step), file=outFile)
+            budget.spent(name, numBodies, perf_counter() - clock)
+    return results
+
+def bench_output(sizes, formats, nSteps, outFile):
+    """Time the writing of nSteps steps to a step file of every format."""
+    from sinks import StepWriter
+    from stepfile import BinaryStepWriter, CompressedStepWriter
+
+    results = []
+    with TemporaryDirectory() as tempDir:
+        for numBodies in sizes:
+            masses, posits, vels = make_system(numBodies)
+            names = ["body{0}".format(i) for i in range(numBodies)]
+            steps = max(1, min(nSteps, 2**21 // numBodies))
+            # The bodies move between steps, as the compressed format stores
+            # the change of each position
+            moved = posits + 0.01*arange(1, steps + 1)[:, None, None]*vels
+            for name in formats:
+                fileName = os.path.join(tempDir, "bench." + name)
+                start = perf_counter()
+                if name == 'text':
+                    sink = StepWriter(open(fileName, 'w'), names)
+                elif name == 'binary':
+                    sink = BinaryStepWriter(open(fileName, 'wb'), names, 1.)
+                else:
+                    sink = CompressedStepWriter(open(fileName, 'wb'), names,
+                                                1., 1e-9, 1e-11)
+                for step in range(1, steps + 1):
+                    sink.write(step, float(step), moved[step - 1], vels)
+                sink.close()
+                seconds = (perf_counter() - start)/steps
+                size = os.path.getsize(fileName)
+                results.append({'group': 'output', 'name': name,
+                                'n': numBodies, 'metric': 'write',
+                                'seconds': seconds, 'bytes': size//steps})
+                print("{0:>11} N = {1:<7} write {2:.3e} s per step, {3} bytes "
+                      "per step".format(name, numBodies, seconds, size//steps),
+                      file=outFile)
+    return results
+
+def environment():
+    """Return a description of the machine and the code being measured."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import numba
+        numbaVersion = numba.__version__
+    except ImportError:
+        numbaVersion = None
+    return {'commit': commit, 'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(), 'numpy': numpy.__version__,
+            'numba': numbaVersion, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+def result_key(result):
+    return (result['group'], result['name'], result['n'], result['metric'])
+
+def compare(results, baseline, threshold, outFile):
+    """Compare the times of the results against those of a baseline,
+    returning the results whose times grew by more than the threshold, a
+    fraction of the baseline time."""
+    before = {result_key(result): result for result in baseline}
+    regressions = []
+    print("\n{0:>11}{1:>11}{2:>9}{3:>10}{4:>12}{5:>12}{6:>8}".format(
+          "group", "name", "N", "metric", "before (s)", "after (s)", "ratio"),
+          file=outFile)
+    for result in results:
+        old = before.get(result_key(result))
+        if old is None or not old['seconds']:
+            continue
+        ratio = result['seconds']/old['seconds']
+        flag  = ''
+        if ratio > 1. + threshold:
+            regressions.append(result)
+            flag = '  slower'
+        print("{0:>11}{1:>11}{2:>9}{3:>10}{4:12.3e}{5:12.3e}{6:8.2f}{7}"
+              .format(result['group'], result['name'], str(result['n']),
+                      result['metric'], old['seconds'], result['seconds'],
+                      ratio, flag), file=outFile)
+    print("{0} of {1} times grew by more than {2:.0%}."
+          .format(len(regressions), len(results), threshold), file=outFile)
+    return regressions
+
+def write_csv(fileName, results):
+    """Write the results as CSV, one row for each result."""
+    fields = ['group', 'name', 'n', 'metric', 'seconds', 'errorMedian',
+              'errorMax', 'bytes']
+    with open(fileName, 'w', newline='') as csvFile:
+        writer = csv.DictWriter(csvFile, fields)
+        writer.writeheader()
+        for result in results:
+            row = {key: result.get(key) for key in fields}
+            if 'error' in result:
+                row['errorMedian'], row['errorMax'] = result['error']
+            writer.writerow(row)
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser(description=
+            "Time the force engines, integrators and step file writers on "
+            "synthetic disks of bodies, and compare against earlier results.")
+    parse.add_argument('-n', '--nbodies', default=[10, 100, 1000, 10000,
+                       100000], type=int, nargs='+', help=
+                       "Numbers of bodies to time.")
+    parse.add_argument('-e', '--engines', default=list(engineScaling),
+                       nargs='+', choices=list(engineScaling), help=
+                       "Force engines to time, those that cannot be imported"
+                       " are skipped.")
+    parse.add_argument('-s', '--integrators', default=integratorNames,
+                       nargs='+', choices=integratorNames, help=
+                       "Integrators to time, with the NumPy direct sum.")
+    parse.add_argument('-f', '--formats', default=formatNames, nargs='+',
+                       choices=formatNames, help="Step file formats to time.")
+    parse.add_argument('-r', '--repeat', default=3, type=int, help=
+                       "Timings of each measurement, the shortest is kept.")
+    parse.add_argument('--steps', default=200, type=int, help=
+                       "Steps written to time each step file format.")
+    parse.add_argument('--sample', default=2000, type=int, help=
+                       "Bodies compared against the direct sum.")
+    parse.add_argument('-b', '--budget', default=30., type=float, help=
+                       "Skip the measurements of an engine or integrator"
+                       " estimated to take longer than this, in seconds.")
+    parse.add_argument('--all', action='store_true', help=
+                       "Run every measurement, however long.")
+    parse.add_argument('-j', '--json', default=None, type=str, help=
+                       "Write the results to this JSON file.")
+    parse.add_argument('-c', '--csv', default=None, type=str, help=
+                       "Write the results to this CSV file.")
+    parse.add_argument('--compare', default=None, type=str, help=
+                       "JSON results of an earlier run to compare against.")
+    parse.add_argument('-t', '--threshold', default=0.1, type=float, help=
+                       "Fraction by which a time may grow before it is a "
+                       "regression, for '--compare'.")
+    args = parse.parse_args()
+
+    budget = Budget(None if args.all else args.budget)
+    sizes  = sorted(set(max(2, n) for n in args.nbodies))
+    results  = bench_engines(sizes, args.engines, args.repeat, args.sample,
+                             budget, sys.stdout)
+    results += bench_integrators(sizes, args.integrators, args.repeat, budget,
+                                 sys.stdout)
+    results += bench_output(sizes, args.formats, args.steps, sys.stdout)
+
+    report = {'environment': environment(), 'results': results}
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump(report, jsonFile, indent=1)
+    if args.csv:
+        write_csv(args.csv, results)
+    if args.compare:
+        with open(args.compare) as jsonFile:
+            baseline = json.load(jsonFile)['results']
+        if compare(results, baseline, args.threshold, sys.stdout):
+            sys.exit(1)
@@ -0,0 +1,61 @@
+# Checkpoints hold everything needed to continue a simulation exactly where
+# it stopped: the step and time, the positions, velocities and accelerations
+# of the bodies, the internal state of the integrator, and the state of each
+# sink, including how much of the step file had been written.
+#
+# A checkpoint is a NumPy '.npz' archive, with nested dictionaries flattened
+# into keys separated by '/'. It is written to a temporary file which then
+# replaces the previous checkpoint, so that a simulation which dies while
+# writing a checkpoint leaves the previous one intact.
+
+import json
+from os import fsync, replace
+
+from numpy import array, load, savez
+
+def flatten(state, prefix=''):
+    """Return a nested dictionary as a flat dictionary of '/' separated keys."""
+    flat = {}
+    for key, value in state.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '/'))
+        else:
+            flat[prefix + key] = array(value)
+    return flat
+
+def unflatten(flat):
+    """Return the nested dictionary of a flat dictionary of '/' separated
+    keys, with arrays of no dimensions returned as Python scalars."""
+    state = {}
+    for key, value in flat.items():
+        *path, name = key.split('/')
+        level = state
+        for part in path:
+            level = level.setdefault(part, {})
+        level[name] = value.item() if value.ndim == 0 else value
+    return state
+
+def save_checkpoint(fileName, meta, state):
+    """Write a checkpoint atomically.
+
+    Arguments:
+    fileName -- the name of the checkpoint file, '.chk' suffix.
+    meta     -- a dictionary of the parameters of the simulation, which must
+                be unchanged when it is resumed, stored as JSON.
+    state    -- a nested dictionary of the values and NumPy ndarrays of the
+                state of the simulation.
+    """
+    tempName = fileName + '.tmp'
+    with open(tempName, 'wb') as chkFile:
+        savez(chkFile, meta=array(json.dumps(meta)), **flatten(state))
+        chkFile.flush()
+        fsync(chkFile.fileno())
+    replace(tempName, fileName)
+
+def load_checkpoint(fileName):
+    """Read a checkpoint, returning the dictionaries 'meta' and 'state' as
+    they were given to save_checkpoint."""
+    with load(fileName, allow_pickle=False) as archive:
+        flat = {key: archive[key] for key in archive.files}
+    meta = json.loads(flat.pop('meta').item())
+    return meta, unflatten(flat)
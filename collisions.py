@@ -0,0 +1,240 @@
+# Bodies that touch during a step collide, rather than passing through each
+# other with forces that grow without bound. Each body is taken to move in a
+# straight line from its position at the start of the step to its position at
+# the end, and a pair collides if the closest approach of these lines is
+# within the sum of their radii, so that fast bodies cannot pass through each
+# other between the ends of two steps. Candidate pairs are found with a
+# spatial hash of the midpoints of the lines, so that the check costs about as
+# much as a step of the bodies' positions, and are either merged into one body
+# or bounced apart.
+#
+# Merged bodies are removed from the arrays of the simulation, which are made
+# shorter. The step file keeps a column for every body of the input file, so
+# each removed body is written with the position and velocity of the body it
+# merged into.
+
+from numpy import arange, cbrt, clip, cumsum, int64, maximum, minimum, ones, \
+                  sqrt, where, zeros
+
+from spatialhash import close_pairs
+
+def norm(vectors):
+    """Return the length of each vector."""
+    return sqrt((vectors**2).sum(axis=1))
+
+def dot(first, second):
+    """Return the scalar product of each pair of vectors."""
+    return (first*second).sum(axis=1)
+
+def closest_approach(start, change):
+    """Return the fraction of the step at which the separation start, moving
+    by change over the step, is shortest."""
+    lengthSq = dot(change, change)
+    return clip(-dot(start, change)/where(lengthSq > 0., lengthSq, 1.),
+                0., 1.)
+
+def find_collisions(posits, radii, previous=None):
+    """Return the pairs of bodies which overlap, or which touch during the
+    step from the positions previous if they are given, as NumPy ndarrays of
+    the indices of the first and second bodies of each pair.
+
+    Two bodies moving in straight lines over the step are at most the sum of
+    their radii apart at their closest approach only if the midpoints of
+    their lines are at most that plus the longest line apart, which bounds
+    the spatial hash.
+    """
+    if radii.max() == 0.:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    if previous is None:
+        first, second = close_pairs(posits, 2*radii.max())
+    else:
+        first, second = close_pairs(0.5*(previous + posits), 2*radii.max()
+                                    + norm(posits - previous).max())
+    return touching(posits, radii, previous, first, second)
+
+def touching(posits, radii, previous, first, second):
+    """Return the pairs of those given which overlap, or which touch during
+    the step from the positions previous if they are given."""
+    if previous is None:
+        dist = norm(posits[second] - posits[first])
+    else:
+        start  = previous[second] - previous[first]
+        change = posits[second] - posits[first] - start
+        dist = norm(start + closest_approach(start, change)[:, None]*change)
+    hit = dist < radii[first] + radii[second]
+    return first[hit], second[hit]
+
+def disjoint(first, second):
+    """Return the indices of pairs in which no body is in an earlier pair."""
+    seen  = set()
+    taken = []
+    for k, (i, j) in enumerate(zip(first.tolist(), second.tolist())):
+        if i not in seen and j not in seen:
+            seen.update((i, j))
+            taken.append(k)
+    return taken
+
+class Collisions:
+    """Merge or bounce the bodies which touch during each step.
+
+    The policy 'merge' joins the two bodies of a pair into one with the sum of
+    their masses and volumes, at their centre of mass and with their total
+    momentum. The policy 'bounce' reverses the approach of the two bodies
+    along the line between them, times the coefficient of restitution.
+
+    The slot of each body of the input file in the arrays of the simulation is
+    kept in 'owner', and the slot of the input file of each body of the
+    simulation in 'origin'. The masses of the input file, with the masses of
+    merged bodies moved to the body they merged into, are kept in 'outMasses'
+    for the sinks. The number of collisions of pairs which had passed through
+    each other by the end of the step is kept in 'nSwept'.
+    """
+    def __init__(self, policy, radii, masses, restitution=1.):
+        self.policy      = policy
+        self.radii       = radii.copy()
+        self.restitution = restitution
+        self.owner       = arange(len(radii))
+        self.origin      = arange(len(radii))
+        self.outMasses   = masses.copy()
+        self.nMerged     = 0
+        self.nBounced    = 0
+        self.nSwept      = 0
+
+    def apply(self, masses, posits, vels, previous=None):
+        """Resolve every collision during the step from the positions
+        previous, or of the bodies which overlap if previous is not given,
+        returning the masses, positions and velocities after it, and whether
+        any bodies were merged or moved."""
+        changed = False
+        first, second = find_collisions(posits, self.radii, previous)
+        while len(first):
+            taken = disjoint(first, second)
+            # Bounced pairs keep their bodies, the pairs sharing a body with
+            # one of them are bounced next
+            left = ones(len(first), dtype=bool)
+            left[taken] = False
+            nextFirst, nextSecond = first[left], second[left]
+            first, second = first[taken], second[taken]
+            # Pairs which touched during the step but are apart at its end
+            # have passed through each other
+            apart = zeros(len(first), dtype=bool)
+            if previous is not None:
+                apart = norm(posits[second] - posits[first]) \
+                        >= self.radii[first] + self.radii[second]
+                self.nSwept += int(apart.sum())
+            if self.policy == 'bounce':
+                vels = self.bounce(masses, posits, vels, first[~apart],
+                                   second[~apart])
+                if apart.any():
+                    posits, vels = self.rebound(masses, previous, posits, vels,
+                                                first[apart], second[apart])
+                    changed = True
+                # A bounce may have moved the bodies of the pairs left apart
+                first, second = touching(posits, self.radii, previous,
+                                         nextFirst, nextSecond)
+                continue
+            masses, posits, vels, alive = self.merge(masses, posits, vels,
+                                                     first, second)
+            changed = True
+            # A merged body may now overlap another, and a body may have
+            # touched more than one other during the step
+            if previous is not None:
+                previous = previous[alive]
+            first, second = find_collisions(posits, self.radii, previous)
+        return masses, posits, vels, changed
+
+    def bounce(self, masses, posits, vels, first, second):
+        """Reverse the approach of each pair along the line between them."""
+        normal   = posits[second] - posits[first]
+        normal  /= sqrt((normal**2).sum(axis=1))[:, None]
+        approach = ((vels[second] - vels[first])*normal).sum(axis=1)
+        # Pairs already moving apart are left alone
+        approach = where(approach < 0., approach, 0.)[:, None]
+        mFirst, mSecond = masses[first][:, None], masses[second][:, None]
+        impulse  = (1. + self.restitution)*approach*normal/(mFirst + mSecond)
+        vels = vels.copy()
+        vels[first]  += mSecond*impulse
+        vels[second] -= mFirst*impulse
+        self.nBounced += int((approach < 0.).sum())
+        return vels
+
+    def rebound(self, masses, previous, posits, vels, first, second):
+        """Bounce each pair which passed through the other during the step,
+        moving in straight lines, at the moment they touched: the rest of
+        their motion relative to each other, and their relative velocity, are
+        reflected off the line between them then. Their centre of mass is
+        left where it is."""
+        start  = previous[second] - previous[first]
+        change = (posits[second] - posits[first]) - start
+        # The first time that the separation is the sum of the radii
+        reach    = (self.radii[first] + self.radii[second])**2
+        lengthSq = dot(change, change)
+        half     = dot(start, change)/lengthSq
+        touch    = -half - sqrt(maximum(half**2 - (dot(start, start) - reach)
+                                        /lengthSq, 0.))
+        touch    = clip(touch, 0., 1.)[:, None]
+        contact  = start + touch*change
+        normal   = contact/norm(contact)[:, None]
+
+        def reflect(vectors):
+            approach = minimum(dot(vectors, normal), 0.)[:, None]
+            return vectors - (1. + self.restitution)*approach*normal
+
+        rest   = contact + reflect((1. - touch)*change)
+        relVel = reflect(vels[second] - vels[first])
+
+        mFirst, mSecond = masses[first][:, None], masses[second][:, None]
+        total = mFirst + mSecond
+        # Test particles of no mass are weighted equally
+        wFirst = where(total > 0., mFirst/where(total > 0., total, 1.), 0.5)
+        wSecond = 1. - wFirst
+        centre    = wFirst*posits[first] + wSecond*posits[second]
+        centreVel = wFirst*vels[first] + wSecond*vels[second]
+        posits, vels = posits.copy(), vels.copy()
+        posits[first]  = centre - wSecond*rest
+        posits[second] = centre + wFirst*rest
+        vels[first]    = centreVel - wSecond*relVel
+        vels[second]   = centreVel + wFirst*relVel
+        self.nBounced += len(first)
+        return posits, vels
+
+    def merge(self, masses, posits, vels, first, second):
+        """Merge each pair into its more massive body, removing the other,
+        returning the masses, positions and velocities of the bodies left and
+        which of the bodies before are left."""
+        keep = where(masses[second] > masses[first], second, first)
+        gone = where(masses[second] > masses[first], first, second)
+        mKeep, mGone = masses[keep][:, None], masses[gone][:, None]
+        total = mKeep + mGone
+
+        masses, posits, vels = masses.copy(), posits.copy(), vels.copy()
+        posits[keep] = (mKeep*posits[keep] + mGone*posits[gone])/total
+        vels[keep]   = (mKeep*vels[keep] + mGone*vels[gone])/total
+        masses[keep] = total[:, 0]
+        self.radii[keep] = cbrt(self.radii[keep]**3 + self.radii[gone]**3)
+
+        alive = ones(len(masses), dtype=bool)
+        alive[gone] = False
+        # The new slot of every old slot, the slot of its survivor if removed
+        newSlot = cumsum(alive) - 1
+        newSlot[gone] = newSlot[keep]
+        self.owner  = newSlot[self.owner]
+        self.origin = self.origin[alive]
+        self.radii  = self.radii[alive]
+        self.outMasses[:] = 0.
+        self.outMasses[self.origin] = masses[alive]
+        self.nMerged += len(gone)
+        return masses[alive], posits[alive], vels[alive], alive
+
+    def checkpoint(self):
+        return {'radii': self.radii, 'owner': self.owner,
+                'origin': self.origin, 'outMasses': self.outMasses,
+                'nMerged': self.nMerged, 'nBounced': self.nBounced,
+                'nSwept': self.nSwept}
+
+    def restore(self, state):
+        # The sinks hold the array of masses, which is filled rather than
+        # replaced
+        self.outMasses[:] = state.pop('outMasses')
+        for key, value in state.items():
+            setattr(self, key, value)
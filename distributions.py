@@ -0,0 +1,108 @@
+# Populations of many bodies drawn at random, for the DISTRIBUTION case of the
+# input file. Every function draws all of its bodies at once with NumPy, so
+# that a disk of a million bodies takes about as long as reading one from a
+# file.
+#
+# Reference for the Plummer sphere:
+# S. J. Aarseth, M. Henon & R. Wielen, Astron. Astrophys. 37, 183 (1974)
+
+from numpy import arange, argsort, column_stack, cos, cumsum, empty, \
+                  empty_like, flatnonzero, full, pi, sin, sqrt
+
+from rknopar import convG
+
+def mass_function(rng, n, mMin, mMax=None, slope=2.35):
+    """Draw the masses of n bodies from a power law dN/dm ~ m^-slope between
+    mMin and mMax, or return n masses of mMin if no mMax is given. The
+    default slope is that of E. E. Salpeter, Astrophys. J. 121, 161 (1955)."""
+    if mMax is None or mMax == mMin:
+        return full(n, mMin)
+    u = rng.random(n)
+    if slope == 1.:
+        return mMin*(mMax/mMin)**u
+    power = 1. - slope
+    return (mMin**power + u*(mMax**power - mMin**power))**(1./power)
+
+def on_circles(rng, radii):
+    """Return positions at the given distances from the origin, at angles
+    drawn uniformly."""
+    phi = rng.uniform(0., 2*pi, len(radii))
+    return column_stack((radii*cos(phi), radii*sin(phi)))
+
+def exponential_disk(rng, n, scale, cutoff=None):
+    """Draw the positions of n bodies of a disk with surface density
+    ~ exp(-r/scale), out to the radius cutoff if one is given.
+
+    The distance of a body from the centre then follows a Gamma distribution
+    of shape 2, bodies beyond the cutoff are drawn again.
+    """
+    radii = rng.gamma(2., scale, n)
+    if cutoff is not None:
+        beyond = flatnonzero(radii > cutoff)
+        while len(beyond):
+            radii[beyond] = rng.gamma(2., scale, len(beyond))
+            beyond = beyond[radii[beyond] > cutoff]
+    return on_circles(rng, radii)
+
+def annulus(rng, n, inner, outer):
+    """Draw the positions of n bodies spread uniformly over the area between
+    the radii inner and outer."""
+    radii = sqrt(rng.uniform(inner**2, outer**2, n))
+    return on_circles(rng, radii)
+
+def plummer(rng, n, scale, totalMass, cutoff=None):
+    """Draw the positions and velocities of n bodies of a Plummer sphere,
+    projected onto the plane.
+
+    The distances and speeds are drawn in three dimensions, in equilibrium
+    with the total mass, and the bodies given isotropic directions whose x
+    and y components are kept.
+
+    Arguments:
+    rng       -- a NumPy random Generator.
+    n         -- the number of bodies.
+    scale     -- the Plummer radius, in au.
+    totalMass -- the mass of the sphere, in Earth masses.
+    cutoff    -- the largest distance from the centre, in au, None for none.
+
+    Returns:
+    posits -- a NumPy ndarray of the positions of the bodies.
+    vels   -- a NumPy ndarray of the velocities of the bodies.
+    """
+
+    # The fraction of the mass within the cutoff bounds the drawn fraction
+    top = 1. if cutoff is None else (1. + (scale/cutoff)**2)**-1.5
+    frac  = rng.uniform(0., top, n)
+    radii = scale/sqrt(frac**(-2./3) - 1.)
+
+    # The speed as a fraction q of the escape speed, by rejection from
+    # g(q) = q^2 (1 - q^2)^(7/2), whose maximum is below 0.1
+    q    = empty(n)
+    left = arange(n)
+    while len(left):
+        trial  = rng.random(len(left))
+        accept = 0.1*rng.random(len(left)) < trial**2*(1. - trial**2)**3.5
+        q[left[accept]] = trial[accept]
+        left = left[~accept]
+    escape = sqrt(2*convG*totalMass)*(radii**2 + scale**2)**-0.25
+    return isotropic(rng, radii), isotropic(rng, q*escape)
+
+def isotropic(rng, lengths):
+    """Return the x and y components of vectors of the given lengths in
+    directions drawn uniformly over the sphere."""
+    cosTheta = rng.uniform(-1., 1., len(lengths))
+    return on_circles(rng, lengths*sqrt(1. - cosTheta**2))
+
+def circular_vels(posits, masses, centralMass=0.):
+    """Return the velocities of circular orbits, anticlockwise, around a
+    central mass and the mass of the other bodies closer to the centre, as
+    if the bodies were spread over spheres rather than a plane."""
+    radii = sqrt((posits**2).sum(axis=1))
+    order = argsort(radii)
+    inner = empty_like(radii)
+    inner[order] = cumsum(masses[order]) - masses[order]
+    speed = sqrt(convG*(centralMass + inner)/radii)
+    vels  = empty_like(posits)
+    vels[:, 0] = -speed*posits[:, 1]/radii
+    vels[:, 1] =  speed*posits[:, 0]/radii
+    return vels
@@ -0,0 +1,267 @@
+# Reference for the fast multipole method with Cartesian expansions:
+# W. Dehnen, Comput. Astrophys. Cosmol. 1, 1 (2014)
+#
+# The bodies move in a plane but attract with the three dimensional 1/r
+# potential, so the expansions are Cartesian Taylor series of 1/r in (x, y)
+# rather than the complex series of the two dimensional log potential. The
+# quadtree of the Barnes-Hut engine is reused, and the interactions between
+# its nodes are found with a dual tree walk, performed for all pairs of nodes
+# at once as a list that is refined level by level.
+
+from math import comb
+from functools import partial
+
+from numpy import add, arange, bincount, empty, int64, maximum, multiply, \
+                  nonzero, ones, repeat, sqrt, zeros, zeros_like
+
+from rknopar import convG
+from integrators import rk4_step
+from barneshut import build_tree, expand_ranges, add_accels
+
+# Largest number of bodies in a node for which it is treated as a leaf.
+leafSize = 16
+
+def multi_indices(order):
+    """Return the list of exponents (a, b) of x^a y^b with a + b <= order,
+    and a dictionary from each exponent to its position in the list."""
+    indices = [(a, n - a) for n in range(order + 1) for a in range(n, -1, -1)]
+    return indices, {index: i for i, index in enumerate(indices)}
+
+def powers(order, dX, dY):
+    """Return the monomials dX^a dY^b for every exponent up to 'order', one
+    row per exponent."""
+    indices, _ = multi_indices(order)
+    powX = [ones(len(dX))]
+    powY = [ones(len(dY))]
+    for n in range(order):
+        powX.append(powX[-1]*dX)
+        powY.append(powY[-1]*dY)
+    out = empty((len(indices), len(dX)))
+    for i, (a, b) in enumerate(indices):
+        out[i] = powX[a]*powY[b]
+    return out
+
+def kernel_coeffs(order, rX, rY):
+    """Return the Taylor coefficients c_k of 1/|r - h| = sum_k c_k h^k, for
+    every exponent k up to 'order', using the recurrence relation
+
+        |k| r^2 c_k = (2|k| - 1) sum_i r_i c_{k-e_i} - (|k| - 1) sum_i c_{k-2e_i}
+
+    where the sums run over the x and y components, one row per exponent.
+    """
+    indices, where = multi_indices(order)
+    rSumSq = rX*rX + rY*rY
+    coeffs = empty((len(indices), len(rX)))
+    coeffs[0] = 1/sqrt(rSumSq)
+    for i, (a, b) in enumerate(indices[1:], start=1):
+        n = a + b
+        term = zeros(len(rX))
+        if a > 0:
+            term += (2*n - 1) * rX * coeffs[where[a - 1, b]]
+        if b > 0:
+            term += (2*n - 1) * rY * coeffs[where[a, b - 1]]
+        if a > 1:
+            term -= (n - 1) * coeffs[where[a - 2, b]]
+        if b > 1:
+            term -= (n - 1) * coeffs[where[a, b - 2]]
+        coeffs[i] = term / (n*rSumSq)
+    return coeffs
+
+def shift_tables(order):
+    """Return the index and coefficient tables for translating expansions.
+
+    For exponents alpha and gamma, 'diff' holds the position of alpha - gamma
+    and 'binom' the product of binomial coefficients C(alpha, gamma), or zero
+    where gamma is not contained in alpha. For the multipole to local
+    translation, 'sums' holds the position of alpha + beta and 'm2l' the
+    coefficient (-1)^|beta| C(alpha + beta, beta), or zero where the sum
+    exceeds the order.
+    """
+    indices, where = multi_indices(order)
+    size  = len(indices)
+    diff  = zeros((size, size), dtype=int64)
+    binom = zeros((size, size))
+    sums  = zeros((size, size), dtype=int64)
+    m2l   = zeros((size, size))
+    for i, (a, b) in enumerate(indices):
+        for j, (c, d) in enumerate(indices):
+            if c <= a and d <= b:
+                diff[i, j]  = where[a - c, b - d]
+                binom[i, j] = comb(a, c) * comb(b, d)
+            if a + b + c + d <= order:
+                sums[i, j] = where[a + c, b + d]
+                m2l[i, j]  = (-1)**(a + b) * comb(a + c, a) * comb(b + d, b)
+    return {'diff': diff, 'binom': binom, 'sums': sums, 'm2l': m2l}
+
+def translate(coeffs, values, index, table):
+    """Apply a translation to a set of expansions, returning
+
+        out[i, n] = sum_j table[i, j] coeffs[index[i, j], n] values[j, n]
+
+    for every expansion n. The tables are sparse, so the sum runs only over
+    their non-zero entries, each as one operation over all expansions.
+    """
+    out  = zeros(values.shape)
+    term = empty(values.shape[1])
+    for i, j in zip(*nonzero(table)):
+        multiply(coeffs[index[i, j]], values[j], out=term)
+        term *= table[i, j]
+        out[i] += term
+    return out
+
+def calc_accels(numBodies, bodyMasses, posits, order=4, theta=0.5,
+                targets=None):
+    """Calculate the gravitational acceleration of every body using the fast
+    multipole method.
+
+    The multipole expansion of every node about its centre of mass is built
+    from its children, and every pair of nodes whose bounding circles of radii
+    r_A and r_B satisfy r_A + r_B < theta d, where d is the distance between
+    their centres of mass, interacts through a local expansion. Nodes that
+    are too close are split until both are leaves, whose bodies interact
+    directly. The local expansions are then passed down to the bodies.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+    order      -- the order of the multipole and local expansions, the error
+                  falls roughly as theta^(order + 1).
+    theta      -- the separation criterion of interacting nodes.
+    targets    -- an optional NumPy ndarray of the indices of the bodies whose
+                  accelerations are wanted, by default every body. The
+                  expansions are found for every body regardless.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, or of the
+              targets in the order given, each element of which has in turn
+              two dimensions: [x, y].
+    """
+
+    tree   = build_tree(bodyMasses, posits)
+    sortedMass = bodyMasses[tree['order']]
+    sortedX = posits[tree['order'], 0]
+    sortedY = posits[tree['order'], 1]
+
+    # Nodes below the first level made entirely of leaves are never used
+    levels = []
+    for level in tree['levels']:
+        levels.append(level)
+        if (level['end'] - level['start']).max() <= leafSize:
+            break
+
+    # Radius of the bounding circle of each node about its centre of mass
+    for level in levels:
+        counts = level['end'] - level['start']
+        nodeOf = repeat(arange(len(counts)), counts)
+        rX = sortedX - level['com'][nodeOf, 0]
+        rY = sortedY - level['com'][nodeOf, 1]
+        level['radius'] = maximum.reduceat(sqrt(rX*rX + rY*rY), level['start'])
+
+    tables  = shift_tables(order)
+    indices, _ = multi_indices(order)
+    size    = len(indices)
+
+    # Upward pass, multipoles of the deepest nodes from their bodies...
+    deepest = levels[-1]
+    counts  = deepest['end'] - deepest['start']
+    nodeOf  = repeat(arange(len(counts)), counts)
+    bodPows = powers(order, sortedX - deepest['com'][nodeOf, 0],
+                            sortedY - deepest['com'][nodeOf, 1])
+    deepest['multi'] = add.reduceat(sortedMass*bodPows, deepest['start'],
+                                    axis=1)
+    # ... then of each parent from its children.
+    for parent, child in zip(levels[-2::-1], levels[:0:-1]):
+        counts = parent['child1'] - parent['child0']
+        parentOf = repeat(arange(len(counts)), counts)
+        shift = powers(order, child['com'][:, 0] - parent['com'][parentOf, 0],
+                              child['com'][:, 1] - parent['com'][parentOf, 1])
+        shifted = translate(shift, child['multi'], tables['diff'],
+                            tables['binom'])
+        parent['multi'] = add.reduceat(shifted, parent['child0'], axis=1)
+
+    for level in levels:
+        level['local'] = zeros((size, len(level['start'])))
+
+    # Dual tree walk, beginning with the root interacting with itself
+    accels = zeros_like(posits)
+    tgts = zeros(1, dtype=int64)
+    srcs = zeros(1, dtype=int64)
+    for depth, level in enumerate(levels):
+        last   = depth == len(levels) - 1
+        counts = level['end'] - level['start']
+        rX = level['com'][tgts, 0] - level['com'][srcs, 0]
+        rY = level['com'][tgts, 1] - level['com'][srcs, 1]
+        apart = (tgts != srcs) & (level['radius'][tgts] + level['radius'][srcs]
+                                  < theta*sqrt(rX*rX + rY*rY))
+        leaves = (counts[tgts] <= leafSize) & (counts[srcs] <= leafSize)
+        direct = ~apart & (leaves | last)
+
+        # Multipole to local translation for well separated nodes
+        if apart.any():
+            coeffs = kernel_coeffs(order, rX[apart], rY[apart])
+            local  = translate(coeffs, level['multi'][:, srcs[apart]],
+                               tables['sums'], tables['m2l'])
+            for i in range(size):
+                level['local'][i] += bincount(tgts[apart], local[i],
+                                              minlength=len(counts))
+
+        # Direct summation between the bodies of nearby leaves
+        if direct.any():
+            pair, bods = expand_ranges(level['start'][tgts[direct]],
+                                       counts[tgts[direct]])
+            pair, members = expand_ranges(level['start'][srcs[direct]][pair],
+                                          counts[srcs[direct]][pair])
+            bods = bods[pair]
+            notSelf = bods != members
+            bods, members = bods[notSelf], members[notSelf]
+            add_accels(accels, bods, sortedX[bods], sortedY[bods],
+                       sortedX[members], sortedY[members], sortedMass[members])
+
+        # Split both nodes of every remaining pair into pairs of children
+        split = ~apart & ~direct
+        if not split.any():
+            break
+        nTgt = (level['child1'] - level['child0'])[tgts[split]]
+        nSrc = (level['child1'] - level['child0'])[srcs[split]]
+        pair, combo = expand_ranges(zeros(len(nTgt), dtype=int64), nTgt*nSrc)
+        tgts = level['child0'][tgts[split]][pair] + combo // nSrc[pair]
+        srcs = level['child0'][srcs[split]][pair] + combo % nSrc[pair]
+
+    # Downward pass, local expansions of each child from its parent...
+    for parent, child in zip(levels[:-1], levels[1:]):
+        counts = parent['child1'] - parent['child0']
+        parentOf = repeat(arange(len(counts)), counts)
+        shift = powers(order, child['com'][:, 0] - parent['com'][parentOf, 0],
+                              child['com'][:, 1] - parent['com'][parentOf, 1])
+        child['local'] += translate(shift, parent['local'][:, parentOf],
+                                    tables['diff'].T, tables['binom'].T)
+
+    # ... then the gradient of the local expansion at each body.
+    counts = deepest['end'] - deepest['start']
+    local  = deepest['local'][:, repeat(arange(len(counts)), counts)]
+    gradX  = zeros(numBodies)
+    gradY  = zeros(numBodies)
+    where  = multi_indices(order)[1]
+    for i, (a, b) in enumerate(indices):
+        if a > 0:
+            gradX += a * local[i] * bodPows[where[a - 1, b]]
+        if b > 0:
+            gradY += b * local[i] * bodPows[where[a, b - 1]]
+    accels[:, 0] += convG * gradX
+    accels[:, 1] += convG * gradY
+
+    accels[tree['order']] = accels.copy()
+    return accels if targets is None else accels[targets]
+
+def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+              order=4):
+    """Perform a forward step using the fourth-order Runge-Kutta method, with
+    the forces at each stage from the fast multipole method.
+
+    Arguments and returns are as for rkvec.make_step, with the addition of:
+    order -- the order of the multipole expansions, see calc_accels.
+    """
+    return rk4_step(stepSize, numBodies, bodyMasses, currentPosits,
+                    currentVels, partial(calc_accels, order=order))
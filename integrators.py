@@ -0,0 +1,506 @@
+# Time integration schemes, independent of the engine used for the forces.
+#
+# Every scheme takes the accelerations at the start of the step, which were
+# returned by the previous step, and returns the accelerations at the end of
+# the step along with the positions and velocities, so that no force
+# evaluation is repeated between one step and the next.
+#
+# Reference for the symplectic compositions:
+# H. Yoshida, Phys. Lett. A 150, 262 (1990)
+# Reference for the embedded Runge-Kutta pair:
+# J. R. Dormand & P. J. Prince, J. Comp. Appl. Math. 6, 19 (1980)
+# Reference for the block time steps:
+# V. Springel, Mon. Not. R. Astron. Soc. 364, 1105 (2005)
+# Reference for the Wisdom-Holman map in democratic heliocentric coordinates:
+# M. J. Duncan, H. F. Levison & M. H. Lee, Astron. J. 116, 2067 (1998)
+# Reference for the leapfrog with Keplerian drifts of close pairs:
+# J. Chambers, Mon. Not. R. Astron. Soc. 304, 793 (1999)
+
+from functools import partial
+
+from numpy import abs as npabs
+from numpy import arange, argmax, argsort, bincount, ceil, errstate, \
+                  flatnonzero, full, int64, isfinite, log2, maximum, mean, \
+                  sort, sqrt, unique, zeros, zeros_like
+
+from rknopar import convG
+from kepler import kepler_drift
+from spatialhash import close_pairs
+
+def rk4_stages(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+               currentAccels, accelFunc):
+    """Perform the stages of a fourth-order Runge-Kutta step, given the
+    accelerations at the start of the step, returning the next positions and
+    velocities."""
+
+    l1 = stepSize * currentVels
+    k1 = stepSize * currentAccels
+
+    l2 = stepSize * (currentVels + k1/2)
+    k2 = stepSize * accelFunc(numBodies, bodyMasses, currentPosits + l1/2)
+
+    l3 = stepSize * (currentVels + k2/2)
+    k3 = stepSize * accelFunc(numBodies, bodyMasses, currentPosits + l2/2)
+
+    l4 = stepSize * (currentVels + k3)
+    k4 = stepSize * accelFunc(numBodies, bodyMasses, currentPosits + l3)
+
+    nextPosits = currentPosits + (l1 + 2*l2 + 2*l3 + l4)/6
+    nextVels   = currentVels   + (k1 + 2*k2 + 2*k3 + k4)/6
+
+    return nextPosits, nextVels
+
+def rk4_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+             accelFunc):
+    """Perform a forward fourth-order Runge-Kutta step for any force engine.
+
+    Arguments are as for rkvec.make_step, with the addition of:
+    accelFunc -- a function with the signature of rkvec.calc_accels that
+                 returns the accelerations of all bodies at given positions.
+    """
+    return rk4_stages(stepSize, numBodies, bodyMasses, currentPosits,
+                      currentVels,
+                      accelFunc(numBodies, bodyMasses, currentPosits),
+                      accelFunc)
+
+def runge_kutta(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+                currentAccels, accelFunc):
+    """Perform a forward step using the fourth-order Runge-Kutta method.
+
+    The first stage uses the accelerations at the start of the step, and the
+    accelerations at the end of the step are returned for the first stage of
+    the next step, so that each step costs four force evaluations.
+
+    Arguments:
+    stepSize      -- the size of the time step in days.
+    numBodies     -- the number of bodies equal to len(bodyMasses).
+    bodyMasses    -- a NumPy ndarray of masses for each body.
+    currentPosits -- a NumPy ndarray of the current positions of all bodies,
+                     each element of which has in turn two dimensions: [x, y].
+    currentVels   -- a NumPy ndarray of the current velocities of all bodies.
+    currentAccels -- a NumPy ndarray of the current accelerations of all
+                     bodies, as returned by accelFunc.
+    accelFunc     -- a function with the signature of rkvec.calc_accels that
+                     returns the accelerations of all bodies at given positions.
+
+    Returns:
+    nextPosits -- a NumPy ndarray of the next positions of all bodies.
+    nextVels   -- a NumPy ndarray of the next velocities of all bodies.
+    nextAccels -- a NumPy ndarray of the accelerations at the next positions.
+    """
+    nextPosits, nextVels = rk4_stages(stepSize, numBodies, bodyMasses,
+                                      currentPosits, currentVels,
+                                      currentAccels, accelFunc)
+    return nextPosits, nextVels, accelFunc(numBodies, bodyMasses, nextPosits)
+
+def kick_drift(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+               currentAccels, accelFunc, weights=(1.,)):
+    """Perform a forward step as a composition of kick-drift-kick leapfrog
+    steps, of sizes weights[i]*stepSize.
+
+    The closing kick of each leapfrog step is merged with the opening kick of
+    the next, so that each step costs one force evaluation per weight. The
+    scheme is symplectic and time reversible, so the energy error does not
+    grow secularly for a fixed step size.
+
+    Arguments and returns are as for runge_kutta, with the addition of:
+    weights -- the fractions of the step taken by each leapfrog step.
+    """
+
+    posits = currentPosits.copy()
+    vels   = currentVels + 0.5*weights[0]*stepSize*currentAccels
+    for i, weight in enumerate(weights):
+        posits += weight*stepSize*vels
+        accels  = accelFunc(numBodies, bodyMasses, posits)
+        if i < len(weights) - 1:
+            vels += 0.5*(weight + weights[i+1])*stepSize*accels
+        else:
+            vels += 0.5*weight*stepSize*accels
+    return posits, vels, accels
+
+# Fourth-order weights from the triple jump of a second-order step
+cubeRoot2 = 2**(1/3)
+yoshida4Weights = (1/(2 - cubeRoot2), -cubeRoot2/(2 - cubeRoot2),
+                   1/(2 - cubeRoot2))
+
+# Sixth-order weights, solution A of Yoshida (1990)
+w1, w2, w3 = -1.17767998417887, 0.235573213359357, 0.784513610477560
+w0 = 1 - 2*(w1 + w2 + w3)
+yoshida6Weights = (w3, w2, w1, w0, w1, w2, w3)
+
+# Butcher tableau of the Dormand-Prince 5(4) pair, the last row of 'dpA' is
+# the fifth-order solution, which is also the point of the seventh stage
+dpA = ((1/5,),
+       (3/40, 9/40),
+       (44/45, -56/15, 32/9),
+       (19372/6561, -25360/2187, 64448/6561, -212/729),
+       (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+       (35/384, 0., 500/1113, 125/192, -2187/6784, 11/84))
+# Difference between the fifth and fourth-order weights, for the error
+dpE = (35/384 - 5179/57600, 0., 500/1113 - 7571/16695, 125/192 - 393/640,
+       -2187/6784 + 92097/339200, 11/84 - 187/2100, -1/40)
+
+def dormand_prince(stepSize, numBodies, bodyMasses, currentPosits,
+                   currentVels, currentAccels, accelFunc):
+    """Perform a trial step using the Dormand-Prince 5(4) method.
+
+    The acceleration at the last stage is the acceleration at the end of the
+    step, so that each trial step costs six force evaluations.
+
+    Arguments are as for runge_kutta.
+
+    Returns:
+    nextPosits -- a NumPy ndarray of the next positions of all bodies.
+    nextVels   -- a NumPy ndarray of the next velocities of all bodies.
+    nextAccels -- a NumPy ndarray of the accelerations at the next positions.
+    errPosits  -- the estimated error of the next positions.
+    errVels    -- the estimated error of the next velocities.
+    """
+
+    stageVels   = [currentVels]
+    stageAccels = [currentAccels]
+    for row in dpA:
+        posits = currentPosits.copy()
+        vels   = currentVels.copy()
+        for coeff, stageVel, stageAccel in zip(row, stageVels, stageAccels):
+            if coeff != 0.:
+                posits += stepSize*coeff*stageVel
+                vels   += stepSize*coeff*stageAccel
+        stageVels.append(vels)
+        stageAccels.append(accelFunc(numBodies, bodyMasses, posits))
+
+    errPosits = zeros_like(currentPosits)
+    errVels   = zeros_like(currentVels)
+    for coeff, stageVel, stageAccel in zip(dpE, stageVels, stageAccels):
+        if coeff != 0.:
+            errPosits += stepSize*coeff*stageVel
+            errVels   += stepSize*coeff*stageAccel
+
+    return posits, vels, stageAccels[-1], errPosits, errVels
+
+def error_norm(error, current, following, tolerance):
+    """Return the root mean square of the error relative to the tolerance.
+
+    Each component is scaled by its own magnitude plus the root mean square
+    magnitude of all components, so that components which pass through zero
+    are not held to an impossible absolute accuracy.
+    """
+    size  = sqrt(mean(current**2))
+    scale = tolerance*(size + maximum(npabs(current), npabs(following)))
+    return sqrt(mean((error/scale)**2))
+
+def adaptive_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+                  currentAccels, accelFunc, tolerance, maxRejected=50):
+    """Perform a forward step of at most stepSize with the Dormand-Prince 5(4)
+    method, shrinking the step until the estimated error is within tolerance.
+
+    A trial step whose error is not finite is rejected as if it were too
+    large. FloatingPointError is raised if the current state is not finite,
+    or if maxRejected trial steps in a row are rejected.
+
+    Arguments are as for runge_kutta, with the addition of:
+    tolerance   -- the relative error allowed in each step.
+    maxRejected -- the most trial steps rejected before giving up.
+
+    Returns:
+    nextPosits -- a NumPy ndarray of the next positions of all bodies.
+    nextVels   -- a NumPy ndarray of the next velocities of all bodies.
+    nextAccels -- a NumPy ndarray of the accelerations at the next positions.
+    stepTaken  -- the size of the step that was taken in days.
+    stepNext   -- the size of step suggested for the next step.
+    nRejected  -- the number of trial steps that were rejected.
+    """
+
+    if not (isfinite(currentPosits).all() and isfinite(currentVels).all()):
+        raise FloatingPointError("the positions or velocities are not finite")
+    nRejected = 0
+    while True:
+        nextPosits, nextVels, nextAccels, errPosits, errVels \
+            = dormand_prince(stepSize, numBodies, bodyMasses, currentPosits,
+                             currentVels, currentAccels, accelFunc)
+        error = max(error_norm(errPosits, currentPosits, nextPosits, tolerance),
+                    error_norm(errVels, currentVels, nextVels, tolerance))
+        # Standard step size controller for a fifth-order method, an error
+        # that is not finite shrinks the step as much as a very large one
+        if not isfinite(error):
+            factor = 0.2
+        else:
+            factor = 0.9*error**-0.2 if error > 0. else 5.
+            if error <= 1.:
+                return nextPosits, nextVels, nextAccels, stepSize, \
+                       stepSize*min(5., factor), nRejected
+        stepSize *= max(0.2, factor)
+        nRejected += 1
+        if nRejected >= maxRejected:
+            raise FloatingPointError("{0} trial steps in a row were rejected, "
+                                     "down to {1:.2e} days"
+                                     .format(nRejected, stepSize))
+
+def initial_step(numBodies, bodyMasses, posits, vels, accels, tolerance):
+    """Estimate a first step size for the adaptive integrator, as a small
+    fraction of the time for each body to move or change its velocity by its
+    own magnitude."""
+    scaleVels = sqrt(mean(vels**2)) + 1e-300
+    timePosit = sqrt(mean(posits**2)) / scaleVels
+    timeVel   = scaleVels / (sqrt(mean(accels**2)) + 1e-300)
+    return 0.01*tolerance**0.2*min(timePosit, timeVel)
+
+def choose_levels(stepSize, accels, jerks, levels, eta):
+    """Return the level of each body, such that its step stepSize/2^level
+    is the longest no greater than eta |a|/|j|."""
+    aMag = sqrt((accels**2).sum(axis=1))
+    jMag = sqrt((jerks**2).sum(axis=1))
+    with errstate(divide='ignore', invalid='ignore'):
+        wanted = ceil(log2(stepSize*jMag/(eta*aMag)))
+    # Bodies with no jerk may take the longest step, with no force the shortest
+    wanted[jMag == 0.] = 0
+    wanted[(aMag == 0.) & (jMag > 0.)] = levels - 1
+    return wanted.clip(0, levels - 1).astype(int64)
+
+def block_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+               currentAccels, accelFunc, levels=8, eta=0.01, state=None):
+    """Perform a forward step with hierarchical block time steps, in which
+    each body takes kick-drift-kick leapfrog steps of stepSize/2^level.
+
+    Every body drifts between the ends of the shortest steps in use, but only
+    the bodies whose own steps end there are given new forces and kicked, by
+    passing them to accelFunc as its targets. The level of each body is chosen
+    from its acceleration a and jerk j at the end of each of its steps, the
+    jerk being estimated from the change of acceleration across the step. A
+    body may shorten its step at the end of any step, but may only lengthen
+    it where the longer step would begin in step with the hierarchy. Every
+    body finishes at the end of the step, so the returned positions and
+    velocities are synchronised.
+
+    Arguments and returns are as for runge_kutta, with the addition of:
+    levels -- the number of levels, the shortest step is stepSize/2^(levels-1).
+    eta    -- the accuracy parameter of the step of each body.
+    state  -- a dictionary kept from one step to the next, holding the 'level'
+              of every body, the number of 'kicks' made at each level, and
+              the 'occupancy' summed over steps of each level. Every body
+              begins at the shortest step until its jerk is known.
+    """
+
+    nTicks = 2**(levels - 1)
+    tick   = stepSize/nTicks
+    if state is None:
+        state = {}
+    if 'level' not in state:
+        state['level']     = full(numBodies, levels - 1, dtype=int64)
+        state['kicks']     = zeros(levels, dtype=int64)
+        state['occupancy'] = zeros(levels, dtype=int64)
+    level = state['level']
+    # Length of the step of each body in units of the shortest step
+    span  = 2**(levels - 1 - level)
+
+    posits = currentPosits.copy()
+    accels = currentAccels.copy()
+    vels   = currentVels + 0.5*(span*tick)[:, None]*accels
+    now = 0
+    while now < nTicks:
+        # Drift everybody to the next end of a step
+        spans  = unique(span)
+        after  = ((now//spans + 1)*spans).min()
+        posits += (after - now)*tick*vels
+        now    = after
+
+        active    = flatnonzero(now % span == 0)
+        newAccels = accelFunc(numBodies, bodyMasses, posits, targets=active)
+        activeStep = (span[active]*tick)[:, None]
+        vels[active] += 0.5*activeStep*newAccels
+        jerks = (newAccels - accels[active])/activeStep
+        accels[active] = newAccels
+        state['kicks'] += bincount(level[active], minlength=levels)
+
+        # Longer steps must begin at a multiple of their own length
+        newLevel = choose_levels(stepSize, newAccels, jerks, levels, eta)
+        while True:
+            early = now % 2**(levels - 1 - newLevel) != 0
+            if not early.any():
+                break
+            newLevel[early] += 1
+        level[active] = newLevel
+        span[active]  = 2**(levels - 1 - newLevel)
+        if now < nTicks:
+            vels[active] += 0.5*(span[active]*tick)[:, None]*accels[active]
+
+    state['occupancy'] += bincount(level, minlength=levels)
+    return posits, vels, accels
+
+def central_accels(mu, helioPosits):
+    """Return the accelerations of bodies at heliocentric positions from a
+    central mass with gravitational parameter mu."""
+    rSq = (helioPosits**2).sum(axis=1)
+    return -mu*helioPosits/(rSq*sqrt(rSq))[:, None]
+
+def wisdom_holman(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+                  currentAccels, accelFunc):
+    """Perform a forward step using the Wisdom-Holman map in democratic
+    heliocentric coordinates, for systems dominated by one central mass.
+
+    The positions of the bodies are taken relative to the most massive body,
+    the central mass, and their velocities relative to the centre of mass.
+    The step drifts each body analytically along its Keplerian orbit around
+    the central mass, between two half kicks from the forces of the other
+    bodies and two half drifts from the motion of the central mass. Only the
+    forces between the other bodies are integrated numerically, so that the
+    step may be a good fraction of the shortest orbital period. The map is
+    symplectic, so the energy error does not grow secularly.
+
+    The forces between the other bodies are the accelerations from accelFunc
+    with the mass of the central body set to zero. The accelerations of the
+    central mass are added to them for the accelerations returned, and taken
+    from those given, so that each step costs one force evaluation.
+
+    Arguments and returns are as for runge_kutta.
+    """
+
+    central = argmax(bodyMasses)
+    others  = flatnonzero(arange(numBodies) != central)
+    mu = convG*bodyMasses[central]
+    centralMass = bodyMasses[central]
+    totalMass   = bodyMasses.sum()
+    otherMasses = bodyMasses[others][:, None]
+    interMasses = bodyMasses.copy()
+    interMasses[central] = 0.
+
+    # The centre of mass moves uniformly, and is restored after the step
+    centreVel = (bodyMasses[:, None]*currentVels).sum(axis=0)/totalMass
+    centre    = (bodyMasses[:, None]*currentPosits).sum(axis=0)/totalMass \
+              + stepSize*centreVel
+
+    helio = currentPosits[others] - currentPosits[central]
+    bary  = currentVels[others] - centreVel
+    inter = currentAccels[others] - central_accels(mu, helio)
+
+    # Half drift from the motion of the central mass, and half kick
+    helio += 0.5*stepSize*(otherMasses*bary).sum(axis=0)/centralMass
+    bary  += 0.5*stepSize*inter
+    helio, bary = kepler_drift(mu, helio, bary, stepSize)
+
+    posits = zeros_like(currentPosits)
+    posits[others] = helio
+    accels = accelFunc(numBodies, interMasses, posits)
+
+    bary  += 0.5*stepSize*accels[others]
+    helio += 0.5*stepSize*(otherMasses*bary).sum(axis=0)/centralMass
+
+    # Back from democratic heliocentric coordinates
+    posits[central] = centre - (otherMasses*helio).sum(axis=0)/totalMass
+    posits[others]  = helio + posits[central]
+    vels = zeros_like(currentVels)
+    vels[others]  = bary + centreVel
+    vels[central] = centreVel - (otherMasses*bary).sum(axis=0)/centralMass
+    accels[others] += central_accels(mu, helio)
+    return posits, vels, accels
+
+def find_pairs(stepSize, bodyMasses, posits, factor):
+    """Return the close pairs of bodies whose orbit around each other is too
+    fast for the step, those with a free-fall time sqrt(r^3/G(m_i + m_j))
+    shorter than factor*stepSize.
+
+    Candidates are found with a spatial hash, within the largest separation
+    that the two most massive bodies could have. Each body is in at most one
+    pair, the pairs with the shortest free-fall times are taken first.
+    """
+    heaviest = sort(bodyMasses)[-2:].sum()
+    radius   = (convG*heaviest*(factor*stepSize)**2)**(1/3)
+    first, second = close_pairs(posits, radius)
+    if len(first) == 0:
+        return first, second
+
+    pairMu = convG*(bodyMasses[first] + bodyMasses[second])
+    rCube  = (((posits[second] - posits[first])**2).sum(axis=1))**1.5
+    with errstate(divide='ignore'):
+        freeFall = sqrt(rCube/pairMu)
+    close = flatnonzero(freeFall < factor*stepSize)
+    close = close[argsort(freeFall[close], kind='stable')]
+
+    paired = set()
+    taken  = []
+    for k in close.tolist():
+        i, j = first[k], second[k]
+        if i not in paired and j not in paired:
+            paired.update((i, j))
+            taken.append(k)
+    return first[taken], second[taken]
+
+def pair_accels(bodyMasses, posits, first, second):
+    """Return the accelerations of every body from the other body of its pair,
+    zero for the bodies in no pair."""
+    accels = zeros_like(posits)
+    sep    = posits[second] - posits[first]
+    rSq    = (sep**2).sum(axis=1)
+    invR3  = convG/(rSq*sqrt(rSq))[:, None]
+    accels[first]  =  bodyMasses[second][:, None]*invR3*sep
+    accels[second] = -bodyMasses[first][:, None]*invR3*sep
+    return accels
+
+def pair_drift(stepSize, bodyMasses, posits, vels, first, second):
+    """Drift every body in a straight line, except the close pairs, whose
+    centres of mass drift in a straight line while the bodies orbit each
+    other exactly along their two-body Keplerian orbit."""
+    nextPosits = posits + stepSize*vels
+    if len(first) == 0:
+        return nextPosits, vels
+
+    nextVels = vels.copy()
+    mFirst, mSecond = bodyMasses[first][:, None], bodyMasses[second][:, None]
+    mPair     = mFirst + mSecond
+    centreVel = (mFirst*vels[first] + mSecond*vels[second])/mPair
+    centre    = (mFirst*posits[first] + mSecond*posits[second])/mPair \
+              + stepSize*centreVel
+    rel, relVel = kepler_drift(convG*mPair[:, 0],
+                               posits[second] - posits[first],
+                               vels[second] - vels[first], stepSize)
+    nextPosits[first]  = centre - mSecond/mPair*rel
+    nextPosits[second] = centre + mFirst/mPair*rel
+    nextVels[first]    = centreVel - mSecond/mPair*relVel
+    nextVels[second]   = centreVel + mFirst/mPair*relVel
+    return nextPosits, nextVels
+
+def encounter_step(stepSize, numBodies, bodyMasses, currentPosits,
+                   currentVels, currentAccels, accelFunc, factor=20.,
+                   state=None):
+    """Perform a forward kick-drift-kick leapfrog step, in which close pairs
+    of bodies orbit each other exactly rather than in steps.
+
+    The close pairs are found at the start of each step by find_pairs. The
+    force of each pair on itself is taken out of the kicks, and the pair is
+    instead moved along its two-body Keplerian orbit in the drift, so that a
+    tight binary does not need a short step for the whole simulation. The
+    step is symplectic for as long as the pairs are unchanged.
+
+    Arguments and returns are as for runge_kutta, with the addition of:
+    factor -- the pairs with a free-fall time shorter than factor*stepSize
+              are moved along their Keplerian orbits.
+    state  -- a dictionary in which the numbers of 'steps', of steps of pairs
+              'pairSteps', and the most pairs at once 'mostPairs' are counted.
+    """
+
+    first, second = find_pairs(stepSize, bodyMasses, currentPosits, factor)
+    vels = currentVels + 0.5*stepSize*(currentAccels
+           - pair_accels(bodyMasses, currentPosits, first, second))
+    posits, vels = pair_drift(stepSize, bodyMasses, currentPosits, vels,
+                              first, second)
+    accels = accelFunc(numBodies, bodyMasses, posits)
+    vels  += 0.5*stepSize*(accels
+             - pair_accels(bodyMasses, posits, first, second))
+
+    if state is not None:
+        state['steps']     = state.get('steps', 0) + 1
+        state['pairSteps'] = state.get('pairSteps', 0) + len(first)
+        state['mostPairs'] = max(state.get('mostPairs', 0), len(first))
+    return posits, vels, accels
+
+# Every available integrator, and the force evaluations each costs per step,
+# or None where it varies from step to step
+schemes = {
+    'rk4'      : (runge_kutta, 4),
+    'leapfrog' : (kick_drift, 1),
+    'yoshida4' : (partial(kick_drift, weights=yoshida4Weights), 3),
+    'yoshida6' : (partial(kick_drift, weights=yoshida6Weights), 7),
+    'block'    : (block_step, None),
+    'wh'       : (wisdom_holman, 1),
+    'encounter': (encounter_step, 1),
+    }
@@ -0,0 +1,101 @@
+# Keplerian motion of many bodies around a single mass, advanced through a
+# given time with the universal variable formulation, which holds for
+# elliptic, parabolic and hyperbolic orbits alike.
+#
+# Reference for the universal variable and the f and g functions:
+# J. M. A. Danby, Fundamentals of Celestial Mechanics, 2nd ed. (1988), ch. 6
+# Reference for the Laguerre iteration of Kepler's equation:
+# B. A. Conway, Celest. Mech. 39, 199 (1986)
+
+from numpy import abs as npabs
+from numpy import cos, cosh, errstate, maximum, ones_like, sign, sin, sinh, \
+                  sqrt, where
+
+# Below this size of z the Stumpff functions are summed as series, which avoid
+# the cancellation of the closed forms near z = 0
+seriesLimit = 1.
+nSeries     = 11
+
+# Laguerre's method converges from almost any starting point, this many
+# iterations is never reached for bound orbits
+maxIterations = 50
+laguerreN     = 5
+
+def stumpff(z):
+    """Return the Stumpff functions c2(z) and c3(z) of a NumPy ndarray z."""
+    small = npabs(z) < seriesLimit
+    with errstate(invalid='ignore', divide='ignore', over='ignore'):
+        rootPos = sqrt(where(z > 0., z, 1.))
+        rootNeg = sqrt(where(z < 0., -z, 1.))
+        c2 = where(z > 0., (1. - cos(rootPos))/where(z > 0., z, 1.),
+                   (cosh(rootNeg) - 1.)/where(z < 0., -z, 1.))
+        c3 = where(z > 0., (rootPos - sin(rootPos))/rootPos**3,
+                   (sinh(rootNeg) - rootNeg)/rootNeg**3)
+
+    # c2 = sum (-z)^k/(2k+2)!, c3 = sum (-z)^k/(2k+3)!
+    term2, term3 = 0.5*ones_like(z), ones_like(z)/6.
+    sum2, sum3   = term2.copy(), term3.copy()
+    for k in range(1, nSeries):
+        term2 = -term2*z/((2*k + 1)*(2*k + 2))
+        term3 = -term3*z/((2*k + 2)*(2*k + 3))
+        sum2 += term2
+        sum3 += term3
+    return where(small, sum2, c2), where(small, sum3, c3)
+
+def kepler_drift(mu, posits, vels, stepSize):
+    """Advance bodies along their Keplerian orbits around a central mass.
+
+    Kepler's equation in the universal variable chi is solved for every body
+    at once by Laguerre's method, and the positions and velocities follow
+    from the f and g functions.
+
+    Arguments:
+    mu       -- the gravitational parameter G*M of the central mass, in units
+                of au^3 per day^2, or a NumPy ndarray of one for each body.
+    posits   -- a NumPy ndarray of the positions of the bodies relative to the
+                central mass, each element of which has two dimensions: [x, y].
+    vels     -- a NumPy ndarray of the velocities of the bodies relative to
+                the central mass.
+    stepSize -- the time to advance the bodies through, in days.
+
+    Returns:
+    nextPosits -- a NumPy ndarray of the positions of the bodies after
+                  stepSize days, relative to the central mass.
+    nextVels   -- a NumPy ndarray of the velocities of the bodies after
+                  stepSize days, relative to the central mass.
+    """
+
+    r0     = sqrt((posits**2).sum(axis=1))
+    vSq    = (vels**2).sum(axis=1)
+    rootMu = sqrt(mu)
+    # r0 dr/dt / sqrt(mu), and alpha, the reciprocal of the semi-major axis
+    sigma  = (posits*vels).sum(axis=1)/rootMu
+    alpha  = 2./r0 - vSq/mu
+    scaled = rootMu*stepSize
+
+    # Exact for circular orbits, and close for short steps of any orbit
+    chi = where(alpha > 0., scaled*alpha, scaled/r0)
+    for _ in range(maxIterations):
+        z = alpha*chi**2
+        c2, c3 = stumpff(z)
+        # Kepler's equation F(chi) = 0 and its first two derivatives
+        F   = sigma*chi**2*c2 + (1. - alpha*r0)*chi**3*c3 + r0*chi - scaled
+        dF  = sigma*chi*(1. - z*c3) + (1. - alpha*r0)*chi**2*c2 + r0
+        ddF = sigma*(1. - z*c2) + (1. - alpha*r0)*chi*(1. - z*c3)
+        n = laguerreN
+        root  = sqrt(npabs((n - 1)**2*dF**2 - n*(n - 1)*F*ddF))
+        delta = n*F/(dF + sign(dF)*root)
+        chi  -= delta
+        if (npabs(delta) <= 1e-15*maximum(npabs(chi), 1e-300)).all():
+            break
+
+    z = alpha*chi**2
+    c2, c3 = stumpff(z)
+    f = 1. - chi**2*c2/r0
+    g = stepSize - chi**3*c3/rootMu
+    nextPosits = f[:, None]*posits + g[:, None]*vels
+    r = sqrt((nextPosits**2).sum(axis=1))
+    fDot = rootMu*chi*(z*c3 - 1.)/(r*r0)
+    gDot = 1. - chi**2*c2/r
+    nextVels = fDot[:, None]*posits + gDot[:, None]*vels
+    return nextPosits, nextVels
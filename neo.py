@@ -4,11 +4,21 @@
 # Public Python Libraries
 from os import path
 import sys
-from numpy import array, absolute, amax, zeros, log, log10
+from numpy import arange, empty, flatnonzero, linspace
 import argparse
+from time import perf_counter
+from functools import partial
+from hashlib import sha1
 
 # orBits Libraries
 from readinput import input_reader
+from integrators import schemes
+from sinks import StepWriter, FrameCollector, Diagnostics, AsyncWriter
+from stepfile import BinaryStepWriter, CompressedStepWriter
+from checkpoint import save_checkpoint, load_checkpoint
+from testparticles import split_accels
+from collisions import Collisions
+from profiling import Profiler, Progress, write_metrics
 
 int8 = '8d'
 sci2 = '.2e'
@@ -30,8 +40,31 @@ parse.add_argument('-o', '--outfile', default=None, type=str, help=
                    "\nIf not given, output can be written to console.")
 parse.add_argument('-p', action='store_true', help=
                    "Perform computations in parallel (requires Numba).")
+parse.add_argument('-e', '--engine', default='direct', type=str,
+                   choices=['direct', 'barneshut', 'fmm', 'pm'], help=
+                   "Engine used to calculate the gravitational forces,"
+                   "\n'direct' sums over all pairs of bodies (default),"
+                   "\n'barneshut' uses a quadtree with opening angle 'theta',"
+                   "\n'fmm' uses the fast multipole method of given 'order',"
+                   "\n'pm' uses a particle-mesh of given 'grid' and 'padding'.")
+parse.add_argument('--resume', action='store_true', help=
+                   "Continue the simulation from its last checkpoint, the"
+                   "\n'.chk' file with the name of the input file. The duration"
+                   "\nor number of steps may be increased to extend it.")
+parse.add_argument('--progress', default=None, type=float, metavar='SECONDS',
+                   help=
+                   "Report the step reached, steps per second, time left and"
+                   "\nmemory used every given number of seconds.")
+parse.add_argument('--profile', action='store_true', help=
+                   "Time each phase of the run, reading the input, compiling,"
+                   "\nforces, integration, output and rendering.")
+parse.add_argument('--metrics', default=None, type=str, help=
+                   "Write the times of the phases and the rate of the run to"
+                   "\nthis JSON file, implies '--profile'.")
 
 args = parse.parse_args()
+# The phases are only timed when asked for, otherwise nothing is wrapped
+profiler = Profiler(args.profile or args.metrics is not None)
 
 # Ask user for input file, check it is valid type and exists, then open.
 inName = args.infile
@@ -45,7 +78,6 @@ while (len(checkIn) < 2) or (checkIn[1] != "inp"):
 if not path.exists(inName):
     sys.exit("Could not find the input file, is it in the working directory?")
 inFile = open(inName, 'r')
-stepFile = open("{0}.steps".format(checkIn[0]), 'w+')
 
 
 # Ask user for output file. If no file is given, we can output to the console
@@ -72,7 +104,7 @@ while not termOut:
             continue
         elif not path.exists(outName):
             print("Could not find the output file... Created automatically.", file=sys.stdout)
-        outFile = open(outName, 'w+')
+        outFile = open(outName, 'a' if args.resume else 'w+')
         break
 
 print("\n"
@@ -101,72 +133,455 @@ print("\n------------"
       "\nBegin output"
       "\n------------", file=outFile)
 
-if args.p:
+if args.engine != 'direct' and args.p:
+    print("Warning: Argument '-p' has no effect on the '{0}' engine."
+          .format(args.engine), file=outFile)
+if args.engine == 'barneshut':
+    from barneshut import calc_accels
+    print("Using Barnes-Hut quadtree forces.", file=outFile)
+elif args.engine == 'fmm':
+    from fmm import calc_accels
+    print("Using fast multipole method forces.", file=outFile)
+elif args.engine == 'pm':
+    from pm import calc_accels
+    print("Using particle-mesh forces.", file=outFile)
+elif args.p:
     try:
         from numba import njit, prange
-        from rkpar import make_step
-        print("Argument '-p' given, using numba parallelised Runge-Kutta.", file=outFile)
+        from rkpar import calc_accels, compile_kernels, make_steps, \
+                          choose_block
+        print("Argument '-p' given, using numba parallelised direct forces.", file=outFile)
     except:
         print("Error: Argument '-p' given, but cannot find numba.", file=outFile)
         sys.exit()
+    # Compiling is timed apart from the simulation, it is much faster when the
+    # kernels are loaded from the cache of an earlier run
+    compileTime = compile_kernels()
+    profiler.add('compile', compileTime)
+    print("Numba kernels compiled or loaded from cache in {0:.2f} s."
+          .format(compileTime), file=outFile)
 else:
-    from rknopar import make_step
-    print("Argument '-p' not given, will no compute in parallel.", file=outFile)
+    from rkvec import calc_accels
+    print("Argument '-p' not given, using vectorised NumPy direct forces.", file=outFile)
     
 # Read the input file and create the bodies
-bods, timeStep, nSteps, doVis, figSize, visTime, FPS, visName \
-    = input_reader(inFile, outFile)
+bods, timeStep, nSteps, doVis, figSize, visTime, FPS, visName, visOpts, \
+    simOpts, outOpts = profiler.timed('parse', input_reader)(inFile, outFile)
+
+# Options from the input file for the chosen engine
+if args.engine == 'barneshut':
+    calc_accels = partial(calc_accels, theta=simOpts['theta'])
+    print("Barnes-Hut opening angle theta = {0}.".format(simOpts['theta']),
+          file=outFile)
+elif args.engine == 'fmm':
+    calc_accels = partial(calc_accels, order=simOpts['order'])
+    print("Fast multipole expansion order = {0}.".format(simOpts['order']),
+          file=outFile)
+elif args.engine == 'pm':
+    calc_accels = partial(calc_accels, grid=simOpts['grid'],
+                          padding=simOpts['padding'])
+    print("Particle-mesh of {0} x {0} cells, padded by a factor of {1}."
+          .format(simOpts['grid'], simOpts['padding']), file=outFile)
+
+isAdaptive = simOpts['tolerance'] is not None
+if isAdaptive:
+    from integrators import adaptive_step, initial_step
+    adaptive_step = profiler.timed('integration', adaptive_step)
+    print("Integrating with adaptive 'dopri5' to a tolerance of {0:{1}}, 6 "
+          "force evaluations per trial step.".format(simOpts['tolerance'], sci2),
+          file=outFile)
+elif simOpts['integrator'] == 'block':
+    make_step, _ = schemes['block']
+    blockState = {}
+    make_step = partial(make_step, levels=simOpts['levels'],
+                        eta=simOpts['eta'], state=blockState)
+    print("Integrating with 'block' time steps of dt/2^n for n from 0 to {0}, "
+          "eta = {1}.".format(simOpts['levels'] - 1, simOpts['eta']),
+          file=outFile)
+elif simOpts['integrator'] == 'encounter':
+    make_step, _ = schemes['encounter']
+    encounterState = {}
+    make_step = partial(make_step, factor=simOpts['encounter'],
+                        state=encounterState)
+    print("Integrating with 'encounter' leapfrog steps, pairs with a free-fall "
+          "time under {0} dt orbit each other exactly."
+          .format(simOpts['encounter']), file=outFile)
+else:
+    make_step, nForces = schemes[simOpts['integrator']]
+    print("Integrating with '{0}', {1} force evaluation(s) per step."
+          .format(simOpts['integrator'], nForces), file=outFile)
+# Runge-Kutta steps of numba parallelised direct forces run many steps in each
+# call of a compiled kernel
+isFused = args.p and args.engine == 'direct' and not isAdaptive \
+          and simOpts['integrator'] == 'rk4' and not simOpts['collisions']
+if isFused:
+    # The forces are found within the kernel, and are timed with the steps
+    make_steps = profiler.timed('integration', make_steps)
+elif not isAdaptive:
+    make_step = profiler.timed('integration', make_step)
 
 print("\nPreparing the simulation for the following bodies:", file=outFile)
-for bod in bods:
+for i in bods.listed.nonzero()[0]:
         print(  " - {1} with..."
               "\n   Mass = {2:{0}} Earth Masses"
               "\n   Initial Position (x, y) = ({3:{0}}, {4:{0}}) A.U."
               "\n   Initial Velocity (x, y) = ({5:{0}}, {6:{0}}) A.U. per day\n"
-              .format(sci2, bod.name, bod.mass, *bod.pos, *bod.vel), file=outFile)
+              .format(sci2, bods.names[i], bods.masses[i], *bods.posits[i],
+                      *bods.vels[i]), file=outFile)
+for name, n in bods.groups:
+    print(" - {0}, {1} particles\n".format(name, n), file=outFile)
 
 # Initialise bodies
 print("Setting initial conditions.", file=outFile)
-nBods = len(bods)
-posSteps = zeros((nSteps+1, nBods, 2))
-velSteps = zeros((nSteps+1, nBods, 2))
-posSteps[0] = array([bod.pos for bod in bods])
-velSteps[0] = array([bod.vel for bod in bods])
-masses      = array([bod.mass for bod in bods])
-
-print(*[bod.name for bod in bods], file=stepFile)
+nBods  = len(bods)
+posits = bods.posits.copy()
+vels   = bods.vels.copy()
+masses = bods.masses.copy()
+
+# Test particles follow the massive bodies, the engine is given only the
+# massive bodies and the particles have a kernel of their own
+if args.p and args.engine == 'direct':
+    from rkpar import test_accels
+else:
+    from testparticles import test_accels
+engine_accels = calc_accels
+
+def split_engine():
+    """Return the number of massive bodies and the function for the
+    accelerations of the bodies, for the current masses."""
+    nMassive = int((masses != 0.).sum())
+    if nMassive < len(masses):
+        return nMassive, profiler.timed('force', split_accels(
+            engine_accels, nMassive, test_accels))
+    return nMassive, profiler.timed('force', engine_accels)
+
+nMassive, calc_accels = split_engine()
+if nMassive < nBods:
+    print("{0} test particles feel the gravity of the {1} massive bodies only."
+          .format(nBods - nMassive, nMassive), file=outFile)
+
+# Overlapping bodies are merged or bounced, merged bodies are removed from the
+# arrays of the simulation
+collider = None
+if simOpts['collisions']:
+    collider = Collisions(simOpts['collisions'],
+                          bods.radii, masses,
+                          simOpts['restitution'])
+    print("Collisions of bodies are resolved by '{0}', restitution {1}."
+          .format(simOpts['collisions'], simOpts['restitution']),
+          file=outFile)
+
+# Parameters that must be unchanged for a simulation to resume exactly
+chkName = "{0}.chk".format(checkIn[0])
+# The bodies are compared by a digest of their names and masses, which stays
+# short for any number of bodies
+bodyDigest = sha1("\n".join(bods.names).encode())
+bodyDigest.update(masses.tobytes())
+meta = {'bodies': bodyDigest.hexdigest(), 'nBodies': nBods,
+        'engine': args.engine, 'parallel': args.p,
+        'dt': None if isAdaptive else timeStep,
+        'format': outOpts['format'], 'poserror': outOpts['poserror'],
+        'velerror': outOpts['velerror'], 'codec': outOpts['codec'],
+        **{key: simOpts[key] for key in ['integrator', 'tolerance', 'theta',
+                                         'order', 'grid', 'padding', 'eta',
+                                         'levels', 'encounter', 'collisions',
+                                         'radius', 'restitution']}}
+if args.resume:
+    if not path.exists(chkName):
+        print("Error: Argument '--resume' given, but there is no checkpoint "
+              "'{0}'.".format(chkName), file=outFile)
+        sys.exit()
+    chkMeta, chk = load_checkpoint(chkName)
+    changed = [key for key in meta if chkMeta.get(key) != meta[key]]
+    if changed:
+        print("Error: Cannot resume from '{0}', the simulation has changed: "
+              "{1}.".format(chkName, ", ".join(changed)), file=outFile)
+        sys.exit()
+
+# Each step is passed on to the sinks rather than kept, when resuming the step
+# file is opened to be cut back to the checkpoint
+if outOpts['format'] == 'compressed':
+    stepName = "{0}.csteps".format(checkIn[0])
+    sinks = [CompressedStepWriter(open(stepName, 'r+b' if args.resume else 'wb'),
+                                  bods.names,
+                                  None if isAdaptive else timeStep,
+                                  outOpts['poserror'], outOpts['velerror'],
+                                  outOpts['codec'], outOpts['chunk'])]
+    print("Compressing steps with '{1}', positions to within {2:{0}} au and "
+          "velocities to within {3:{0}} au per day."
+          .format(sci2, outOpts['codec'], outOpts['poserror'],
+                  outOpts['velerror']), file=outFile)
+elif outOpts['format'] == 'binary':
+    stepName = "{0}.bsteps".format(checkIn[0])
+    sinks = [BinaryStepWriter(open(stepName, 'r+b' if args.resume else 'wb'),
+                              bods.names,
+                              None if isAdaptive else timeStep)]
+else:
+    stepName = "{0}.steps".format(checkIn[0])
+    sinks = [StepWriter(open(stepName, 'r+' if args.resume else 'w+'),
+                        bods.names)]
+print("Writing the steps to '{0}'.".format(stepName), file=outFile)
+# The step file is written on a thread of its own, fed with blocks of steps
+if outOpts['writer'] == 'thread':
+    sinks[0] = AsyncWriter(sinks[0], nBods, outFile, *outOpts['buffer'])
+if doVis:
+    # Frames are evenly spaced in time, so with the adaptive integrator each
+    # frame takes the first step at or after its time
+    if isAdaptive:
+        if FPS == 'all':
+            frameTimes = None
+        else:
+            frameTimes = linspace(0., simOpts['duration'], round(FPS*visTime))
+    else:
+        if FPS == 'all':
+            frameStep = 1
+        else:
+            frameStep = max(round(nSteps/(FPS*visTime)), 1)
+        frameTimes = (arange(int(nSteps/frameStep))*frameStep)*timeStep
+    # A live view draws the frames while the simulation runs, into a window,
+    # or into the animation file in place of rendering it afterwards
+    if visOpts['live']:
+        from render import LiveView, has_encoder
+        if visOpts['live'] == 'mp4' and not has_encoder():
+            print("Warning: ffmpeg was not found, the live view writes the "
+                  "frames as PNG files instead.", file=outFile)
+            visOpts['live'] = 'png'
+        if FPS != 'all':
+            liveFPS = FPS
+        else:
+            liveFPS = 25 if isAdaptive else nSteps/visTime
+        sinks.append(LiveView(visOpts['live'], frameTimes, figSize/6*bods.ms,
+                              bods.colours, posits, figSize, liveFPS, visName,
+                              outFile, visOpts['bodies'], visOpts['queue'],
+                              visOpts['budget']))
+        print("Showing the frames live in '{0}' mode, through a queue of {1} "
+              "frames with a budget of {2} s for each."
+              .format(visOpts['live'], visOpts['queue'], visOpts['budget']),
+              file=outFile)
+    if visOpts['live'] in [None, 'window']:
+        frames = FrameCollector(frameTimes)
+        sinks.append(frames)
+    else:
+        doVis = False
+if simOpts['diagnostics']:
+    sinks.append(Diagnostics(masses if collider is None else collider.outMasses,
+                             simOpts['diagnostics'], outFile))
+if args.progress:
+    sinks.append(Progress(args.progress, outFile,
+                          None if isAdaptive else nSteps,
+                          simOpts['duration'] if isAdaptive else None))
+
+def sink_name(sink):
+    """Return the name of a sink in checkpoints, the name of the writer for
+    a writer on a thread."""
+    return type(getattr(sink, 'sink', sink)).__name__
+
+def push(step, time, posits, vels):
+    """Pass the state after a step to every sink, with every body of the
+    input file."""
+    if collider is not None:
+        posits, vels = posits[collider.owner], vels[collider.owner]
+    for sink in sinks:
+        sink.write(step, time, posits, vels)
+
+def save_state():
+    """Write a checkpoint of the simulation after the current step."""
+    state = {'step': step, 'time': time, 'posits': posits, 'vels': vels,
+             'accels': accels,
+             'sinks': {sink_name(sink): sink.checkpoint() for sink in sinks}}
+    if isAdaptive:
+        state['adaptive'] = {'timeStep': timeStep, 'nRejected': nRejected,
+                             'shortest': shortest, 'longest': longest}
+    elif simOpts['integrator'] == 'block':
+        state['block'] = blockState
+    elif simOpts['integrator'] == 'encounter':
+        state['encounter'] = encounterState
+    if collider is not None:
+        state['collisions'] = {'masses': masses, **collider.checkpoint()}
+    save_checkpoint(chkName, meta, state)
+
+def collide(previous=None):
+    """Resolve the collisions during a step from the positions previous, and
+    when bodies are merged or moved find the accelerations of the bodies that
+    are left."""
+    global masses, posits, vels, accels, nBods, nMassive, calc_accels
+    masses, posits, vels, changed = collider.apply(masses, posits, vels,
+                                                   previous)
+    if changed:
+        nBods = len(masses)
+        nMassive, calc_accels = split_engine()
+        accels = calc_accels(nBods, masses, posits)
+
+push       = profiler.timed('output', push)
+save_state = profiler.timed('checkpoint', save_state)
+collide    = profiler.timed('collisions', collide)
+
+checkEvery = outOpts['checkpoint']
+if args.resume:
+    step, time = chk['step'], chk['time']
+    posits, vels, accels = chk['posits'], chk['vels'], chk['accels']
+    for sink in sinks:
+        if sink_name(sink) in chk['sinks']:
+            sink.restore(chk['sinks'][sink_name(sink)])
+    if isAdaptive:
+        timeStep, nRejected = chk['adaptive']['timeStep'], chk['adaptive']['nRejected']
+        shortest, longest = chk['adaptive']['shortest'], chk['adaptive']['longest']
+    elif simOpts['integrator'] == 'block':
+        blockState.update(chk['block'])
+    elif simOpts['integrator'] == 'encounter':
+        encounterState.update(chk.get('encounter', {}))
+    if collider is not None:
+        masses = chk['collisions'].pop('masses')
+        collider.restore(chk['collisions'])
+        nBods = len(masses)
+        nMassive, calc_accels = split_engine()
+    print("Resuming from the checkpoint at step {1} and {2:{0}} days."
+          .format(sci2, step, time), file=outFile)
+    if (isAdaptive and time > simOpts['duration']) \
+    or (not isAdaptive and step > nSteps):
+        print("Error: The checkpoint is beyond the end of the simulation."
+              "\n  Check your input file!", file=outFile)
+        sys.exit()
+else:
+    step, time = 0, 0.
+    if collider is not None:
+        collide()
+    accels = calc_accels(nBods, masses, posits)
+    push(0, 0., posits, vels)
+    if isAdaptive:
+        if timeStep is None:
+            timeStep = initial_step(nBods, masses, posits, vels, accels,
+                                    simOpts['tolerance'])
+        nRejected = 0
+        shortest, longest = float('inf'), 0.
+
 print("Beginning forward time steps...", file=outFile)
-for step in range(1, nSteps+1):
-    posSteps[step], velSteps[step] = make_step(timeStep, nBods, masses, 
-                                               posSteps[step-1], 
-                                               velSteps[step-1])
-    for i, bodPos in enumerate(posSteps[step]):
-        bodVel = velSteps[step][i]
-        bodStr = "{2:{0}}{1}{3:{0}}{1}{4:{0}}{1}{5:{0}}".format(sci8, ws2, *bodPos, *bodVel)
-        print(bodStr, end=ws6, file=stepFile)
-    print('', file=stepFile)
-
-stepFile.close()    
+runClock = perf_counter()
+firstStep = step
+if isAdaptive:
+    duration = simOpts['duration']
+    # Stop within rounding error of the duration, the last step is shortened
+    # to finish on it exactly
+    while duration - time > 1e-12*duration:
+        before = posits
+        try:
+            posits, vels, accels, stepTaken, timeStep, rejected \
+                = adaptive_step(min(timeStep, duration - time), nBods, masses,
+                                posits, vels, accels, calc_accels,
+                                simOpts['tolerance'])
+        except FloatingPointError as error:
+            # The steps so far are kept in the step file
+            for sink in sinks:
+                sink.close()
+            print("Error: The adaptive integration failed after step {1} at "
+                  "{2:{0}} days, {3}."
+                  "\n  Check your input file!".format(sci2, step, time, error),
+                  file=outFile)
+            sys.exit()
+        time += stepTaken
+        step += 1
+        nRejected += rejected
+        shortest = min(shortest, stepTaken)
+        longest  = max(longest, stepTaken)
+        if collider is not None:
+            collide(before)
+        push(step, time, posits, vels)
+        if checkEvery and step % checkEvery == 0:
+            save_state()
+    nSteps = step
+    print("Adaptive integration took {0} steps with {1} rejected, of sizes "
+          "from {3:{2}} to {4:{2}} days."
+          .format(nSteps, nRejected, sci2, shortest, longest), file=outFile)
+elif isFused:
+    blockSteps  = choose_block(nBods, nSteps, nMassive)
+    stepBuffer  = empty((blockSteps, nBods, 4))
+    print("Running up to {0} steps in each call of the numba kernel."
+          .format(blockSteps), file=outFile)
+    while step < nSteps:
+        # Blocks end on every checkpoint
+        nBlock = min(blockSteps, nSteps - step)
+        if checkEvery:
+            nBlock = min(nBlock, checkEvery - step % checkEvery)
+        posits, vels = make_steps(timeStep, nBlock, nBods, masses, posits,
+                                  vels, stepBuffer, numMassive=nMassive)
+        for row in stepBuffer[:nBlock]:
+            step += 1
+            time  = step*timeStep
+            push(step, time, row[:, :2], row[:, 2:])
+        accels = calc_accels(nBods, masses, posits)
+        if checkEvery and step % checkEvery == 0:
+            save_state()
+else:
+    while step < nSteps:
+        step += 1
+        time  = step*timeStep
+        before = posits
+        posits, vels, accels = make_step(timeStep, nBods, masses, posits, vels,
+                                         accels, calc_accels)
+        if collider is not None:
+            collide(before)
+        push(step, time, posits, vels)
+        if checkEvery and step % checkEvery == 0:
+            save_state()
+    if simOpts['integrator'] == 'block':
+        print("Block time steps, with the number of bodies on each level at the "
+              "end, on average, and the kicks given:"
+              "\n  Level  Step (days)  Bodies at end  Mean bodies  Kicks",
+              file=outFile)
+        for n in range(simOpts['levels']):
+            print("  {1:5d}  {2:11{0}}  {3:13d}  {4:11.2f}  {5:d}"
+                  .format(sci2, n, timeStep/2**n, blockState['level'].tolist().count(n),
+                          blockState['occupancy'][n]/nSteps,
+                          blockState['kicks'][n]), file=outFile)
+        # A shared step must be as short as the shortest step in use
+        shortest = max(flatnonzero(blockState['occupancy']))
+        print("  {0} force evaluations of single bodies, {1:.1f}% of those for "
+              "a shared step of dt/2^{2}."
+              .format(blockState['kicks'].sum(),
+                      100*blockState['kicks'].sum()/(nBods*nSteps*2**shortest),
+                      shortest), file=outFile)
+    elif simOpts['integrator'] == 'encounter':
+        print("Close pairs were moved along their orbits for {0} steps of pairs, "
+              "with at most {1} pairs at once."
+              .format(encounterState.get('pairSteps', 0),
+                      encounterState.get('mostPairs', 0)), file=outFile)
+
+
+if collider is not None:
+    print("Collisions: {0} bodies merged, {1} bounces, {2} bodies left, {3} "
+          "of the collisions between pairs that had passed through each "
+          "other within a step."
+          .format(collider.nMerged, collider.nBounced, nBods, collider.nSwept),
+          file=outFile)
+runTime = perf_counter() - runClock
+print("Forward time steps took {0:.2f} s, {1:.1f} steps per second."
+      .format(runTime, (step - firstStep)/runTime if runTime else 0.),
+      file=outFile)
+
+# A final checkpoint lets the simulation be extended later
+if checkEvery and step % checkEvery != 0:
+    save_state()
+# Closing waits for the steps still to be written
+closeClock = perf_counter()
+for sink in sinks:
+    sink.close()
+profiler.add('output', perf_counter() - closeClock, 0)
 print("Simulation complete, step file closed.", file=outFile)
 
 if doVis:
-    import matplotlib.animation as ani
-    import matplotlib.pyplot as plt
+    from render import has_encoder, render_animation
 
     print("\nSetting animation parameters.", file=outFile)
+    nFrames = len(frames.frames)
     if FPS == 'all':
-        frameStep = 1
-        FPS = nSteps/visTime
-    else:
-        frameStep = round(nSteps/(FPS*visTime))
-        if (frameStep == 0):
-            frameStep = 1
-            
-    nFrames = int(nSteps/frameStep)    
+        FPS = nFrames/visTime
     scale  = figSize/6
     marg   = 1.1
-    s      = marg*amax(absolute(posSteps))
-    window = [[-s, s], [-s, s]]
+    s      = marg*frames.extent
+    if visOpts['format'] == 'mp4' and not has_encoder():
+        print("Warning: ffmpeg was not found, writing the frames as PNG "
+              "files instead.", file=outFile)
+        visOpts['format'] = 'png'
     
     print("Beginning animation, with:"
           "\n  Figure size = {0} x {0} inches"
@@ -177,31 +592,30 @@ if doVis:
           "\n  {5} frames"
           "\nThis might take a while...".format(figSize, s, FPS, 1e3/FPS, visTime, nFrames), file=outFile)
     
-    fig  = plt.figure(figsize=(figSize,figSize))
-    ax   = plt.axes(xlim=window[0], ylim=window[1])
-    dot, = ax.plot([], [], '.')
-    
-    dots = []
-    for i in range(nBods):
-        dObj = ax.plot([], [], marker='o', markersize=scale*bods[i].ms, color=bods[i].c, ls='none')[0]
-        dots.append(dObj)
-        
-    def ani_init():
-        for dot in dots:
-            dot.set_data([], [])
-        return dots
-    
-    def animate(i, frameStep):
-        xPosits = posSteps[i*frameStep,:,0]
-        yPosits = posSteps[i*frameStep,:,1]
-        for dNum, dot in enumerate(dots):
-            dot.set_data(xPosits[dNum], yPosits[dNum])
-        return dots
-    
-    anim = ani.FuncAnimation(fig, animate, init_func=ani_init, fargs=(frameStep,),
-                            frames=nFrames, interval=1e3/FPS, blit=True)
-    anim.save("{0}.mp4".format(visName))
+    renderStart = perf_counter()
+    visFile, nWorkers = render_animation(frames.frames, scale*bods.ms,
+                                         bods.colours, s, figSize, FPS,
+                                         visName, visOpts['format'],
+                                         visOpts['workers'], visOpts['bodies'])
+    renderTime = perf_counter() - renderStart
+    profiler.add('render', renderTime)
+    print("Rendered {0} frames to '{1}' with {2} processes in {3:.2f} s."
+          .format(nFrames, visFile, nWorkers, renderTime), file=outFile)
     
     print("Animation complete.", file=outFile)
 
+if profiler.enabled:
+    profiler.report(outFile)
+    if isFused:
+        print("The forces found within the numba kernel are timed as "
+              "integration.", file=outFile)
+if args.metrics:
+    write_metrics(args.metrics, profiler.metrics(
+        input=inName, engine=args.engine, parallel=args.p,
+        integrator='dopri5' if isAdaptive else simOpts['integrator'],
+        nBodies=len(bods), steps=step - firstStep, runSeconds=runTime,
+        stepsPerSecond=(step - firstStep)/runTime if runTime else None,
+        writerThreadSeconds=getattr(sinks[0], 'busy', None)))
+    print("Metrics written to '{0}'.".format(args.metrics), file=outFile)
+
 print("Done!", file=sys.stdout)
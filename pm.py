@@ -0,0 +1,124 @@
+# Reference for the particle-mesh method:
+# R. W. Hockney & J. W. Eastwood, Computer Simulation Using Particles (1988)
+#
+# The bodies move in a plane but attract with the three dimensional 1/r^2
+# force, so rather than solving the two dimensional Poisson equation (whose
+# force falls as 1/r) the mass on the mesh is convolved directly with the
+# force kernel of a point mass using FFTs. The mesh is zero padded so that
+# distant bodies do not see periodic images of one another.
+
+from functools import partial
+
+from numpy import amax, arange, bincount, floor, int64, sqrt, zeros
+from numpy.fft import rfft2, irfft2
+
+from rknopar import convG
+from integrators import rk4_step
+
+# FFTs of the force kernels for unit cell size, reused while the mesh is
+# unchanged since the kernel for cells of side h is simply scaled by 1/h^2.
+kernelCache = {}
+
+def force_kernels(grid, padding):
+    """Return the FFTs of the x and y force kernels on the padded mesh.
+
+    The kernel is the acceleration -d/|d|^3 of a unit mass at the origin, at
+    each cell offset d on a mesh of unit cells, with no force at d = 0.
+    """
+    if (grid, padding) not in kernelCache:
+        size = grid*padding
+        offset = arange(size, dtype=float)
+        offset[offset > size//2] -= size
+        dX = offset[:, None]
+        dY = offset[None, :]
+        rSumSq = dX*dX + dY*dY
+        rSumSq[0, 0] = 1.
+        invR3 = 1/(rSumSq*sqrt(rSumSq))
+        invR3[0, 0] = 0.
+        kernelCache[grid, padding] = (rfft2(-dX*invR3), rfft2(-dY*invR3))
+    return kernelCache[grid, padding]
+
+def cic_weights(posits, corner, cellSize, grid):
+    """Return the four cells overlapped by each body and the cloud-in-cell
+    weight of each, with the cells given as flat indices into the mesh."""
+    cells = (posits - corner)/cellSize - 0.5
+    lower = floor(cells).astype(int64)
+    frac  = cells - lower
+    flat, weights = [], []
+    for sX, wX in ((0, 1 - frac[:, 0]), (1, frac[:, 0])):
+        for sY, wY in ((0, 1 - frac[:, 1]), (1, frac[:, 1])):
+            flat.append((lower[:, 0] + sX)*grid + lower[:, 1] + sY)
+            weights.append(wX*wY)
+    return flat, weights
+
+def calc_accels(numBodies, bodyMasses, posits, grid=128, padding=2,
+                targets=None):
+    """Calculate the gravitational acceleration of every body on a mesh.
+
+    The masses are deposited onto a square mesh covering all of the bodies
+    using the cloud-in-cell scheme, the accelerations on the mesh are found by
+    convolution with the force kernel using FFTs, and the accelerations are
+    interpolated back to the bodies with the same cloud-in-cell weights, so
+    that no body feels a force from itself. Forces between bodies less than a
+    few cells apart are not resolved.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+    grid       -- the number of cells along each side of the mesh.
+    padding    -- the factor by which the mesh is zero padded for the FFTs. A
+                  factor of 2 isolates the mesh exactly, while 1 halves the
+                  size of the FFTs but lets the bodies feel images of the
+                  mass on the far side of the mesh.
+    targets    -- an optional NumPy ndarray of the indices of the bodies whose
+                  accelerations are wanted, by default every body. The whole
+                  mesh is solved regardless.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, or of the
+              targets in the order given, each element of which has in turn
+              two dimensions: [x, y].
+    """
+
+    # The mesh leaves a cell spare around the bodies for the cloud-in-cell
+    lower  = posits.min(axis=0)
+    extent = amax(posits.max(axis=0) - lower)
+    cellSize = extent/(grid - 3) if extent > 0. else 1.
+    corner = lower - 1.5*cellSize
+
+    size = grid*padding
+    flat, weights = cic_weights(posits, corner, cellSize, grid)
+    density = zeros(grid*grid)
+    for cells, weight in zip(flat, weights):
+        density += bincount(cells, weight*bodyMasses, minlength=grid*grid)
+    padded = zeros((size, size))
+    padded[:grid, :grid] = density.reshape(grid, grid)
+
+    kernelX, kernelY = force_kernels(grid, padding)
+    densityFFT = rfft2(padded)
+    scale  = convG/cellSize**2
+    meshX  = (irfft2(densityFFT*kernelX, s=(size, size))[:grid, :grid]
+              * scale).ravel()
+    meshY  = (irfft2(densityFFT*kernelY, s=(size, size))[:grid, :grid]
+              * scale).ravel()
+
+    accels = zeros((numBodies, 2))
+    for cells, weight in zip(flat, weights):
+        accels[:, 0] += weight*meshX[cells]
+        accels[:, 1] += weight*meshY[cells]
+    return accels if targets is None else accels[targets]
+
+def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+              grid=128, padding=2):
+    """Perform a forward step using the fourth-order Runge-Kutta method, with
+    the forces at each stage from the particle-mesh method.
+
+    Arguments and returns are as for rkvec.make_step, with the addition of:
+    grid    -- the number of cells along each side of the mesh.
+    padding -- the zero padding factor of the mesh, see calc_accels.
+    """
+    return rk4_step(stepSize, numBodies, bodyMasses, currentPosits,
+                    currentVels, partial(calc_accels, grid=grid,
+                                         padding=padding))
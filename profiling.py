@@ -0,0 +1,191 @@
+# Timing of the phases of a simulation and reports of its progress, for seeing
+# where the time of a run goes and how long it has left.
+#
+# The phases are timed by wrapping the functions of each phase, and a function
+# called from within another phase counts towards its own phase only, so the
+# phases add up to the time of the run. When profiling is not asked for the
+# functions are returned unwrapped and cost nothing.
+
+import json
+from os import sysconf
+import sys
+from time import perf_counter
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+# The phases in the order they are reported, with their descriptions
+phaseNames = {'parse': "Reading the input file",
+              'compile': "Compiling numba kernels",
+              'force': "Force evaluation",
+              'integration': "Integration",
+              'collisions': "Collisions",
+              'output': "Output of the steps",
+              'checkpoint': "Checkpoints",
+              'render': "Rendering the animation"}
+
+def memory_use():
+    """Return the memory used by the process now and at its peak, in MB, or
+    None for either where it cannot be found."""
+    current, peak = None, None
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1])*sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        pass
+    if getrusage is not None:
+        # The peak is in bytes on macOS, and in kB elsewhere
+        peak = getrusage(RUSAGE_SELF).ru_maxrss
+        peak /= 2**20 if sys.platform == 'darwin' else 2**10
+        # The two are measured differently, the peak is never shown as less
+        if current is not None:
+            peak = max(peak, current)
+    return current, peak
+
+def format_memory(current, peak):
+    """Return the memory used now and at its peak, as far as known."""
+    if current is None and peak is None:
+        return "unknown"
+    if peak is None:
+        return "{0:.0f} MB".format(current)
+    if current is None:
+        return "peak {0:.0f} MB".format(peak)
+    return "{0:.0f} MB, peak {1:.0f} MB".format(current, peak)
+
+def format_seconds(seconds):
+    """Return a duration as hours, minutes and seconds."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes   = divmod(minutes, 60)
+    if hours:
+        return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{0}m{1:02d}s".format(minutes, seconds)
+    return "{0}s".format(seconds)
+
+class Profiler:
+    """The wall time spent in each phase of a simulation.
+
+    Functions wrapped by timed() add the time of each call to their phase,
+    less the time of wrapped functions they call, which add it to their own.
+    If the profiler is not enabled the functions are returned as they are.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases  = {name: [0., 0] for name in phaseNames}
+        self.inner   = 0.
+        self.start   = perf_counter()
+
+    def timed(self, name, func):
+        """Return func, timed as part of the phase name if enabled."""
+        if not self.enabled:
+            return func
+        phase = self.phases.setdefault(name, [0., 0])
+
+        def timed_func(*args, **kwargs):
+            outer, self.inner = self.inner, 0.
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                phase[0] += elapsed - self.inner
+                phase[1] += 1
+                self.inner = outer + elapsed
+        return timed_func
+
+    def add(self, name, seconds, calls=1):
+        """Add time measured elsewhere to the phase name."""
+        if self.enabled:
+            phase = self.phases.setdefault(name, [0., 0])
+            phase[0] += seconds
+            phase[1] += calls
+
+    def report(self, outFile):
+        """Write the time of each phase, and of the run in all."""
+        total = perf_counter() - self.start
+        print("\nTime spent in each phase of the run:"
+              "\n  Phase                      Time (s)  Share   Calls",
+              file=outFile)
+        for name, (seconds, calls) in self.phases.items():
+            if calls:
+                print("  {0:<25}{1:10.3f}{2:6.1f}%{3:8d}"
+                      .format(phaseNames.get(name, name), seconds,
+                              100*seconds/total, calls), file=outFile)
+        other = total - sum(seconds for seconds, _ in self.phases.values())
+        print("  {0:<25}{1:10.3f}{2:6.1f}%"
+              "\n  {3:<25}{4:10.3f}"
+              .format("Other", other, 100*other/total, "Total", total),
+              file=outFile)
+
+    def metrics(self, **extra):
+        """Return the times of the phases and of the run, the memory used and
+        any extra values, as a dictionary for a metrics file."""
+        current, peak = memory_use()
+        return {'wall': perf_counter() - self.start,
+                'phases': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in self.phases.items()
+                           if calls},
+                'memoryMB': current, 'peakMemoryMB': peak, **extra}
+
+def write_metrics(fileName, metrics):
+    """Write the metrics of a run to a JSON file."""
+    with open(fileName, 'w') as metricsFile:
+        json.dump(metrics, metricsFile, indent=1)
+
+class Progress:
+    """Report the progress of the simulation, as a sink of the steps.
+
+    Every 'interval' seconds of wall time the step reached is written to
+    outFile, with the fraction of the run done, the steps per second since
+    the first step seen, the estimated time left and the memory used. The run
+    ends after nSteps steps, or for the adaptive integrator at the time
+    duration.
+    """
+    def __init__(self, interval, outFile, nSteps=None, duration=None):
+        self.interval = interval
+        self.outFile  = outFile
+        self.nSteps   = nSteps
+        self.duration = duration
+        self.first    = None
+
+    def write(self, step, time, posits, vels):
+        now = perf_counter()
+        if self.first is None:
+            # A resumed run is measured from where it resumed
+            self.first = (step, time, now)
+            self.next  = now + self.interval
+            return
+        if now < self.next:
+            return
+        self.next = now + self.interval
+        firstStep, firstTime, start = self.first
+        elapsed = now - start
+        rate = (step - firstStep)/elapsed
+        # The time left is estimated from the rate since the first step seen
+        if self.duration is None:
+            done = step/self.nSteps
+            left = (self.nSteps - step)/rate if rate else None
+            reached = "Step {0} of {1}".format(step, self.nSteps)
+        else:
+            done = time/self.duration
+            left = elapsed*(self.duration - time)/(time - firstTime) \
+                   if time > firstTime else None
+            reached = "Step {0} at {1:.4g} of {2:.4g} days".format(
+                      step, time, self.duration)
+        left = "ETA unknown" if left is None \
+               else "ETA {0}".format(format_seconds(left))
+        print("  {0}, {1:.1f}% done, {2:.1f} steps/s, {3}, memory {4}."
+              .format(reached, 100*min(done, 1.), rate, left,
+                      format_memory(*memory_use())),
+              file=self.outFile, flush=True)
+
+    def checkpoint(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+    def close(self):
+        pass
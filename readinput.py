@@ -1,7 +1,14 @@
 import sys
-from numpy import pi, array, cos, sin, log10
+from os import path
+from numpy import pi, array, argsort, asarray, atleast_2d, cbrt, concatenate, \
+                  cos, empty, full, int64, load, loadtxt, log10, sin, zeros
+from numpy.random import SeedSequence, default_rng
 
-cases = ["BODY", "SIMULATION", "VISUAL"]
+from integrators import schemes
+import distributions
+
+cases = ["BODY", "SIMULATION", "VISUAL", "OUTPUT", "PARTICLES",
+         "DISTRIBUTION"]
 
 # A dictionary of conversion factors.
 convert = {
@@ -42,6 +49,8 @@ class Body:
         self.c       = '#787878'
         self.ms      = 0.1
         self.posUnit = 'au'
+        self.type    = 'massive'
+        self.rad     = None
         
     def de_polar(self):
         self.vR, self.vPhi = self.vel
@@ -51,9 +60,16 @@ class Body:
                          self.vR*sin(self.phi) + self.vPhi*cos(self.phi)])
         self.polar = False
         
-    def calc_rad(self):
-         self.rad = self.mass**(1/3)
-         self.ms  = 5*log10(self.rad**(1/2)+1.0)
+    def calc_rad(self, radiusScale):
+         """Set the radius of the body, unless one was given, from the radius
+         of a body of 1 Earth mass of the same density, and the marker size."""
+         # Test particles keep the default marker size and have no size
+         if self.type == 'test':
+             self.rad = 0.
+             return
+         if self.rad is None:
+             self.rad = radiusScale*self.mass**(1/3)
+         self.ms  = 5*log10(self.mass**(1/6)+1.0)
 
 
 def count_lines(inFile, outFile):
@@ -89,20 +105,502 @@ def count_lines(inFile, outFile):
         else:
             bodyLines.append(line_)
 
-def input_reader(inFile, outFile):
+class Bodies:
+    """The bodies of the simulation, held as NumPy ndarrays rather than one
+    object for each body.
+
+    The names and colours are lists, the masses, radii and marker sizes 'ms'
+    are arrays of one value for each body, and the positions 'posits' and
+    velocities 'vels' arrays of [x, y] for each body. Bodies given by a BODY
+    case are marked in 'listed', those loaded by a PARTICLES case are counted
+    in 'groups', a list of (name, number of bodies).
+    """
+    def __init__(self, names, masses, posits, vels, radii, ms, colours,
+                 listed, groups):
+        self.names   = names
+        self.masses  = masses
+        self.posits  = posits
+        self.vels    = vels
+        self.radii   = radii
+        self.ms      = ms
+        self.colours = colours
+        self.listed  = listed
+        self.groups  = groups
+
+    def __len__(self):
+        return len(self.masses)
+
+def load_particles(source, outFile):
+    """Load the table of a PARTICLES case from a CSV or NumPy .npy file.
+
+    A CSV file may begin with a line of column names, which is skipped.
+    A .npy file holds either a 2D array, or a structured array with the
+    fields 'mass', 'x', 'y', 'vx' and 'vy' ('mass' may be absent for test
+    particles).
+
+    Arguments:
+    source  -- the name of the file.
+    outFile -- the global output file.
+
+    Returns:
+    table -- a 2D NumPy ndarray of floats with a row for each body.
+    """
+
+    if not path.exists(source):
+        print("Error: Particle file '{0}' not found."
+              "\n  Check your input file!".format(source), file=outFile)
+        sys.exit()
+    if source.endswith('.npy'):
+        return particle_table(load(source))
+    with open(source) as csvFile:
+        first = csvFile.readline().split(',')
+    try:
+        [float(value) for value in first]
+        header = 0
+    except ValueError:
+        header = 1
+    return loadtxt(source, delimiter=',', skiprows=header, ndmin=2)
+
+def particle_table(table):
+    """Return a table of bodies as a 2D NumPy ndarray of floats, with the
+    columns in order if it is a structured array."""
+    table = asarray(table)
+    if table.dtype.names is not None:
+        fields  = [key for key in ['mass', 'x', 'y', 'vx', 'vy']
+                   if key in table.dtype.names]
+        columns = empty((len(table), len(fields)))
+        for i, key in enumerate(fields):
+            columns[:, i] = table[key]
+        return columns
+    return atleast_2d(asarray(table, dtype='float64'))
+
+def read_particles(lines, nGroups, arrays, outFile):
+    """Read the lines of a PARTICLES case, and load its table of bodies.
+
+    Arguments:
+    lines   -- a list of the lines of the case.
+    nGroups -- the number of this PARTICLES case, for messages.
+    arrays  -- a dictionary of tables of bodies given through the Python
+               interface, by name.
+    outFile -- the global output file.
+
+    Returns:
+    group -- a dictionary of the 'name', 'type', 'rel', 'c' and 'polar' of the
+             bodies, and their 'masses', 'posits' and 'vels' as NumPy ndarrays.
+    """
+
+    group = {'name': 'particles{0}'.format(nGroups), 'type': 'massive',
+             'rel': 'centre', 'c': '#787878', 'polar': False}
+    units = ['mE', 'au', 'au/dy']
+    table = None
+    for line in lines:
+        if line in ["Polar", "polar"]:
+            group['polar'] = True
+            continue
+        keyword = line.split(sep=':')[0].strip()
+        value   = line.split(sep=':', maxsplit=1)[1].split()
+        if len(value) == 0 or (len(value) != 1 and keyword not in
+                               ["Units", "units"]):
+            print("Error: Invalid number of arguments given for '{0}' of "
+                  "particles {1}.\n  Check your input file!"
+                  .format(keyword, nGroups), file=outFile)
+            sys.exit()
+        if keyword in ["Name", "name"]:
+            group['name'] = value[0]
+        elif keyword in ["File", "file"]:
+            table = load_particles(value[0], outFile)
+        elif keyword in ["Array", "array"]:
+            if arrays is None or value[0] not in arrays:
+                print("Error: No array '{0}' was given for particles {1}."
+                      .format(value[0], nGroups), file=outFile)
+                sys.exit()
+            table = particle_table(arrays[value[0]])
+        elif keyword in ["Type", "type"]:
+            if value[0].lower() in ["massive", "test"]:
+                group['type'] = value[0].lower()
+            else:
+                print("Error: The type of particles {0} must be 'massive' or "
+                      "'test'.\n  Check your input file!".format(nGroups),
+                      file=outFile)
+                sys.exit()
+        elif keyword in ["Relative", "relative"]:
+            group['rel'] = value[0]
+        elif keyword in ["Colour", "colour", "Color", "color"]:
+            group['c'] = value[0]
+        elif keyword in ["Units", "units"]:
+            if len(value) != 3 or value[0] not in convert or value[1] not in \
+            convert or any(unit not in convert for unit in value[2].split('/')):
+                print("Error: The 'units' of particles {0} must be three units, "
+                      "of mass, position and velocity."
+                      "\n  Check your input file!".format(nGroups), file=outFile)
+                sys.exit()
+            units = value
+        else:
+            print("Error: Unrecognised keyword in particles decleration. "
+                  "\n  Check your input file!", file=outFile)
+            sys.exit()
+
+    if table is None:
+        print("Error: Particles {0} have neither a 'file' nor an 'array'."
+              "\n  Check your input file!".format(nGroups), file=outFile)
+        sys.exit()
+    # Test particles may leave out the column of masses
+    nColumns = table.shape[1]
+    if nColumns == 4 and group['type'] == 'test':
+        first = 0
+    elif nColumns == 5:
+        first = 1
+    else:
+        print("Error: The table of particles {0} has {1} columns, it must have "
+              "five, mass x y vx vy, or four for test particles."
+              "\n  Check your input file!".format(nGroups, nColumns),
+              file=outFile)
+        sys.exit()
+
+    velUnits = units[2].split('/')
+    group['posits'] = table[:, first:first + 2]*convert[units[1]]
+    group['vels']   = table[:, first + 2:first + 4] \
+                    * (convert[velUnits[0]]/convert[velUnits[1]])
+    if group['polar']:
+        # The angles are not scaled by the units of position
+        group['posits'][:, 1] = table[:, first + 1]
+        r, phi   = group['posits'][:, 0], group['posits'][:, 1]
+        vR, vPhi = group['vels'][:, 0], group['vels'][:, 1]
+        group['posits'] = array([r*cos(phi), r*sin(phi)]).T
+        group['vels']   = array([vR*cos(phi) - vPhi*sin(phi),
+                                 vR*sin(phi) + vPhi*cos(phi)]).T
+
+    if group['type'] == 'test':
+        if first == 1 and (table[:, 0] != 0.).any():
+            print("Warning: The masses of test particles {0} are ignored."
+                  .format(group['name']), file=outFile)
+        group['masses'] = zeros(len(table))
+    else:
+        group['masses'] = table[:, 0]*convert[units[0]]
+        if (group['masses'] <= 0.).any():
+            print("Error: Particles {0} have masses not greater than 0."
+                  "\n  Check your input file!".format(group['name']),
+                  file=outFile)
+            sys.exit()
+    return group
+
+def read_distribution(lines, nGroups, outFile):
+    """Read the lines of a DISTRIBUTION case, and draw its bodies.
+
+    Arguments:
+    lines   -- a list of the lines of the case.
+    nGroups -- the number of this PARTICLES or DISTRIBUTION case, for
+               messages.
+    outFile -- the global output file.
+
+    Returns:
+    group -- a dictionary of the 'name', 'type', 'rel' and 'c' of the bodies,
+             their 'masses', 'posits' and 'vels' as NumPy ndarrays, and whether
+             they 'orbit' the relative body, in which case the velocities of
+             circular orbits are still to be added to 'vels'.
+    """
+
+    group = {'name': 'particles{0}'.format(nGroups), 'type': 'massive',
+             'rel': 'centre', 'c': '#787878', 'orbit': False}
+    profile, number, radius, mass = None, None, None, None
+    slope, seed, dispersion = 2.35, None, 0.
+    for line in lines:
+        keyword = line.split(sep=':')[0].strip()
+        value   = line.split(sep=':', maxsplit=1)[1].split()
+        if len(value) == 0:
+            print("Error: No value given for '{0}' of distribution {1}."
+                  "\n  Check your input file!".format(keyword, nGroups),
+                  file=outFile)
+            sys.exit()
+        if keyword in ["Name", "name"]:
+            group['name'] = value[0]
+        elif keyword in ["Type", "type"]:
+            if value[0].lower() in ["massive", "test"]:
+                group['type'] = value[0].lower()
+            else:
+                print("Error: The type of distribution {0} must be 'massive' "
+                      "or 'test'.\n  Check your input file!".format(nGroups),
+                      file=outFile)
+                sys.exit()
+        elif keyword in ["Relative", "relative"]:
+            group['rel'] = value[0]
+        elif keyword in ["Colour", "colour", "Color", "color"]:
+            group['c'] = value[0]
+        elif keyword in ["Profile", "profile"]:
+            profile = value[0].lower()
+            if profile not in ["disk", "annulus", "plummer"]:
+                print("Error: The profile of distribution {0} must be 'disk', "
+                      "'annulus' or 'plummer'.\n  Check your input file!"
+                      .format(nGroups), file=outFile)
+                sys.exit()
+        elif keyword in ["Number", "number"]:
+            number = int(value[0])
+        elif keyword in ["Seed", "seed"]:
+            seed = int(value[0])
+        elif keyword in ["Slope", "slope"]:
+            slope = float(value[0])
+        # The radii and masses are one or two values, followed by units
+        elif keyword in ["Radius", "radius", "Mass", "mass"]:
+            unit = value.pop() if value[-1] in convert else \
+                   ('au' if keyword.lower() == 'radius' else 'mE')
+            if len(value) not in [1, 2]:
+                print("Error: Invalid number of arguments given for '{0}' of "
+                      "distribution {1}.\n  Check your input file!"
+                      .format(keyword, nGroups), file=outFile)
+                sys.exit()
+            values = [float(val)*convert[unit] for val in value]
+            if keyword.lower() == 'radius':
+                radius = values
+            else:
+                mass = values
+        elif keyword in ["Dispersion", "dispersion"]:
+            dispersion = float(value[0])
+            if len(value) == 2:
+                units = value[1].split(sep='/')
+                dispersion *= convert[units[0]]/convert[units[1]]
+        else:
+            print("Error: Unrecognised keyword in distribution decleration. "
+                  "\n  Check your input file!", file=outFile)
+            sys.exit()
+
+    for keyword, val in [('profile', profile), ('number', number),
+                         ('radius', radius)]:
+        if val is None:
+            print("Error: Distribution {0} has no '{1}', but it is required."
+                  "\n  Check your input file!".format(nGroups, keyword),
+                  file=outFile)
+            sys.exit()
+    if profile == 'annulus' and len(radius) != 2:
+        print("Error: The 'radius' of an annulus is its inner and outer radii."
+              "\n  Check your input file!", file=outFile)
+        sys.exit()
+    if group['type'] == 'massive' and mass is None:
+        print("Error: Distribution {0} of massive bodies has no 'mass'."
+              "\n  Check your input file!".format(nGroups), file=outFile)
+        sys.exit()
+    if group['type'] == 'test' and profile == 'plummer':
+        print("Error: A Plummer sphere must be of massive bodies, its "
+              "velocities follow from its mass.\n  Check your input file!",
+              file=outFile)
+        sys.exit()
+
+    # Without a seed one is chosen, and reported so the bodies can be drawn
+    # again
+    if seed is None:
+        seed = SeedSequence().entropy
+    print("Drawing {0} bodies of distribution {1} with seed {2}."
+          .format(number, group['name'], seed), file=outFile)
+    rng = default_rng(seed)
+
+    if group['type'] == 'test':
+        group['masses'] = zeros(number)
+    else:
+        group['masses'] = distributions.mass_function(rng, number, *mass,
+                                                      slope=slope)
+    if profile == 'plummer':
+        group['posits'], group['vels'] = distributions.plummer(
+            rng, number, radius[0], group['masses'].sum(), *radius[1:])
+    else:
+        if profile == 'disk':
+            group['posits'] = distributions.exponential_disk(rng, number,
+                                                             *radius)
+        else:
+            group['posits'] = distributions.annulus(rng, number, *radius)
+        group['vels']  = dispersion*rng.standard_normal((number, 2))
+        group['orbit'] = True
+    return group
+
+def globalise(local, parent, names, outFile):
+    """Add to each position or velocity those of the bodies it is relative to.
+
+    Each body has at most one parent, so the chains of parents are followed
+    by pointer jumping: every body adds the sum of its parent's chain so far,
+    then takes its parent's parent, so a chain of length L takes log2(L)
+    vectorised steps.
+
+    Arguments:
+    local  -- a NumPy ndarray of the values relative to the parents, either
+              the positions or velocities, or both side by side.
+    parent -- a NumPy ndarray of the index of the parent of each body, -1 for
+              bodies relative to the origin.
+    names  -- the names of the bodies, for messages.
+    outFile -- the global output file.
+
+    Returns:
+    total -- a NumPy ndarray of the values relative to the origin.
+    """
+
+    total  = local.copy()
+    parent = parent.copy()
+    for _ in range(len(parent).bit_length() + 1):
+        chained = parent >= 0
+        if not chained.any():
+            return total
+        idx = chained.nonzero()[0]
+        up  = parent[idx]
+        total[idx]  = total[idx] + total[up]
+        parent[idx] = parent[up]
+    cycle = (parent >= 0).nonzero()[0][0]
+    print("Error: Could not globalise coordinates for {0}, its relative "
+          "bodies form a loop.\n  Check your input file!"
+          .format(names[cycle]), file=outFile)
+    sys.exit()
+
+def gather_bodies(blocks, radiusScale, outFile):
+    """Join the bodies of the BODY and PARTICLES cases into arrays, with
+    coordinates relative to the origin and the massive bodies first.
+
+    Arguments:
+    blocks      -- a list of the Body objects of the BODY cases and the
+                   dictionaries of the PARTICLES and DISTRIBUTION cases, in
+                   the order given.
+    radiusScale -- the radius of a body of 1 Earth mass.
+    outFile     -- the global output file.
+
+    Returns:
+    bods -- a Bodies object.
+    """
+
+    names, rels, colours = [], [], []
+    masses, posits, vels, radii, ms = [], [], [], [], []
+    isTest, listed, groups = [], [], []
+    for block in blocks:
+        if isinstance(block, Body):
+            # Also calculate the body's radius and marker size
+            block.calc_rad(radiusScale)
+            names.append(block.name)
+            rels.append((block.name, block.rel, 1, block))
+            colours.append(block.c)
+            masses.append(array([block.mass]))
+            posits.append(block.pos[None, :])
+            vels.append(block.vel[None, :])
+            radii.append(array([block.rad]))
+            ms.append(array([block.ms]))
+            isTest.append(full(1, block.type == 'test'))
+            listed.append(full(1, True))
+        else:
+            n = len(block['masses'])
+            names += ["{0}_{1}".format(block['name'], i) for i in range(n)]
+            rels.append(("{0} ({1} particles)".format(block['name'], n),
+                         block['rel'], n, block))
+            colours += [block['c']]*n
+            masses.append(block['masses'])
+            posits.append(block['posits'])
+            vels.append(block['vels'])
+            if block['type'] == 'test':
+                radii.append(zeros(n))
+                ms.append(full(n, 0.1))
+            else:
+                radii.append(radiusScale*cbrt(block['masses']))
+                ms.append(5*log10(block['masses']**(1/6) + 1.0))
+            isTest.append(full(n, block['type'] == 'test'))
+            listed.append(full(n, False))
+            groups.append((block['name'], n))
+    masses, posits, vels = concatenate(masses), concatenate(posits), \
+                           concatenate(vels)
+    radii, ms = concatenate(radii), concatenate(ms)
+    isTest, listed = concatenate(isTest), concatenate(listed)
+
+    # Now globalise coordinates for bodies defined relative to one another,
+    # finding the index of each relative body by its name
+    print("Globalising the coordinates for ", end='', file=outFile)
+    index = {}
+    for i, name in enumerate(names):
+        index.setdefault(name, i)
+    parent = empty(len(masses), dtype=int64)
+    start  = 0
+    none   = True
+    for name, rel, n, block in rels:
+        if rel == 'centre':
+            parent[start:start + n] = -1
+        elif rel in index:
+            none = False
+            print(name, end='... ', file=outFile)
+            parent[start:start + n] = index[rel]
+        else:
+            print("\nError: Could not globalise coordinates for {0}, "
+                  "relative body {1} not found."
+                  "\n  Check your input file!".format(name, rel), file=outFile)
+            sys.exit()
+        # Distributions in orbit move around the relative body and the mass
+        # within them
+        if isinstance(block, dict) and block.get('orbit'):
+            central = 0. if rel == 'centre' else masses[index[rel]]
+            part    = slice(start, start + n)
+            vels[part] += distributions.circular_vels(posits[part],
+                                                      masses[part], central)
+        start += n
+    if none:
+        print("...None!", file=outFile)
+    else:
+        print(file=outFile)
+        both = globalise(concatenate((posits, vels), axis=1), parent, names,
+                         outFile)
+        posits, vels = both[:, :2], both[:, 2:]
+
+    # The massive bodies come first, followed by the test particles
+    if isTest.all():
+        print("Error: At least one body must be massive."
+              "\n  Check your input file!", file=outFile)
+        sys.exit()
+    if isTest.any():
+        order   = argsort(isTest, kind='stable')
+        names   = [names[i] for i in order]
+        colours = [colours[i] for i in order]
+        masses, posits, vels = masses[order], posits[order], vels[order]
+        radii, ms, listed = radii[order], ms[order], listed[order]
+    return Bodies(names, masses, posits.copy(), vels.copy(), radii, ms,
+                  colours, listed, groups)
+
+def input_reader(inFile, outFile, arrays=None):
     """Control function for reading the input file, discriminates input cases.
     
     Calls the appropriate processing function for the input cases decribed in
-    the documentation, namely: BODY and SIMULATION
+    the documentation, namely: BODY, PARTICLES, DISTRIBUTION and SIMULATION
     
     Arguments:
     inFile  -- the global input file.
     outFile -- the global output file.
+    arrays  -- an optional dictionary of tables of bodies, by name, for the
+               'array' keyword of the PARTICLES case. Each table is a 2D NumPy
+               ndarray with columns mass x y vx vy, or a structured array.
     
     Returns:
-    bods     -- a list of bodies.
-    timeStep -- the time step of the simulation.
-    nSteps   -- the number of steps to simulate.
+    bods     -- a Bodies object of the arrays of the bodies, the massive
+                bodies followed by the test particles.
+    timeStep -- the time step of the simulation, or for the adaptive
+                integrator the first time step, None if it is to be chosen.
+    nSteps   -- the number of steps to simulate, None for the adaptive
+                integrator.
+    doVis    -- whether the VISUAL case was given.
+    figsize, visTime, FPS, visName -- the parameters of the animation.
+    visOpts  -- a dictionary of further options for the animation, namely the
+                'format', 'mp4' or 'png', the number of 'workers' rendering
+                frames and the largest number of 'bodies' drawn, None for one
+                worker for each core and for every body, the 'live' view,
+                None, 'window', 'mp4' or 'png', the size of its 'queue' in
+                frames and the 'budget' in seconds the simulation waits on a
+                full queue.
+    simOpts  -- a dictionary of further simulation options, namely the
+                opening angle 'theta' of the Barnes-Hut engine, the
+                expansion 'order' of the fast multipole engine, and the
+                'grid' size and 'padding' of the particle-mesh engine, the
+                name of the time 'integrator', the 'tolerance' and
+                'duration' of the adaptive integrator, and the accuracy 'eta'
+                and number of 'levels' of the block time steps, the
+                'encounter' factor of the close pairs, the policy for
+                'collisions', None, 'merge' or 'bounce', the 'radius' of a
+                body of 1 Earth mass and the 'restitution' of bounces, and the
+                interval in steps of the conservation 'diagnostics', 0 for
+                none.
+    outOpts  -- a dictionary of options for the output of the steps, namely
+                the 'format' of the step file, 'text', 'binary' or
+                'compressed', for compressed files the largest errors
+                'poserror' and 'velerror', the 'codec' and the 'chunk' size,
+                the interval in steps of each 'checkpoint', 0 for none, the
+                'writer', 'thread' or 'direct', and the 'buffer' of the
+                thread, the steps in each block, None to choose, and the
+                number of blocks.
     """
     
     print("\nReading input from '{}'".format(inFile.name), file=outFile) 
@@ -118,8 +616,25 @@ def input_reader(inFile, outFile):
     visTime = 30
     FPS     = 25
     visName = 'animated'
+    visOpts = {'format': 'mp4', 'workers': None, 'bodies': None,
+               'live': None, 'queue': 4, 'budget': 0.01}
     
-    bods = []
+    # Default values for the force engines
+    simOpts = {'theta': 0.5, 'order': 4, 'grid': 128, 'padding': 2,
+               'integrator': 'rk4', 'tolerance': None, 'duration': None,
+               'eta': 0.01, 'levels': 8, 'encounter': 20., 'diagnostics': 0,
+               'collisions': None, 'radius': 6371.*convert['km'],
+               'restitution': 1.}
+    
+    # Default values for the step file
+    outOpts = {'format': 'text', 'poserror': None, 'velerror': None,
+               'codec': 'zlib', 'chunk': None, 'checkpoint': 0,
+               'writer': 'thread', 'buffer': [None, 4]}
+    
+    # The Body objects of the BODY cases and the dictionaries of the PARTICLES
+    # and DISTRIBUTION cases, in the order given
+    blocks  = []
+    nGroups = 0
     for line in inFile:
         # Strip trailing, leading whitespace from line, skip if empty
         line = line.rstrip('\n').strip()
@@ -197,6 +712,26 @@ def input_reader(inFile, outFile):
                                       "\n  Check your input file!"
                                       .format(nBods), file=outFile)
                                 sys.exit()
+                        elif keyword in ["Radius", "radius"]:
+                            bod.rad = float(line[0])
+                            if len(line) == 2:
+                                bod.rad *= convert[line[1]]
+                            elif len(line) != 1:
+                                print("Error: Invalid number of arguments "
+                                      "given for radius of body {0}."
+                                      "\n  Check your input file!"
+                                      .format(nBods), file=outFile)
+                                sys.exit()
+                        elif keyword in ["Type", "type"]:
+                            if len(line) == 1 and line[0].lower() in \
+                            ["massive", "test"]:
+                                bod.type = line[0].lower()
+                            else:
+                                print("Error: The type of body {0} must be "
+                                      "'massive' or 'test'."
+                                      "\n  Check your input file!"
+                                      .format(nBods), file=outFile)
+                                sys.exit()
                         elif keyword in ["Colour", "colour", "Color", "color"]:
                             if len(line) == 1:
                                 bod.c = line[0]
@@ -217,15 +752,35 @@ def input_reader(inFile, outFile):
                 bod.de_polar()
             else:
                 bod.pos = bod.pos*convert[bod.posUnit]
-            bods.append(bod)
+            blocks.append(bod)
             
+            # Test particles exert no gravity, so their masses are ignored
+            if bod.type == 'test':
+                if bod.mass != 0.:
+                    print("Warning: The mass of test particle {0} is ignored."
+                          .format(bod.name), file=outFile)
+                bod.mass = 0.
             # Check mass of body is not zero.
-            if bod.mass == 0.:
+            elif bod.mass == 0.:
                 print("Error: Mass of body {0} is equal to 0."
                       "\n  Check your input file!"
                       .format(bod.name), file=outFile)
                 sys.exit()
         
+        # Particles case, many bodies loaded from a file or array at once
+        elif line == "PARTICLES":
+            nGroups += 1
+            isBod = True
+            blocks.append(read_particles(count_lines(inFile, outFile),
+                                         nGroups, arrays, outFile))
+        
+        # Distribution case, many bodies drawn at random at once
+        elif line == "DISTRIBUTION":
+            nGroups += 1
+            isBod = True
+            blocks.append(read_distribution(count_lines(inFile, outFile),
+                                            nGroups, outFile))
+        
         # Simulation case
         elif line == "SIMULATION":
             isSim      = True
@@ -233,6 +788,7 @@ def input_reader(inFile, outFile):
             isSteps    = False
             isDuration = False
             isNSteps   = False
+            isIntegrator = False
             
             simLines = count_lines(inFile, outFile)
             for line_ in simLines:
@@ -253,13 +809,122 @@ def input_reader(inFile, outFile):
                 elif keyword in ["Steps", "steps"]:
                     nSteps = int(val[0])
                     isNSteps = True
+                elif keyword in ["Theta", "theta"]:
+                    simOpts['theta'] = float(val[0])
+                    if simOpts['theta'] < 0.:
+                        print("Error: The opening angle 'theta' must not be "
+                              "negative.\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Order", "order"]:
+                    simOpts['order'] = int(val[0])
+                    if simOpts['order'] < 1:
+                        print("Error: The expansion 'order' must be at least 1."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Grid", "grid"]:
+                    simOpts['grid'] = int(val[0])
+                    if simOpts['grid'] < 4:
+                        print("Error: The mesh 'grid' must be at least 4 cells."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Padding", "padding"]:
+                    simOpts['padding'] = int(val[0])
+                    if simOpts['padding'] < 1:
+                        print("Error: The mesh 'padding' must be at least 1."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Integrator", "integrator"]:
+                    simOpts['integrator'] = val[0].lower()
+                    isIntegrator = True
+                    if simOpts['integrator'] not in schemes:
+                        print("Error: Unrecognised integrator '{0}', must be "
+                              "one of: {1}.\n  Check your input file!"
+                              .format(val[0], ", ".join(schemes)), file=outFile)
+                        sys.exit()
+                elif keyword in ["Eta", "eta"]:
+                    simOpts['eta'] = float(val[0])
+                    if simOpts['eta'] <= 0.:
+                        print("Error: The block time step accuracy 'eta' must "
+                              "be positive.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Levels", "levels"]:
+                    simOpts['levels'] = int(val[0])
+                    if not 1 <= simOpts['levels'] <= 31:
+                        print("Error: The number of block time step 'levels' "
+                              "must be from 1 to 31.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Encounter", "encounter"]:
+                    simOpts['encounter'] = float(val[0])
+                    if simOpts['encounter'] <= 0.:
+                        print("Error: The close 'encounter' factor must be "
+                              "positive.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Collisions", "collisions"]:
+                    simOpts['collisions'] = val[0].lower()
+                    if simOpts['collisions'] not in ["merge", "bounce"]:
+                        print("Error: The 'collisions' must be 'merge' or "
+                              "'bounce'.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Radius", "radius"]:
+                    simOpts['radius'] = float(val[0])
+                    if len(val) == 2:
+                        simOpts['radius'] *= convert[val[1]]
+                    if simOpts['radius'] <= 0.:
+                        print("Error: The 'radius' must be positive."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Restitution", "restitution"]:
+                    simOpts['restitution'] = float(val[0])
+                    if not 0. <= simOpts['restitution'] <= 1.:
+                        print("Error: The 'restitution' must be from 0 to 1."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Diagnostics", "diagnostics"]:
+                    simOpts['diagnostics'] = int(val[0])
+                    if simOpts['diagnostics'] < 0:
+                        print("Error: The 'diagnostics' interval must not be "
+                              "negative.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Tolerance", "tolerance"]:
+                    simOpts['tolerance'] = float(val[0])
+                    if simOpts['tolerance'] <= 0.:
+                        print("Error: The 'tolerance' must be positive."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
                 else:
                     print("Error: Unrecognised keyword in 'SIMULATION'."
                           "\n  Check your input file!", file=outFile)
                     sys.exit()
             
             # Some parameters conflict and are mutually exclusive
-            if (isSteps and isDuration and isNSteps):
+            if simOpts['collisions'] and simOpts['integrator'] == 'block':
+                print("Error: 'collisions' cannot be used with the 'block' "
+                      "integrator.\n  Check your input file!", file=outFile)
+                sys.exit()
+            if simOpts['tolerance'] is not None:
+                # The adaptive integrator chooses its own steps, 'dt' is
+                # only the first guess
+                if isNSteps or not isDuration:
+                    print("Error: 'tolerance' requires 'duration' and not "
+                          "'steps' in SIMULATION."
+                          "\n  Check your input file!", file=outFile)
+                    sys.exit()
+                if isIntegrator:
+                    print("Error: 'tolerance' always uses the adaptive "
+                          "integrator, remove 'integrator' from SIMULATION."
+                          "\n  Check your input file!", file=outFile)
+                    sys.exit()
+                simOpts['integrator'] = 'dopri5'
+                simOpts['duration']   = duration
+                nSteps = None
+                if not isSteps:
+                    timeStep = None
+            elif (isSteps and isDuration and isNSteps):
                 print("Error: 'dt', 'duration' and 'steps' are all defined "
                       "for SIMULATION." 
                       "\n  Please choose only two.", file=outFile)
@@ -294,11 +959,124 @@ def input_reader(inFile, outFile):
                         FPS = int(val)
                 elif keyword in ["File", "file"]:
                     visName = val
+                elif keyword in ["Format", "format"]:
+                    if val.lower() in ["mp4", "png"]:
+                        visOpts['format'] = val.lower()
+                    else:
+                        print("Error: The 'format' of the animation must be "
+                              "'mp4' or 'png'.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Workers", "workers"]:
+                    visOpts['workers'] = int(val)
+                elif keyword in ["Bodies", "bodies"]:
+                    visOpts['bodies'] = int(val)
+                elif keyword in ["Live", "live"]:
+                    if val.lower() in ["window", "mp4", "png"]:
+                        visOpts['live'] = val.lower()
+                    else:
+                        print("Error: The 'live' view must be 'window', 'mp4' "
+                              "or 'png'.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Queue", "queue"]:
+                    visOpts['queue'] = int(val)
+                    if visOpts['queue'] < 1:
+                        print("Error: The 'queue' of the live view must hold "
+                              "at least 1 frame.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Budget", "budget"]:
+                    # In seconds, unless other units of time are given
+                    val = val.split()
+                    visOpts['budget'] = float(val[0])
+                    if len(val) == 2:
+                        visOpts['budget'] *= convert[val[1]]*24*60*60
                 else:
                     print("Error: Unrecognised keyword in visual decleration."
                          "\n  Check your input file!", file=outFile)
                     sys.exit()
         
+        # Output case
+        elif line == "OUTPUT":
+            outLines = count_lines(inFile, outFile)
+            for line_ in outLines:
+                keyword = line_.split(sep=':')[0].strip()
+                val     = line_.split(sep=':')[1].strip()
+                if keyword in ["Format", "format"]:
+                    outOpts['format'] = val.lower()
+                    if outOpts['format'] not in ["text", "binary",
+                                                 "compressed"]:
+                        print("Error: The step file 'format' must be 'text', "
+                              "'binary' or 'compressed'."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Poserror", "poserror", "PosError"]:
+                    val = val.split()
+                    outOpts['poserror'] = float(val[0])
+                    if len(val) == 2:
+                        outOpts['poserror'] *= convert[val[1]]
+                elif keyword in ["Velerror", "velerror", "VelError"]:
+                    val = val.split()
+                    outOpts['velerror'] = float(val[0])
+                    if len(val) == 2:
+                        units = val[1].split(sep='/')
+                        outOpts['velerror'] *= convert[units[0]]/convert[units[1]]
+                elif keyword in ["Codec", "codec"]:
+                    outOpts['codec'] = val.lower()
+                    if outOpts['codec'] not in ["zlib", "lzma"]:
+                        print("Error: The compression 'codec' must be 'zlib' "
+                              "or 'lzma'.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Checkpoint", "checkpoint"]:
+                    outOpts['checkpoint'] = int(val)
+                    if outOpts['checkpoint'] < 0:
+                        print("Error: The 'checkpoint' interval must not be "
+                              "negative.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Chunk", "chunk"]:
+                    outOpts['chunk'] = int(val)
+                    if outOpts['chunk'] < 1:
+                        print("Error: The 'chunk' must be at least 1 step."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                elif keyword in ["Writer", "writer"]:
+                    outOpts['writer'] = val.lower()
+                    if outOpts['writer'] not in ["thread", "direct"]:
+                        print("Error: The 'writer' must be 'thread' or "
+                              "'direct'.\n  Check your input file!",
+                              file=outFile)
+                        sys.exit()
+                elif keyword in ["Buffer", "buffer"]:
+                    val = [int(v) for v in val.split()]
+                    if len(val) not in [1, 2] or min(val) < 1:
+                        print("Error: The 'buffer' must be a number of steps "
+                              "in each block, optionally followed by a number "
+                              "of blocks, each at least 1."
+                              "\n  Check your input file!", file=outFile)
+                        sys.exit()
+                    outOpts['buffer'] = val + outOpts['buffer'][len(val):]
+                else:
+                    print("Error: Unrecognised keyword in 'OUTPUT'."
+                          "\n  Check your input file!", file=outFile)
+                    sys.exit()
+            
+            # A compressed step file needs to know how accurate to be
+            if outOpts['format'] == 'compressed':
+                if outOpts['poserror'] is None or outOpts['poserror'] <= 0.:
+                    print("Error: A positive 'poserror' is required for the "
+                          "compressed format in 'OUTPUT'."
+                          "\n  Check your input file!", file=outFile)
+                    sys.exit()
+                if outOpts['velerror'] is None:
+                    outOpts['velerror'] = outOpts['poserror']
+                elif outOpts['velerror'] <= 0.:
+                    print("Error: The 'velerror' must be positive."
+                          "\n  Check your input file!", file=outFile)
+                    sys.exit()
+        
         # If not valid case, raise error  
         else:
             print("Error: Unrecognised flag {0}."
@@ -314,30 +1092,8 @@ def input_reader(inFile, outFile):
             exit = True 
     if exit: sys.exit()
     
-    # Now globalise coordinates for bodies defined relative to one another.
-    print("Globalising the coordinates for ", end='', file=outFile)
-    none = True
-    for bod in bods:
-        # Also calculate the body's radius and marker size
-        bod.calc_rad()
-        while bod.rel != 'centre':
-            none = False
-            print(bod.name, end='... ', file=outFile)
-            noBod = True
-            for relBod in bods:
-                if relBod.name == bod.rel:
-                    noBod = False
-                    bod.pos += relBod.pos
-                    bod.vel += relBod.vel
-                    bod.rel  = relBod.rel
-            if noBod:
-                print("Error: Could not globalise coordinates for {0}, "
-                     "relative body {1} not found."
-                     .format(bod.name, bod.rel), file=outFile)
-    if none:
-        print("...None!", file=outFile)
-    else:
-        print(file=outFile)
+    bods = gather_bodies(blocks, simOpts['radius'], outFile)
                     
     print("Finished reading input.", file=outFile)
-    return bods, timeStep, nSteps, isVis, figsize, visTime, FPS, visName
+    return bods, timeStep, nSteps, isVis, figsize, visTime, FPS, visName, \
+           visOpts, simOpts, outOpts
@@ -0,0 +1,327 @@
+# Rendering of the animation, with every body drawn by a single scatter
+# artist whose offsets are replaced for each frame. Runs of frames are drawn
+# by a pool of processes, each with a figure of its own, and the finished
+# frames are either streamed in order into one ffmpeg process as raw pixels or
+# written by the workers as numbered PNG files.
+#
+# The animation can also be shown live, while the simulation runs: the steps
+# are passed through a bounded queue to a process which draws them in a window
+# or encodes them as they arrive. The simulation never waits on a full queue
+# for longer than its budget, and frames that would are dropped.
+
+from collections import deque
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count
+from queue import Full
+from shutil import which
+import subprocess
+from time import perf_counter
+
+from numpy import absolute, amax, arange, asarray, float32, searchsorted
+
+# neo.py runs as a script, so the processes are forked from it where possible
+# rather than started afresh, which would run the script again
+context = get_context('fork' if 'fork' in get_all_start_methods() else None)
+
+# The frames and figure of the animation, set once in each worker process
+worker = {}
+
+def shown_bodies(nBodies, maxBodies):
+    """Return the indices of the bodies drawn, every n-th body if there are
+    more than maxBodies."""
+    stride = 1 if maxBodies is None else max(1, -(-nBodies//maxBodies))
+    return arange(0, nBodies, stride)
+
+def make_canvas(posits, sizes, colours, window, figSize, dpi):
+    """Create a figure with the bodies at posits drawn by one scatter artist,
+    returning a dictionary of the figure, its canvas, axes and scatter, and
+    the pixels of the empty axes to draw each frame on."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(figSize, figSize), dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    ax = figure.add_axes([0.1, 0.1, 0.8, 0.8])
+    scatter = ax.scatter(posits[:, 0], posits[:, 1], s=sizes, c=colours,
+                         edgecolors='none', animated=True)
+    state = {'figure': figure, 'canvas': canvas, 'ax': ax, 'scatter': scatter}
+    set_window(state, window)
+    return state
+
+def set_window(state, window):
+    """Set the limits of the axes, and keep the pixels of the empty axes."""
+    state['ax'].set_xlim(window)
+    state['ax'].set_ylim(window)
+    state['canvas'].draw()
+    state['background'] = state['canvas'].copy_from_bbox(state['figure'].bbox)
+
+def blit(state, posits):
+    """Draw only the scatter artist at posits over the empty axes, returning
+    the RGBA pixels of the canvas."""
+    state['canvas'].restore_region(state['background'])
+    state['scatter'].set_offsets(posits)
+    state['ax'].draw_artist(state['scatter'])
+    return state['canvas'].buffer_rgba()
+
+def start_encoder(fileName, pixels, FPS):
+    """Start an ffmpeg process encoding square raw RGBA frames of the given
+    size in pixels, read from its standard input."""
+    return subprocess.Popen(
+        [which('ffmpeg'), '-y', '-loglevel', 'error', '-f', 'rawvideo',
+         '-pix_fmt', 'rgba', '-s', '{0}x{0}'.format(pixels), '-r', str(FPS),
+         '-i', '-', '-pix_fmt', 'yuv420p', '-vcodec', 'libx264', fileName],
+        stdin=subprocess.PIPE)
+
+def init_worker(frames, sizes, colours, window, figSize, dpi):
+    """Create the figure and scatter artist of a worker process."""
+    worker.update(make_canvas(frames[0], sizes, colours, window, figSize,
+                              dpi), frames=frames)
+
+def draw_frames(first, last, pngName=None):
+    """Draw the frames from first up to last, returning the raw RGBA pixels
+    of each, or writing each to a numbered PNG file if pngName is given."""
+    from matplotlib.image import imsave
+
+    pixels = []
+    for i in range(first, last):
+        rgba = blit(worker, worker['frames'][i])
+        if pngName:
+            imsave(pngName.format(i), asarray(rgba))
+        else:
+            pixels.append(bytes(rgba))
+    return pixels
+
+def render_animation(frames, sizes, colours, extent, figSize, FPS, visName,
+                     fileFormat='mp4', workers=None, maxBodies=None,
+                     chunkFrames=8, dpi=100):
+    """Render the frames of the animation, in parallel.
+
+    Arguments:
+    frames      -- a list of NumPy ndarrays of the positions of the bodies at
+                   each frame.
+    sizes       -- a NumPy ndarray of the marker size of each body.
+    colours     -- a list of the colour of each body.
+    extent      -- the half width of the window, in au.
+    figSize     -- the size of the square figure, in inches.
+    FPS         -- the frame rate of the animation.
+    visName     -- the prefix of the animation file, or of the PNG files.
+    fileFormat  -- 'mp4' to stream the frames to ffmpeg, or 'png' to write
+                   numbered PNG files.
+    workers     -- the number of processes drawing frames, None for one for
+                   each core.
+    maxBodies   -- the largest number of bodies drawn, every n-th body is
+                   drawn if there are more, None for all bodies.
+    chunkFrames -- the number of frames drawn by a worker at a time.
+    dpi         -- the resolution of the frames, in pixels per inch.
+
+    Returns:
+    fileName -- the name of the animation file, or the pattern of the names of
+                the PNG files.
+    workers  -- the number of processes used.
+    """
+
+    workers = workers or cpu_count() or 1
+    shown   = shown_bodies(len(sizes), maxBodies)
+    # A contiguous decimated copy of every frame, sent to each worker once
+    framesShown = asarray(frames, dtype=float32)[:, shown]
+    sizes   = asarray(sizes)[shown]**2
+    colours = [colours[i] for i in shown]
+    window  = (-extent, extent)
+    nFrames = len(framesShown)
+    chunks  = [(first, min(first + chunkFrames, nFrames))
+               for first in range(0, nFrames, chunkFrames)]
+    initArgs = (framesShown, sizes, colours, window, figSize, dpi)
+
+    if fileFormat == 'png':
+        pngName = "{0}_{{0:05d}}.png".format(visName)
+        with context.Pool(workers, init_worker, initArgs) as pool:
+            pool.starmap(draw_frames, [chunk + (pngName,) for chunk in chunks])
+        return "{0}_*.png".format(visName), workers
+
+    # Frames are even in pixels, as the encoder requires
+    pixels   = 2*round(figSize*dpi/2)
+    initArgs = initArgs[:-2] + (pixels/dpi, dpi)
+    fileName = "{0}.mp4".format(visName)
+    encoder  = start_encoder(fileName, pixels, FPS)
+    # Only a few runs of frames wait at a time, so memory stays bounded, and
+    # they are written in order as each finishes
+    with context.Pool(workers, init_worker, initArgs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(draw_frames, chunk))
+            if len(pending) >= 2*workers:
+                for frame in pending.popleft().get():
+                    encoder.stdin.write(frame)
+        while pending:
+            for frame in pending.popleft().get():
+                encoder.stdin.write(frame)
+    encoder.stdin.close()
+    encoder.wait()
+    return fileName, workers
+
+def has_encoder():
+    """Return whether ffmpeg is found, for streaming the frames."""
+    return which('ffmpeg') is not None
+
+def live_consumer(queue, mode, sizes, colours, extent, figSize, FPS, visName,
+                  dpi=100):
+    """Draw the frames taken from the queue as they arrive, until None is
+    taken, in a window or into an animation file.
+
+    The window is widened whenever a body leaves it. In the mode 'window' the
+    window is left open at the end until it is closed.
+    """
+
+    window = (-extent, extent)
+    state, encoder, frameNum = None, None, 0
+    if mode == 'window':
+        import matplotlib.pyplot as plt
+
+        figure = plt.figure(figsize=(figSize, figSize))
+        ax     = figure.add_axes([0.1, 0.1, 0.8, 0.8])
+        ax.set_xlim(window)
+        ax.set_ylim(window)
+        scatter = None
+        plt.show(block=False)
+    else:
+        from matplotlib.image import imsave
+
+        pixels = 2*round(figSize*dpi/2)
+
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        time, posits = item
+        reach = amax(absolute(posits))
+        if reach > extent:
+            extent = 1.5*reach
+            window = (-extent, extent)
+            if mode == 'window':
+                ax.set_xlim(window)
+                ax.set_ylim(window)
+            elif state is not None:
+                set_window(state, window)
+
+        if mode == 'window':
+            # A closed window stops the drawing, the queue is still emptied
+            if not plt.fignum_exists(figure.number):
+                continue
+            if scatter is None:
+                scatter = ax.scatter(posits[:, 0], posits[:, 1], s=sizes,
+                                     c=colours, edgecolors='none')
+            scatter.set_offsets(posits)
+            ax.set_title("{0:.1f} days".format(time))
+            figure.canvas.draw_idle()
+            figure.canvas.flush_events()
+        elif mode == 'mp4':
+            if state is None:
+                state   = make_canvas(posits, sizes, colours, window,
+                                      pixels/dpi, dpi)
+                encoder = start_encoder("{0}.mp4".format(visName), pixels, FPS)
+            encoder.stdin.write(blit(state, posits))
+        else:
+            if state is None:
+                state = make_canvas(posits, sizes, colours, window, figSize,
+                                    dpi)
+            imsave("{0}_{1:05d}.png".format(visName, frameNum),
+                   asarray(blit(state, posits)))
+            frameNum += 1
+
+    if mode == 'window':
+        if plt.fignum_exists(figure.number):
+            plt.show()
+    elif encoder is not None:
+        encoder.stdin.close()
+        encoder.wait()
+
+class LiveView:
+    """Show the animation while the simulation runs, as a sink of the steps.
+
+    The positions at each frame time, of at most maxBodies bodies, are put on
+    a bounded queue read by a separate process, which draws them in a window
+    ('window') or encodes them into an animation file ('mp4', or 'png' for
+    numbered PNG files). When the queue is full the simulation waits at most
+    'budget' seconds for a place, after which the frame is dropped, so that
+    drawing slows the simulation by no more than the budget for each frame.
+    """
+    def __init__(self, mode, frameTimes, sizes, colours, posits, figSize, FPS,
+                 visName, outFile, maxBodies=None, queueSize=4, budget=0.01):
+        self.mode       = mode
+        self.frameTimes = frameTimes
+        self.nextFrame  = 0
+        self.shown      = shown_bodies(len(sizes), maxBodies)
+        self.budget     = budget
+        self.outFile    = outFile
+        self.nShown     = 0
+        self.nDropped   = 0
+        self.waited     = 0.
+        self.queue      = context.Queue(queueSize)
+        extent = 1.1*amax(absolute(posits)) or 1.
+        self.consumer   = context.Process(
+            target=live_consumer, name='neo-live',
+            args=(self.queue, mode, asarray(sizes)[self.shown]**2,
+                  [colours[i] for i in self.shown], extent, figSize, FPS,
+                  visName))
+        self.consumer.start()
+
+    def write(self, step, time, posits, vels):
+        # Each frame time takes the first step at or after it, a step is at
+        # most one frame however many frame times it passes
+        if self.frameTimes is not None:
+            if self.nextFrame >= len(self.frameTimes) \
+            or time < self.frameTimes[self.nextFrame]:
+                return
+            self.nextFrame = searchsorted(self.frameTimes, time, side='right')
+        # Frames for a view that has stopped are dropped, they would only
+        # fill the queue
+        if not self.consumer.is_alive():
+            self.nDropped += 1
+            return
+        frame = (time, posits[self.shown].astype(float32))
+        start = perf_counter()
+        try:
+            self.queue.put(frame, timeout=self.budget)
+            self.nShown += 1
+        except Full:
+            self.nDropped += 1
+        self.waited += perf_counter() - start
+
+    def checkpoint(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+    def close(self):
+        # The end is only waited for while the view is still drawing, a view
+        # that has stopped never empties the queue
+        ended = False
+        while not ended and self.consumer.is_alive():
+            try:
+                self.queue.put(None, timeout=1.)
+                ended = True
+            except Full:
+                pass
+        print("Live view showed {0} frames and dropped {1}, the simulation "
+              "waited {2:.2f} s for it.".format(self.nShown, self.nDropped,
+                                               self.waited), file=self.outFile)
+        if not ended:
+            self.consumer.join()
+            # The frames left in the queue are abandoned rather than waited
+            # for when the program exits
+            self.queue.cancel_join_thread()
+            print("Error: The live view stopped part way through, with exit "
+                  "code {0}, the frames after it stopped were dropped."
+                  .format(self.consumer.exitcode), file=self.outFile)
+        # A window is left open until it is closed, the others are finished
+        # before the simulation goes on
+        elif self.mode == 'window':
+            print("Close the window of the live view to exit.",
+                  file=self.outFile)
+        else:
+            self.consumer.join()
+            if self.consumer.exitcode:
+                print("Error: The live view failed with exit code {0}, the "
+                      "animation may be incomplete."
+                      .format(self.consumer.exitcode), file=self.outFile)
@@ -1,9 +1,18 @@
 # Reference for discrete equations:
 # http://physics.bu.edu/py502/lectures3/cmotion.pdf
+#
+# The kernels work on a flat structure-of-arrays layout, with the masses and
+# each coordinate of the bodies in its own contiguous array, use only scalar
+# arithmetic in the inner loop, and are parallel over a single outer loop.
+# The force of each pair of bodies is evaluated once and applied to both.
+# They are compiled once and cached on disk, so that later runs load them
+# rather than compiling them again.
 
-from numpy import zeros_like, array
-from numpy import sum as npsum
-from numba import njit, prange
+from math import sqrt
+from time import perf_counter
+
+from numpy import arange, empty, ones
+from numba import get_num_threads, njit, prange
 
 # Constants
 G     = 6.67430e-11     # Netwon's gravitational constant in SI units
@@ -11,98 +20,345 @@ m2AU  = 6.684587122e-12 # Metre to astronomical units
 kg2ME = 1.6744e-25      # Kilogram to Earth masses
 s2dy  = 1.157407407e-5  # Second to days (ass. 24hr/day)
 
-convG = G * m2AU**3 / (kg2ME * s2dy**2) # G in unit [au^3 ME^-1 dy^-2] 
+convG = G * m2AU**3 / (kg2ME * s2dy**2) # G in unit [au^3 ME^-1 dy^-2]
+
+# Work arrays for the kernels, reallocated only when the number of bodies
+# changes so that no step allocates arrays of its own.
+workBuffers = {'numBodies': -1}
+
+def get_buffers(numBodies):
+    """Return the work arrays for N bodies: the coordinates x, y, vx, vy of
+    the bodies, a (12, N) array for the stages of a Runge-Kutta step, and a
+    (2, threads, N) array for the partial sums of the accelerations."""
+    if workBuffers['numBodies'] != numBodies:
+        workBuffers['numBodies'] = numBodies
+        workBuffers['coords']   = empty((4, numBodies))
+        workBuffers['stages']   = empty((12, numBodies))
+        workBuffers['partials'] = empty((2, get_num_threads(), numBodies))
+    return workBuffers['coords'], workBuffers['stages'], \
+           workBuffers['partials']
+
+@njit(parallel=True, cache=True)
+def accel_kernel(masses, x, y, targets, aX, aY):
+    """Calculate the gravitational acceleration of each target body from
+    every other body, in parallel over the targets, into aX and aY."""
+
+    numBodies = len(masses)
+    for k in prange(len(targets)):
+        i  = targets[k]
+        xI = x[i]
+        yI = y[i]
+        sumX = 0.
+        sumY = 0.
+        for j in range(numBodies):
+            if i == j: continue
+
+            rX     = x[j] - xI
+            rY     = y[j] - yI
+            rSumSq = rX*rX + rY*rY
+            weight = masses[j] / (rSumSq*sqrt(rSumSq))
+            sumX  += weight*rX
+            sumY  += weight*rY
+        aX[k] = convG*sumX
+        aY[k] = convG*sumY
+
+@njit(parallel=True, cache=True)
+def symmetric_kernel(masses, x, y, partials, aX, aY):
+    """Calculate the gravitational acceleration of every body into aX and aY,
+    evaluating the force of each pair of bodies once.
+
+    Each part of the bodies i takes the pairs with j > i, adding the force to
+    i and subtracting it from j in its own row of 'partials', so that no two
+    threads write to the same element; the rows are then summed. The parts
+    take every n-th body, so that they hold about as many pairs each.
+    """
+
+    numBodies = len(masses)
+    nParts    = partials.shape[1]
+    for part in prange(nParts):
+        partX = partials[0, part]
+        partY = partials[1, part]
+        partX[:] = 0.
+        partY[:] = 0.
+        for i in range(part, numBodies, nParts):
+            xI   = x[i]
+            yI   = y[i]
+            mI   = masses[i]
+            sumX = 0.
+            sumY = 0.
+            for j in range(i + 1, numBodies):
+                rX     = x[j] - xI
+                rY     = y[j] - yI
+                rSumSq = rX*rX + rY*rY
+                invR3  = 1. / (rSumSq*sqrt(rSumSq))
+                fX     = invR3*rX
+                fY     = invR3*rY
+                sumX     += masses[j]*fX
+                sumY     += masses[j]*fY
+                partX[j] -= mI*fX
+                partY[j] -= mI*fY
+            partX[i] += sumX
+            partY[i] += sumY
+
+    for i in prange(numBodies):
+        sumX = 0.
+        sumY = 0.
+        for part in range(nParts):
+            sumX += partials[0, part, i]
+            sumY += partials[1, part, i]
+        aX[i] = convG*sumX
+        aY[i] = convG*sumY
+
+@njit(parallel=True, cache=True)
+def test_kernel(masses, x, y, testX, testY, aX, aY):
+    """Calculate the gravitational acceleration of each test particle from
+    the massive bodies, in parallel over the particles, into aX and aY."""
+
+    numBodies = len(masses)
+    for k in prange(len(testX)):
+        xK   = testX[k]
+        yK   = testY[k]
+        sumX = 0.
+        sumY = 0.
+        for j in range(numBodies):
+            rX     = x[j] - xK
+            rY     = y[j] - yK
+            rSumSq = rX*rX + rY*rY
+            weight = masses[j] / (rSumSq*sqrt(rSumSq))
+            sumX  += weight*rX
+            sumY  += weight*rY
+        aX[k] = convG*sumX
+        aY[k] = convG*sumY
 
-@njit(parallel=True)
-def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels):
-    """Perform a forward step using the fourth-order Runge-Kutta method 
+@njit(cache=True)
+def force_kernel(numMassive, masses, x, y, partials, aX, aY):
+    """Calculate the gravitational acceleration of every body into aX and aY,
+    where the first numMassive bodies are massive and the rest are test
+    particles."""
+
+    symmetric_kernel(masses[:numMassive], x[:numMassive], y[:numMassive],
+                     partials[:, :, :numMassive], aX[:numMassive],
+                     aY[:numMassive])
+    if numMassive < len(masses):
+        test_kernel(masses[:numMassive], x[:numMassive], y[:numMassive],
+                    x[numMassive:], y[numMassive:], aX[numMassive:],
+                    aY[numMassive:])
+
+@njit(cache=True)
+def rk4_kernel(stepSize, numMassive, masses, x, y, vX, vY, partials, stages):
+    """Advance the coordinates x, y, vX, vY of every body in place by one
+    fourth-order Runge-Kutta step, using the rows of 'stages' for the
+    positions, velocities and accelerations of the intermediate stages. The
+    bodies after the first numMassive are test particles."""
+
+    numBodies = len(masses)
+    xS, yS, vXS, vYS = stages[0], stages[1], stages[2], stages[3]
+    aX1, aY1, aX2, aY2 = stages[4], stages[5], stages[6], stages[7]
+    aX3, aY3, aX4, aY4 = stages[8], stages[9], stages[10], stages[11]
+    halfStep = 0.5*stepSize
+
+    force_kernel(numMassive, masses, x, y, partials, aX1, aY1)
+    for i in range(numBodies):
+        xS[i]  = x[i]  + halfStep*vX[i]
+        yS[i]  = y[i]  + halfStep*vY[i]
+        vXS[i] = vX[i] + halfStep*aX1[i]
+        vYS[i] = vY[i] + halfStep*aY1[i]
+
+    # The sums of the velocities are gathered in the first stage rows as the
+    # later stages no longer need them
+    force_kernel(numMassive, masses, xS, yS, partials, aX2, aY2)
+    for i in range(numBodies):
+        sumVX  = vX[i] + 2*vXS[i]
+        sumVY  = vY[i] + 2*vYS[i]
+        xS[i]  = x[i]  + halfStep*vXS[i]
+        yS[i]  = y[i]  + halfStep*vYS[i]
+        vXS[i] = vX[i] + halfStep*aX2[i]
+        vYS[i] = vY[i] + halfStep*aY2[i]
+        aX1[i] += 2*aX2[i]
+        aY1[i] += 2*aY2[i]
+        aX2[i] = sumVX + 2*vXS[i]
+        aY2[i] = sumVY + 2*vYS[i]
+
+    force_kernel(numMassive, masses, xS, yS, partials, aX3, aY3)
+    for i in range(numBodies):
+        xS[i]  = x[i]  + stepSize*vXS[i]
+        yS[i]  = y[i]  + stepSize*vYS[i]
+        vXS[i] = vX[i] + stepSize*aX3[i]
+        vYS[i] = vY[i] + stepSize*aY3[i]
+        aX1[i] += 2*aX3[i]
+        aY1[i] += 2*aY3[i]
+
+    force_kernel(numMassive, masses, xS, yS, partials, aX4, aY4)
+    for i in range(numBodies):
+        x[i]  += stepSize*(aX2[i] + vXS[i])/6
+        y[i]  += stepSize*(aY2[i] + vYS[i])/6
+        vX[i] += stepSize*(aX1[i] + aX4[i])/6
+        vY[i] += stepSize*(aY1[i] + aY4[i])/6
+
+def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels,
+              numMassive=None):
+    """Perform a forward step using the fourth-order Runge-Kutta method
     in parallel over all bodies in the simulation using Numba.
-    
+
     This function takes the current positions and velocities of a number of
     bodies and performs a single forward time step of Netwon's gravitational
     equations of motion using the 4th order Runge-Kutta method for all bodies.
-    
+
     Arguments:
     stepSize      -- the size of the time step in days.
     numBodies     -- the number of bodies equal to len(bodyMasses).
-    bodyMasses    -- a list of masses for each body.
+    bodyMasses    -- a NumPy ndarray of masses for each body.
     currentPosits -- a NumPy ndarray of the current positions of all bodies,
                      each element of which has in turn two dimensions: [x, y].
     currentVels   -- a NumPy ndarray of the current velocities of all bodies,
                      each element of which has in turn two dimensions: [x, y].
-    
+    numMassive    -- the number of massive bodies, which come before the test
+                     particles, by default every body.
+
     Returns:
     nextPosits  -- a NumPy ndarray of the next positions of all bodies, each
                    element of which has in turn two dimensions: [x, y].
-    currentVels -- a NumPy ndarray of the next velocities of all bodies, each
+    nextVels    -- a NumPy ndarray of the next velocities of all bodies, each
                    element of which has in turn two dimensions: [x, y].
-    
-    Note, the order of the position and velocities vectors for each mass in the 
-    arguments 'currentPosits' and 'currentVels' must be the same as the order 
+
+    Note, the order of the position and velocities vectors for each mass in the
+    arguments 'currentPosits' and 'currentVels' must be the same as the order
     of masses in 'bodyMasses'. The return arrays also have the same ordering.
     """
-    
-    nextPosit = zeros_like(currentPosits)
-    nextVel   = zeros_like(currentVels)
-    
-    for i in prange(numBodies):
-        
-        iMass  = bodyMasses[i]
-        iPosit = currentPosits[i]
-        iVel   = currentVels[i]
-        
-        l1 = stepSize*iVel
-        k1 = array([0., 0.])
-        for j in prange(numBodies):
-            if i == j: continue
-            
-            jMass  = bodyMasses[j]
-            jPosit = currentPosits[j]
-            
-            rVec   = jPosit - iPosit
-            rSumSq = npsum(rVec**2)
-            k1    += stepSize * convG * jMass * (rVec/rSumSq**1.5)
-        
-        
-        l2 = stepSize * (iVel + k1/2)
-        k2 = array([0., 0.])
-        for j in prange(numBodies):
-            if i == j: continue
-            
-            jMass  = bodyMasses[j]
-            jPosit = currentPosits[j]
-            
-            rVec   = jPosit - (iPosit + l1/2)
-            rSumSq = npsum(rVec**2)
-            k2    += stepSize * convG * jMass * (rVec/rSumSq**1.5)
-       
-        
-        l3 = stepSize * (iVel + k2/2)
-        k3 = array([0., 0.])
-        for j in prange(numBodies):
-            if i == j: continue
-            
-            jMass  = bodyMasses[j]
-            jPosit = currentPosits[j]
-            
-            rVec   = jPosit - (iPosit + l2/2)
-            rSumSq = npsum(rVec**2)
-            k3    += stepSize * convG * jMass * (rVec/rSumSq**1.5)
-        
-        
-        l4 = stepSize * (iVel + k3)
-        k4 = array([0., 0.])
-        for j in prange(numBodies):
-            if i == j: continue
-            
-            jMass  = bodyMasses[j]
-            jPosit = currentPosits[j]
-            
-            rVec   = jPosit - (iPosit + l3)
-            rSumSq = npsum(rVec**2)
-            k4    += stepSize * convG * jMass * (rVec/rSumSq**1.5)
-       
-        nextPosit[i] = iPosit + (l1 + 2*l2 + 2*l3 + l4)/6
-        nextVel[i]   = iVel   + (k1 + 2*k2 + 2*k3 + k4)/6
-    
-    return nextPosit, nextVel
+
+    coords, stages, partials = get_buffers(numBodies)
+    coords[:2] = currentPosits.T
+    coords[2:] = currentVels.T
+    if numMassive is None:
+        numMassive = numBodies
+    rk4_kernel(stepSize, numMassive, bodyMasses, coords[0], coords[1],
+               coords[2], coords[3], partials, stages)
+    return coords[:2].T.copy(), coords[2:].T.copy()
+
+@njit(cache=True)
+def steps_kernel(stepSize, nSteps, cadence, numMassive, masses, x, y, vX, vY,
+                 partials, stages, out):
+    """Advance the coordinates of every body in place by nSteps Runge-Kutta
+    steps, copying them into the next row of 'out' every 'cadence' steps."""
+
+    nOut = 0
+    for n in range(1, nSteps + 1):
+        rk4_kernel(stepSize, numMassive, masses, x, y, vX, vY, partials,
+                   stages)
+        if n % cadence == 0:
+            for i in range(len(masses)):
+                out[nOut, i, 0] = x[i]
+                out[nOut, i, 1] = y[i]
+                out[nOut, i, 2] = vX[i]
+                out[nOut, i, 3] = vY[i]
+            nOut += 1
+
+def make_steps(stepSize, nSteps, numBodies, bodyMasses, currentPosits,
+               currentVels, out, cadence=1, numMassive=None):
+    """Perform a number of forward steps using the fourth-order Runge-Kutta
+    method in a single call to a compiled Numba kernel.
+
+    The steps are identical to those of make_step, but no Python is run
+    between them, which for small numbers of bodies takes far longer than the
+    steps themselves.
+
+    Arguments:
+    stepSize      -- the size of the time step in days.
+    nSteps        -- the number of steps to perform.
+    numBodies     -- the number of bodies equal to len(bodyMasses).
+    bodyMasses    -- a NumPy ndarray of masses for each body.
+    currentPosits -- a NumPy ndarray of the current positions of all bodies,
+                     each element of which has in turn two dimensions: [x, y].
+    currentVels   -- a NumPy ndarray of the current velocities of all bodies,
+                     each element of which has in turn two dimensions: [x, y].
+    out           -- a NumPy ndarray of shape (nSteps//cadence, numBodies, 4)
+                     in which row k is given the state [x, y, vx, vy] of
+                     every body after (k + 1)*cadence steps.
+    cadence       -- the number of steps between rows of 'out'.
+    numMassive    -- the number of massive bodies, which come before the test
+                     particles, by default every body.
+
+    Returns:
+    nextPosits  -- a NumPy ndarray of the positions of all bodies after the
+                   steps, each element of which has two dimensions: [x, y].
+    nextVels    -- a NumPy ndarray of the velocities of all bodies after the
+                   steps, each element of which has two dimensions: [x, y].
+    """
+
+    coords, stages, partials = get_buffers(numBodies)
+    coords[:2] = currentPosits.T
+    coords[2:] = currentVels.T
+    if numMassive is None:
+        numMassive = numBodies
+    steps_kernel(stepSize, nSteps, cadence, numMassive, bodyMasses, coords[0],
+                 coords[1], coords[2], coords[3], partials, stages, out)
+    return coords[:2].T.copy(), coords[2:].T.copy()
+
+def choose_block(numBodies, nSteps, numMassive=None, maxValues=2**18,
+                 maxPairs=2**24):
+    """Return the number of steps for each call of make_steps.
+
+    Longer blocks spend less time in Python between calls, but hold more steps
+    in the output buffer and hand the steps on to be written less often. The
+    block is as long as possible with at most maxValues values in the buffer,
+    about 2 MB, and at most maxPairs interactions of the bodies with the
+    massive bodies, a few hundredths of a second of computing.
+    """
+    if numMassive is None:
+        numMassive = numBodies
+    return max(1, min(nSteps, maxValues//(4*numBodies),
+                      maxPairs//(numMassive*numBodies)))
+
+def calc_accels(numBodies, bodyMasses, posits, targets=None):
+    """Calculate the gravitational acceleration of every body, in parallel
+    over all bodies in the simulation using Numba.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+    targets    -- an optional NumPy ndarray of the indices of the bodies whose
+                  accelerations are wanted, by default every body.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, or of the
+              targets in the order given, each element of which has in turn
+              two dimensions: [x, y].
+    """
+    coords, _, partials = get_buffers(numBodies)
+    coords[:2] = posits.T
+    if targets is None:
+        accels = empty((2, numBodies))
+        symmetric_kernel(bodyMasses, coords[0], coords[1], partials,
+                         accels[0], accels[1])
+    else:
+        accels = empty((2, len(targets)))
+        accel_kernel(bodyMasses, coords[0], coords[1], targets, accels[0],
+                     accels[1])
+    return accels.T
+
+def test_accels(massMasses, massPosits, testPosits):
+    """Calculate the gravitational acceleration of test particles from the
+    massive bodies, in parallel over the particles using Numba, with the
+    arguments and results of testparticles.test_accels."""
+    accels = empty((2, len(testPosits)))
+    test_kernel(massMasses, massPosits[:, 0].copy(), massPosits[:, 1].copy(),
+                testPosits[:, 0].copy(), testPosits[:, 1].copy(), accels[0],
+                accels[1])
+    return accels.T
+
+def compile_kernels():
+    """Compile the kernels, or load them from the on-disk cache, by calling
+    them once for two bodies, returning the time taken in seconds."""
+    clock  = perf_counter()
+    masses = ones(2)
+    posits = arange(4.).reshape(2, 2)
+    calc_accels(2, masses, posits)
+    make_step(1., 2, masses, posits, posits, numMassive=1)
+    make_steps(1., 1, 2, masses, posits, posits, empty((1, 2, 4)),
+               numMassive=1)
+    test_accels(masses[:1], posits[:1], posits[1:])
+    # The buffers for two bodies are not wanted by the simulation
+    workBuffers['numBodies'] = -1
+    return perf_counter() - clock
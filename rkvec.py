@@ -0,0 +1,186 @@
+# Reference for discrete equations:
+# http://physics.bu.edu/py502/lectures3/cmotion.pdf
+
+from numpy import add, arange, ascontiguousarray, column_stack, divide, \
+                  empty, inf, matmul, multiply, newaxis, sqrt, subtract, \
+                  tril_indices, zeros
+
+from rknopar import convG
+from integrators import rk4_step
+
+# Pairs of bodies are taken in tiles of rows, each against the bodies from the
+# first row of the tile onwards, so that each pair is evaluated once. With few
+# bodies the extra NumPy calls cost more than is saved and every pair is
+# evaluated twice instead.
+tileRows = 256
+minSymmetric = 32
+tileBuffers = {'numBodies': -1}
+
+def get_tiles(numBodies):
+    """Return the four (tile, N) work buffers of the pairs in a tile of rows,
+    and the indices of the lower triangle of a square tile."""
+    if tileBuffers['numBodies'] != numBodies:
+        nRows = min(tileRows, numBodies)
+        tileBuffers['numBodies'] = numBodies
+        tileBuffers['work']      = empty((4, nRows, numBodies))
+        tileBuffers['lower']     = tril_indices(nRows)
+    return tileBuffers['work'], tileBuffers['lower']
+
+def symmetric_accels(numBodies, bodyMasses, posits):
+    """Calculate the gravitational acceleration of every body, evaluating the
+    force of each pair of bodies once and adding it to both bodies with
+    opposite signs.
+
+    The rows of each tile are the bodies i from the first row f to the last
+    row l, and the columns the bodies j from f onwards, so that each pair with
+    j > i is in exactly one tile; the pairs with j <= i in the square at the
+    start of the tile are masked by setting their squared distance to
+    infinity. The coordinates are kept as separate contiguous arrays of x and
+    y, and the sums over the rows and columns of a tile are products of a
+    matrix and a vector.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, each element
+              of which has in turn two dimensions: [x, y].
+    """
+
+    work, lower = get_tiles(numBodies)
+    x, y  = ascontiguousarray(posits[:, 0]), ascontiguousarray(posits[:, 1])
+    gMass = convG*bodyMasses
+    accX, accY = zeros(numBodies), zeros(numBodies)
+
+    for first in range(0, numBodies, tileRows):
+        last  = min(first + tileRows, numBodies)
+        nRows = last - first
+        sepX, sepY, rSq, invR3 = work[:, :nRows, :numBodies - first]
+
+        subtract(x[newaxis, first:], x[first:last, newaxis], out=sepX)
+        subtract(y[newaxis, first:], y[first:last, newaxis], out=sepY)
+        multiply(sepX, sepX, out=rSq)
+        multiply(sepY, sepY, out=invR3)
+        add(rSq, invR3, out=rSq)
+        rSq[lower if nRows == len(work[0]) else tril_indices(nRows)] = inf
+
+        # The force per unit mass of each pair, 1/|r_ij|^3 times r_ij
+        sqrt(rSq, out=invR3)
+        multiply(invR3, rSq, out=invR3)
+        divide(1., invR3, out=invR3)
+        multiply(sepX, invR3, out=sepX)
+        multiply(sepY, invR3, out=sepY)
+
+        # Body i is pulled towards j by G m_j, and body j away from i by G m_i
+        accX[first:last] += matmul(sepX, gMass[first:])
+        accY[first:last] += matmul(sepY, gMass[first:])
+        accX[first:]     -= matmul(gMass[first:last], sepX)
+        accY[first:]     -= matmul(gMass[first:last], sepY)
+
+    return column_stack((accX, accY))
+
+def target_accels(numBodies, bodyMasses, posits, targets):
+    """Calculate the gravitational acceleration of the targets from every
+    body, taking the targets in tiles of rows against all of the bodies, so
+    that the work buffers hold 256 x N values however many targets there are.
+
+    Arguments are as for symmetric_accels, with the addition of:
+    targets -- a NumPy ndarray of the indices of the bodies whose
+               accelerations are wanted.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of the targets in the order
+              given, each element of which has in turn two dimensions: [x, y].
+    """
+
+    work, _ = get_tiles(numBodies)
+    x, y  = ascontiguousarray(posits[:, 0]), ascontiguousarray(posits[:, 1])
+    gMass = convG*bodyMasses
+    nTargets = len(targets)
+    accX, accY = empty(nTargets), empty(nTargets)
+
+    for first in range(0, nTargets, tileRows):
+        last  = min(first + tileRows, nTargets)
+        rows  = targets[first:last]
+        nRows = last - first
+        sepX, sepY, rSq, invR3 = work[:, :nRows]
+
+        # sepX[i, j] is the x distance from target i to body j
+        subtract(x[newaxis, :], x[rows, newaxis], out=sepX)
+        subtract(y[newaxis, :], y[rows, newaxis], out=sepY)
+        multiply(sepX, sepX, out=rSq)
+        multiply(sepY, sepY, out=invR3)
+        add(rSq, invR3, out=rSq)
+        rSq[arange(nRows), rows] = inf
+
+        # G m_j / |r_ij|^3, zero for the target itself
+        sqrt(rSq, out=invR3)
+        multiply(invR3, rSq, out=invR3)
+        divide(1., invR3, out=invR3)
+        multiply(sepX, invR3, out=sepX)
+        multiply(sepY, invR3, out=sepY)
+        accX[first:last] = matmul(sepX, gMass)
+        accY[first:last] = matmul(sepY, gMass)
+
+    return column_stack((accX, accY))
+
+def calc_accels(numBodies, bodyMasses, posits, targets=None):
+    """Calculate the gravitational acceleration of every body at once.
+
+    For all bodies, unless there are only a few, each pair of bodies is
+    evaluated once by symmetric_accels. Otherwise the accelerations of the
+    targets, or of every body, are summed over all bodies by target_accels.
+
+    Arguments:
+    numBodies  -- the number of bodies equal to len(bodyMasses).
+    bodyMasses -- a NumPy ndarray of masses for each body.
+    posits     -- a NumPy ndarray of the positions of all bodies, each element
+                  of which has in turn two dimensions: [x, y].
+    targets    -- an optional NumPy ndarray of the indices of the bodies whose
+                  accelerations are wanted, by default every body.
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of all bodies, or of the
+              targets in the order given, each element of which has in turn
+              two dimensions: [x, y].
+    """
+
+    if targets is None:
+        if numBodies >= minSymmetric:
+            return symmetric_accels(numBodies, bodyMasses, posits)
+        targets = arange(numBodies)
+    return target_accels(numBodies, bodyMasses, posits, targets)
+
+def make_step(stepSize, numBodies, bodyMasses, currentPosits, currentVels):
+    """Perform a forward step using the fourth-order Runge-Kutta method, with
+    each stage vectorised over all bodies using NumPy.
+
+    This function takes the current positions and velocities of a number of
+    bodies and performs a single forward time step of Netwon's gravitational
+    equations of motion using the 4th order Runge-Kutta method for all bodies.
+
+    Arguments:
+    stepSize      -- the size of the time step in days.
+    numBodies     -- the number of bodies equal to len(bodyMasses).
+    bodyMasses    -- a NumPy ndarray of masses for each body.
+    currentPosits -- a NumPy ndarray of the current positions of all bodies,
+                     each element of which has in turn two dimensions: [x, y].
+    currentVels   -- a NumPy ndarray of the current velocities of all bodies,
+                     each element of which has in turn two dimensions: [x, y].
+
+    Returns:
+    nextPosits -- a NumPy ndarray of the next positions of all bodies, each
+                  element of which has in turn two dimensions: [x, y].
+    nextVels   -- a NumPy ndarray of the next velocities of all bodies, each
+                  element of which has in turn two dimensions: [x, y].
+
+    Note, the order of the position and velocities vectors for each mass in the
+    arguments 'currentPosits' and 'currentVels' must be the same as the order
+    of masses in 'bodyMasses'. The return arrays also have the same ordering.
+    """
+
+    return rk4_step(stepSize, numBodies, bodyMasses, currentPosits,
+                    currentVels, calc_accels)
@@ -0,0 +1,323 @@
+# Sinks receive the state of the simulation after every step from the main
+# loop, which keeps only the current state, so that the memory used by a
+# simulation does not grow with the number of steps.
+#
+# Every sink has a method write(step, time, posits, vels), called once for
+# the initial conditions as step 0 and then once after every step, and a
+# method close(), called once the simulation is complete. For checkpoints,
+# the method checkpoint() returns a dictionary of the state of the sink, after
+# making sure that everything written so far is on disk, and the method
+# restore(state) returns a new sink to that state when a simulation resumes.
+# Writers of step files may also have a method write_block(steps, times,
+# posits, vels), which writes many steps at once.
+
+from os import fsync
+from queue import Empty, Queue
+from threading import Thread
+from time import perf_counter
+
+from numpy import absolute, amax, arange, array, empty, newaxis, \
+                  searchsorted, sqrt
+
+from rknopar import convG
+
+sci2 = '.2e'
+sci8 = '.8e'
+ws6  = '      '
+ws2  = '  '
+
+class StepWriter:
+    """Write the time and the state of every body as one row of the '.steps'
+    file for each step, below a line with the names of the bodies. The
+    initial conditions are not written.
+
+    The format of a whole row is built once, so that each row is formatted
+    with a single call rather than one per body.
+    """
+    def __init__(self, stepFile, names):
+        self.stepFile = stepFile
+        print(*names, file=stepFile)
+        bodStr = "{{:{0}}}{1}{{:{0}}}{1}{{:{0}}}{1}{{:{0}}}{2}".format(sci8, ws2, ws6)
+        self.rowStr = "{{:{0}}}{1}".format(sci8, ws6) + bodStr*len(names) + "\n"
+        self.row = None
+
+    def write(self, step, time, posits, vels):
+        if step == 0:
+            return
+        if self.row is None:
+            self.row = empty((len(posits), 4))
+        self.row[:, :2] = posits
+        self.row[:, 2:] = vels
+        self.stepFile.write(self.rowStr.format(time, *self.row.ravel().tolist()))
+
+    def write_block(self, steps, times, posits, vels):
+        """Write many steps at once, with a single write to the file."""
+        first = 1 if steps[0] == 0 else 0
+        nRows = len(times) - first
+        if nRows == 0:
+            return
+        rows  = empty((nRows, 1 + 4*len(posits[0])))
+        rows[:, 0] = times[first:]
+        state = rows[:, 1:].reshape(nRows, -1, 4)
+        state[:, :, :2] = posits[first:]
+        state[:, :, 2:] = vels[first:]
+        self.stepFile.write((self.rowStr*nRows).format(*rows.ravel().tolist()))
+
+    def checkpoint(self):
+        return sync_file(self.stepFile)
+
+    def restore(self, state):
+        truncate_file(self.stepFile, state)
+
+    def close(self):
+        self.stepFile.close()
+
+# Values held by each block of an AsyncWriter, unless a block size is given
+blockValues = 2**18
+
+class AsyncWriter:
+    """Pass the steps to a step writer on a background thread, so that the
+    formatting and writing of the steps overlap with the simulation.
+
+    The steps are copied into blocks of 'blockSteps' steps, and each full
+    block is handed to the thread, which passes it to the method
+    write_block(steps, times, posits, vels) of the writer if it has one, or to
+    write() one step at a time. There are 'nBlocks' blocks, which are reused,
+    so the simulation waits only when every block is full and waiting to be
+    written. The number and length of these stalls, and the rate at which the
+    thread wrote the steps, are written to outFile when the writer is closed.
+
+    Checkpoints wait for every step so far to be written first.
+    """
+    def __init__(self, sink, nBodies, outFile, blockSteps=None, nBlocks=4):
+        self.sink    = sink
+        self.outFile = outFile
+        if blockSteps is None:
+            blockSteps = max(1, blockValues // (4*nBodies))
+        self.free = Queue()
+        for _ in range(nBlocks):
+            self.free.put({'steps': empty(blockSteps, dtype=int),
+                           'times': empty(blockSteps),
+                           'posits': empty((blockSteps, nBodies, 2)),
+                           'vels': empty((blockSteps, nBodies, 2))})
+        self.full    = Queue()
+        self.block   = None
+        self.nBlock  = 0
+        self.nSteps  = 0
+        self.nStalls = 0
+        self.stalled = 0.
+        self.busy    = 0.
+        self.error   = None
+        self.thread  = Thread(target=self.run, name='neo-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Write every block handed to the thread, until None is handed."""
+        while True:
+            item = self.full.get()
+            if item is None:
+                self.full.task_done()
+                return
+            block, n = item
+            start = perf_counter()
+            # After an error the blocks are still returned, so that the
+            # simulation does not wait forever, and the error is raised there
+            if self.error is None:
+                try:
+                    if hasattr(self.sink, 'write_block'):
+                        self.sink.write_block(block['steps'][:n],
+                                              block['times'][:n],
+                                              block['posits'][:n],
+                                              block['vels'][:n])
+                    else:
+                        for k in range(n):
+                            self.sink.write(block['steps'][k],
+                                            block['times'][k],
+                                            block['posits'][k],
+                                            block['vels'][k])
+                except BaseException as error:
+                    self.error = error
+            self.busy += perf_counter() - start
+            self.free.put(block)
+            self.full.task_done()
+
+    def check(self):
+        """Raise any error of the thread in the simulation."""
+        if self.error is not None:
+            raise self.error
+
+    def write(self, step, time, posits, vels):
+        if self.block is None:
+            try:
+                self.block = self.free.get_nowait()
+            except Empty:
+                start = perf_counter()
+                self.block = self.free.get()
+                self.stalled += perf_counter() - start
+                self.nStalls += 1
+            self.check()
+        block, n = self.block, self.nBlock
+        block['steps'][n]  = step
+        block['times'][n]  = time
+        block['posits'][n] = posits
+        block['vels'][n]   = vels
+        self.nBlock += 1
+        self.nSteps += 1
+        if self.nBlock == len(block['times']):
+            self.hand_over()
+
+    def hand_over(self):
+        """Hand the current block, if it has any steps, to the thread."""
+        if self.nBlock:
+            self.full.put((self.block, self.nBlock))
+        elif self.block is not None:
+            self.free.put(self.block)
+        self.block, self.nBlock = None, 0
+
+    def checkpoint(self):
+        self.hand_over()
+        self.full.join()
+        self.check()
+        return self.sink.checkpoint()
+
+    def restore(self, state):
+        self.sink.restore(state)
+
+    def close(self):
+        self.hand_over()
+        self.full.put(None)
+        self.thread.join()
+        self.check()
+        self.sink.close()
+        print("The steps were written on a background thread, {0} steps in "
+              "{1:.2f} s of writing, {2:.0f} steps per second. The simulation "
+              "waited for the writer {3} times, for {4:.2f} s in all."
+              .format(self.nSteps, self.busy,
+                      self.nSteps/self.busy if self.busy else 0.,
+                      self.nStalls, self.stalled), file=self.outFile)
+
+def sync_file(stepFile):
+    """Flush a step file to disk, returning its length as the 'offset'."""
+    stepFile.flush()
+    fsync(stepFile.fileno())
+    return {'offset': stepFile.tell()}
+
+def truncate_file(stepFile, state):
+    """Discard everything in a step file after the 'offset' of a checkpoint,
+    which was written after the checkpoint, so that writing continues from
+    the step of the checkpoint."""
+    stepFile.seek(state['offset'])
+    stepFile.truncate()
+
+class FrameCollector:
+    """Keep the positions of the bodies at the frames of the animation.
+
+    Each frame time takes the first step at or after it, or if no frame times
+    are given every step is a frame. The largest coordinate of any body over
+    all steps is kept in 'extent', for the window of the animation.
+    """
+    def __init__(self, frameTimes=None):
+        self.frameTimes = frameTimes
+        self.frames = []
+        self.times  = []
+        self.extent = 0.
+
+    def write(self, step, time, posits, vels):
+        self.extent = max(self.extent, amax(absolute(posits)))
+        if self.frameTimes is None:
+            self.frames.append(posits.copy())
+            self.times.append(time)
+            return
+        while len(self.frames) < len(self.frameTimes) \
+        and time >= self.frameTimes[len(self.frames)]:
+            self.frames.append(posits.copy())
+            self.times.append(time)
+
+    def checkpoint(self):
+        return {'frames': array(self.frames), 'times': array(self.times),
+                'extent': self.extent}
+
+    def restore(self, state):
+        """Restore the frames of a checkpoint. If the frame times have changed
+        with the duration of the simulation, each new frame takes the first
+        frame of the checkpoint at or after its time."""
+        self.extent = state['extent']
+        oldFrames, oldTimes = list(state['frames']), state['times']
+        if self.frameTimes is None:
+            self.frames, self.times = oldFrames, list(oldTimes)
+            return
+        for frameTime in self.frameTimes:
+            i = searchsorted(oldTimes, frameTime)
+            if i == len(oldTimes):
+                break
+            self.frames.append(oldFrames[i])
+            self.times.append(oldTimes[i])
+
+    def close(self):
+        pass
+
+def total_energy(masses, posits, vels, chunkSize=1024):
+    """Return the total kinetic and potential energy of the bodies, in units
+    of Earth masses au^2 per day^2, summing the potential over chunks of bodies
+    so that no more than chunkSize x N separations are held at once."""
+    kinetic   = 0.5*(masses*(vels**2).sum(axis=1)).sum()
+    potential = 0.
+    # Bodies without mass add no potential, and may share positions
+    massive = masses != 0.
+    masses, posits = masses[massive], posits[massive]
+    for first in range(0, len(masses), chunkSize):
+        rows = arange(first, min(first + chunkSize, len(masses)))
+        sep  = posits[newaxis, :, :] - posits[rows, newaxis, :]
+        dist = sqrt((sep**2).sum(axis=2))
+        # Count each pair once, from the body with the lower index
+        dist[rows[:, newaxis] >= arange(len(masses))[newaxis, :]] = float('inf')
+        potential -= convG*(masses[rows, newaxis]*masses[newaxis, :]/dist).sum()
+    return kinetic + potential
+
+class Diagnostics:
+    """Check the conservation of the total energy and momentum of the bodies
+    every 'interval' steps, and report the largest relative changes to the
+    output file when closed. Each check sums over every pair of bodies."""
+    def __init__(self, masses, interval, outFile):
+        self.masses   = masses
+        self.interval = interval
+        self.outFile  = outFile
+        self.nChecks  = 0
+        self.energyError   = 0.
+        self.momentumError = 0.
+
+    def write(self, step, time, posits, vels):
+        if step % self.interval != 0:
+            return
+        energy   = total_energy(self.masses, posits, vels)
+        momentum = (self.masses[:, newaxis]*vels).sum(axis=0)
+        if self.nChecks == 0:
+            self.energy0   = energy
+            self.momentum0 = momentum
+            # Momentum changes are relative to the sum of the momentum sizes
+            self.momentumScale = (self.masses*sqrt((vels**2).sum(axis=1))).sum() \
+                                 or 1.
+        else:
+            self.energyError = max(self.energyError,
+                                   abs((energy - self.energy0)/self.energy0))
+            self.momentumError = max(self.momentumError,
+                                     sqrt(((momentum - self.momentum0)**2).sum())
+                                     / self.momentumScale)
+        self.nChecks += 1
+        self.time = time
+
+    def checkpoint(self):
+        return {key: getattr(self, key) for key in
+                ['nChecks', 'energyError', 'momentumError', 'energy0',
+                 'momentum0', 'momentumScale', 'time']}
+
+    def restore(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def close(self):
+        print("Diagnostics from {1} checks up to {3:{0}} days:"
+              "\n  Largest relative change of the energy   = {2:{0}}"
+              "\n  Largest relative change of the momentum = {4:{0}}"
+              .format(sci2, self.nChecks, self.energyError, self.time,
+                      self.momentumError), file=self.outFile)
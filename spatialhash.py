@@ -0,0 +1,58 @@
+# A spatial hash finds every pair of bodies closer than a given radius without
+# testing every pair. The plane is divided into square cells no smaller than
+# the radius, so that a close pair is always in the same or neighbouring
+# cells, and the bodies are sorted by the key of their cell so that the bodies
+# of any cell are found by a binary search.
+
+from numpy import arange, argsort, concatenate, cumsum, floor, int64, repeat, \
+                  searchsorted, sqrt
+
+# Each pair of neighbouring cells is searched once, from the cell on its left
+# or below it, and the cell itself
+halfShell = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+def close_pairs(posits, radius):
+    """Return every pair of bodies closer than radius.
+
+    Arguments:
+    posits -- a NumPy ndarray of the positions of all bodies, each element of
+              which has in turn two dimensions: [x, y].
+    radius -- the largest separation of the pairs to return.
+
+    Returns:
+    first, second -- NumPy ndarrays of the indices of the two bodies of each
+                     pair, with first < second.
+    """
+
+    numBodies = len(posits)
+    corner = posits.min(axis=0)
+    span   = (posits.max(axis=0) - corner).max()
+    # Cells are made larger if needed so that the keys fit in 64 bits
+    size   = max(radius, span/2**30) or 1.
+    cells  = floor((posits - corner)/size).astype(int64)
+    keys   = cells[:, 0]*2**32 + cells[:, 1]
+    order  = argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    firsts, seconds = [], []
+    for dx, dy in halfShell:
+        neighbours = (cells[:, 0] + dx)*2**32 + cells[:, 1] + dy
+        start  = searchsorted(sortedKeys, neighbours, side='left')
+        counts = searchsorted(sortedKeys, neighbours, side='right') - start
+        # Every body i against the run of sorted bodies in its neighbour cell
+        first  = repeat(arange(numBodies), counts)
+        offset = arange(counts.sum()) - repeat(cumsum(counts) - counts, counts)
+        second = order[repeat(start, counts) + offset]
+        if dx == 0 and dy == 0:
+            keep = first < second
+            first, second = first[keep], second[keep]
+        firsts.append(first)
+        seconds.append(second)
+    first, second = concatenate(firsts), concatenate(seconds)
+
+    sep  = posits[second] - posits[first]
+    keep = sqrt((sep**2).sum(axis=1)) < radius
+    first, second = first[keep], second[keep]
+    swap = first > second
+    first[swap], second[swap] = second[swap], first[swap]
+    return first, second
@@ -0,0 +1,421 @@
+# Binary step files, an alternative to the text '.steps' file which is
+# written in bulk and can be read back as a memory map.
+#
+# A binary step file begins with the 8 byte magic string b'NEOSTEPS', then a
+# little-endian uint32 giving the length of a JSON header, then the header
+# itself padded with spaces so that the data begins on a 64 byte boundary.
+# The header holds the format 'version', the 'names' of the bodies, the
+# 'dtype' of the data, the number of bodies 'nBodies' and of steps 'nSteps',
+# the time step 'dt' in days (null when it varies), and the 'columns' of each
+# body. The data follows as one record of float64 values per step, the time
+# of the step in days followed by x, y, vx, vy for every body in turn.
+#
+# A compressed step file stores the same steps to a given absolute error. It
+# begins with the magic string b'NEOCSTEP' and a header as above, which also
+# holds the largest errors 'posError' in au and 'velError' in au per day, the
+# 'codec' of the chunks, 'zlib' or 'lzma', and the 'indexOffset' of the chunk
+# index. Each coordinate is rounded to an integer multiple of twice its
+# largest error, so that it is recovered to within that error. The steps are
+# stored in chunks, each compressed on its own: the float64 times of the
+# steps, then the second differences of the integers along the steps, taking
+# the integers before the chunk as zero, which are small for smooth orbits.
+# These are zigzag encoded, 0, -1, 1, -2, ... as 0, 1, 2, 3, ..., so that
+# small negative values have zero high bytes, and stored as 64-bit integers
+# with the bytes of each significance together, as are the bytes of the times.
+# The chunk index at the end of the file gives the offset, length, first step
+# and number of steps of every chunk as uint64, so that any step may be read
+# by decompressing only its chunk.
+
+import sys
+import argparse
+import json
+import lzma
+import zlib
+from os import path
+
+from numpy import abs as npabs
+from numpy import array, concatenate, cumsum, diff, dtype, empty, frombuffer, \
+                  int64, memmap, rint, searchsorted, uint64, uint8
+
+from sinks import sync_file, truncate_file
+
+magic   = b'NEOSTEPS'
+compressedMagic = b'NEOCSTEP'
+version = 1
+columns = ['x', 'y', 'vx', 'vy']
+
+# Steps buffered before each bulk write, the buffer holds at most about this
+# many values
+bufferSize = 2**19
+
+def step_dtype(nBodies):
+    """Return the NumPy dtype of one step of a binary step file."""
+    return dtype([('time', '<f8'), ('state', '<f8', (nBodies, len(columns)))])
+
+def make_header(names, nSteps, dt, size=None, fileMagic=magic, **extra):
+    """Return the encoded header, with any extra entries, padded with spaces
+    to 'size' bytes in all. By default the size leaves room for the largest
+    step count and offset and aligns the data to 64 bytes."""
+    text = json.dumps({'version': version, 'names': list(names),
+                       'dtype': '<f8', 'nBodies': len(names),
+                       'nSteps': nSteps, 'dt': dt, 'columns': columns, **extra})
+    if size is None:
+        size  = len(fileMagic) + 4 + len(text) + 40
+        size += -size % 64
+    text += ' '*(size - len(fileMagic) - 4 - len(text))
+    return fileMagic + len(text).to_bytes(4, 'little') + text.encode()
+
+class BinaryStepWriter:
+    """Write each step after the first as one record of a binary step file.
+
+    Steps are gathered in a buffer and written to the file in bulk. The number
+    of steps in the header is filled in when the file is closed, so a file
+    that was never closed says null, and the reader counts the steps from the
+    size of the file instead.
+    """
+    def __init__(self, stepFile, names, dt=None):
+        self.stepFile = stepFile
+        self.names    = list(names)
+        self.dt       = dt
+        self.header   = make_header(self.names, None, dt)
+        stepFile.write(self.header)
+        self.nSteps   = 0
+        self.buffer   = empty(max(1, bufferSize // (1 + 4*len(self.names))),
+                              dtype=step_dtype(len(self.names)))
+        self.nBuffer  = 0
+
+    def write(self, step, time, posits, vels):
+        if step == 0:
+            return
+        record = self.buffer[self.nBuffer]
+        record['time'] = time
+        record['state'][:, :2] = posits
+        record['state'][:, 2:] = vels
+        self.nBuffer += 1
+        self.nSteps  += 1
+        if self.nBuffer == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.buffer[:self.nBuffer].tofile(self.stepFile)
+        self.nBuffer = 0
+
+    def checkpoint(self):
+        self.flush()
+        return {**sync_file(self.stepFile), 'nSteps': self.nSteps}
+
+    def restore(self, state):
+        truncate_file(self.stepFile, state)
+        self.nSteps = state['nSteps']
+
+    def close(self):
+        self.flush()
+        self.stepFile.seek(0)
+        self.stepFile.write(make_header(self.names, self.nSteps, self.dt,
+                                        len(self.header)))
+        self.stepFile.close()
+
+def read_header(fileName, fileMagic=magic):
+    """Return the header of a binary step file as a dictionary, with the
+    number of bytes before the data as 'offset'."""
+    with open(fileName, 'rb') as stepFile:
+        if stepFile.read(len(fileMagic)) != fileMagic:
+            raise ValueError("'{0}' is not a {1} step file."
+                             .format(fileName, "binary" if fileMagic == magic
+                                               else "compressed"))
+        length = int.from_bytes(stepFile.read(4), 'little')
+        header = json.loads(stepFile.read(length).decode())
+    header['offset'] = len(fileMagic) + 4 + length
+    if fileMagic == magic and header['nSteps'] is None:
+        header['nSteps'] = ((path.getsize(fileName) - header['offset'])
+                            // step_dtype(header['nBodies']).itemsize)
+    return header
+
+def read_steps(fileName, mode='r'):
+    """Open a binary step file as a memory map, without reading its data.
+
+    Arguments:
+    fileName -- the name of the binary step file.
+    mode     -- the mode of the memory map, 'r' for read only.
+
+    Returns:
+    header -- a dictionary of the header of the file, see read_header.
+    steps  -- a NumPy memmap of one record per step, whose field 'time' has
+              shape (nSteps,) and field 'state' shape (nSteps, nBodies, 4),
+              with the last axis x, y, vx, vy. For example the positions of
+              the second body over the last 100 steps are
+              steps['state'][-100:, 1, :2].
+    """
+    header = read_header(fileName)
+    steps  = memmap(fileName, dtype=step_dtype(header['nBodies']), mode=mode,
+                    offset=header['offset'], shape=(header['nSteps'],))
+    return header, steps
+
+codecs = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+          'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress)}
+
+# Largest number of values held by a chunk when the chunk size is automatic
+chunkValues = 2**20
+
+def shuffle_bytes(values):
+    """Return the bytes of a 64-bit array grouped by significance, so that
+    the mostly zero high bytes of small integers compress together."""
+    return values.view(uint8).reshape(-1, 8).T.tobytes()
+
+def unshuffle_bytes(data, shape, dataType=int64):
+    """Return the 64-bit array of the given shape from shuffled bytes."""
+    count = len(data)//8
+    return frombuffer(data, dtype=uint8).reshape(8, count).T.copy() \
+           .view(dataType).reshape(shape)
+
+class CompressedStepWriter:
+    """Write each step after the first to a compressed step file, with the
+    positions to within posError au and the velocities to within velError au
+    per day.
+
+    Steps are gathered into chunks of 'chunkSteps' steps, by default as many
+    as hold about a million values, and each full chunk is quantized,
+    differenced and compressed with the 'codec', 'zlib' or 'lzma'. The chunk
+    index and the step count are written when the file is closed.
+    """
+    def __init__(self, stepFile, names, dt, posError, velError, codec='zlib',
+                 chunkSteps=None):
+        self.stepFile = stepFile
+        self.names    = list(names)
+        self.dt       = dt
+        self.posError = posError
+        self.velError = velError
+        self.codec    = codec
+        self.compress = codecs[codec][0]
+        nBodies = len(self.names)
+        if chunkSteps is None:
+            chunkSteps = max(1, chunkValues // (4*nBodies))
+        self.times  = empty(chunkSteps)
+        self.states = empty((chunkSteps, nBodies, 4))
+        self.step   = array([2*posError, 2*posError, 2*velError, 2*velError])
+        self.nBuffer = 0
+        self.nSteps  = 0
+        self.index   = []
+        self.header  = self.make_header(None, None)
+        stepFile.write(self.header)
+
+    def make_header(self, nSteps, indexOffset, size=None):
+        return make_header(self.names, nSteps, self.dt, size, compressedMagic,
+                           posError=self.posError, velError=self.velError,
+                           codec=self.codec, chunkSteps=len(self.times),
+                           indexOffset=indexOffset)
+
+    def write(self, step, time, posits, vels):
+        if step == 0:
+            return
+        self.times[self.nBuffer] = time
+        self.states[self.nBuffer, :, :2] = posits
+        self.states[self.nBuffer, :, 2:] = vels
+        self.nBuffer += 1
+        if self.nBuffer == len(self.times):
+            self.flush()
+
+    def flush(self):
+        if self.nBuffer == 0:
+            return
+        states = self.states[:self.nBuffer]/self.step
+        # Integers beyond 2^62 could overflow when differenced
+        if npabs(states).max() >= 2.**62:
+            raise OverflowError("A coordinate is too large to store to the "
+                                "requested error.")
+        quanta = rint(states).astype(int64)
+        # Differencing twice from zero is undone by summing twice
+        quanta = diff(diff(quanta, axis=0, prepend=0), axis=0, prepend=0)
+        quanta = (quanta << 1) ^ (quanta >> 63)
+        data = self.compress(shuffle_bytes(self.times[:self.nBuffer])
+                             + shuffle_bytes(quanta))
+        self.index.append((self.stepFile.tell(), len(data), self.nSteps,
+                           self.nBuffer))
+        self.stepFile.write(data)
+        self.nSteps += self.nBuffer
+        self.nBuffer = 0
+
+    def checkpoint(self):
+        """Compress the steps gathered so far as a shorter chunk, and return
+        the state of the writer."""
+        self.flush()
+        return {**sync_file(self.stepFile), 'nSteps': self.nSteps,
+                'index': array(self.index, dtype=uint64).reshape(-1, 4)}
+
+    def restore(self, state):
+        truncate_file(self.stepFile, state)
+        self.nSteps = state['nSteps']
+        self.index  = [tuple(chunk) for chunk in state['index'].tolist()]
+
+    def close(self):
+        self.flush()
+        indexOffset = self.stepFile.tell()
+        array(self.index, dtype=uint64).reshape(-1, 4).tofile(self.stepFile)
+        self.stepFile.seek(0)
+        self.stepFile.write(self.make_header(self.nSteps, indexOffset,
+                                             len(self.header)))
+        self.stepFile.close()
+
+class CompressedSteps:
+    """Read the steps of a compressed step file, decompressing only the
+    chunks that hold the steps wanted.
+
+    The positions and velocities returned are within the 'posError' and
+    'velError' of the header of those written, apart from the rounding of the
+    float64 values themselves. The file must have been closed by its writer.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.header   = read_header(fileName, compressedMagic)
+        if self.header['indexOffset'] is None:
+            raise ValueError("'{0}' was not closed, it has no chunk index."
+                             .format(fileName))
+        self.decompress = codecs[self.header['codec']][1]
+        self.step  = array([2*self.header['posError']]*2
+                           + [2*self.header['velError']]*2)
+        with open(fileName, 'rb') as stepFile:
+            stepFile.seek(self.header['indexOffset'])
+            self.index = frombuffer(stepFile.read(), dtype=uint64) \
+                         .reshape(-1, 4).astype(int64)
+
+    def __len__(self):
+        return self.header['nSteps']
+
+    def read_chunk(self, chunk):
+        """Return the times and states of the steps of one chunk."""
+        offset, length, first, count = self.index[chunk]
+        with open(self.fileName, 'rb') as stepFile:
+            stepFile.seek(offset)
+            data = self.decompress(stepFile.read(length))
+        times  = unshuffle_bytes(data[:8*count], count, float)
+        quanta = unshuffle_bytes(data[8*count:],
+                                 (count, self.header['nBodies'], 4))
+        quanta = (quanta >> 1) ^ -(quanta & 1)
+        quanta = cumsum(cumsum(quanta, axis=0), axis=0)
+        return times, quanta*self.step
+
+    def read(self, start=0, stop=None):
+        """Return the steps from 'start' up to but not including 'stop'.
+
+        Returns:
+        times  -- a NumPy ndarray of the time of each step in days.
+        states -- a NumPy ndarray of shape (steps, nBodies, 4) of x, y, vx, vy
+                  for every body at each step.
+        """
+        stop  = len(self) if stop is None else min(stop, len(self))
+        start = min(start, stop)
+        first = searchsorted(self.index[:, 2], start, side='right') - 1
+        last  = searchsorted(self.index[:, 2], stop, side='left')
+        times, states = [empty(0)], [empty((0, self.header['nBodies'], 4))]
+        for chunk in range(max(first, 0), last):
+            chunkTimes, chunkStates = self.read_chunk(chunk)
+            lower = max(start - self.index[chunk, 2], 0)
+            upper = stop - self.index[chunk, 2]
+            times.append(chunkTimes[lower:upper])
+            states.append(chunkStates[lower:upper])
+        return concatenate(times), concatenate(states)
+
+def convert_text(textName, outName, dt=None, posError=None, velError=None,
+                 codec='zlib'):
+    """Convert a text '.steps' file into a binary step file, or a compressed
+    step file if the errors are given, one line at a time so that the text
+    file need not fit in memory.
+
+    Text files written before the time of each step was recorded have four
+    columns per body and no time column, their times are taken as the step
+    number multiplied by dt, or simply the step number if dt is not given.
+
+    Arguments:
+    textName -- the name of the text step file.
+    outName  -- the name of the binary or compressed step file to write.
+    dt       -- the time step of old text files without times, in days.
+    posError, velError, codec -- the largest errors and the codec of a
+                compressed step file, see CompressedStepWriter.
+
+    Returns:
+    nSteps -- the number of steps converted.
+    """
+    with open(textName, 'r') as textFile:
+        names  = textFile.readline().split()
+        nBodies = len(names)
+        if posError is None:
+            writer = BinaryStepWriter(open(outName, 'wb'), names, dt)
+        else:
+            writer = CompressedStepWriter(open(outName, 'wb'), names, dt,
+                                          posError, velError, codec)
+        for step, line in enumerate(textFile, start=1):
+            values = array(line.split(), dtype=float)
+            if len(values) == 4*nBodies:
+                time   = step*dt if dt is not None else float(step)
+                values = values.reshape(nBodies, 4)
+            elif len(values) == 1 + 4*nBodies:
+                time   = values[0]
+                values = values[1:].reshape(nBodies, 4)
+            else:
+                writer.close()
+                raise ValueError("Line {0} of '{1}' has {2} values, expected "
+                                 "{3} or {4}.".format(step + 1, textName,
+                                 len(values), 4*nBodies, 1 + 4*nBodies))
+            writer.write(step, time, values[:, :2], values[:, 2:])
+        writer.close()
+    return writer.nSteps
+
+def compress_binary(binName, outName, posError, velError, codec='zlib'):
+    """Convert a binary step file into a compressed step file, reading it a
+    chunk at a time. Arguments are as for convert_text.
+
+    Returns:
+    nSteps -- the number of steps converted.
+    """
+    header, steps = read_steps(binName)
+    writer = CompressedStepWriter(open(outName, 'wb'), header['names'],
+                                  header['dt'], posError, velError, codec)
+    chunkSteps = len(writer.times)
+    for first in range(0, len(steps), chunkSteps):
+        chunk = steps[first:first + chunkSteps]
+        writer.times[:len(chunk)]  = chunk['time']
+        writer.states[:len(chunk)] = chunk['state']
+        writer.nBuffer = len(chunk)
+        writer.flush()
+    writer.close()
+    return writer.nSteps
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser(description=
+            "Convert a text '.steps' file into a binary '.bsteps' file, or a "
+            "text or binary step file into a compressed '.csteps' file if "
+            "the errors are given.")
+    parse.add_argument('stepfile', type=str, help=
+                       "The step file to convert, '.steps' or '.bsteps' suffix.")
+    parse.add_argument('-o', '--outfile', default=None, type=str, help=
+                       "The step file to write, by default the same name with "
+                       "a '.bsteps' or '.csteps' suffix.")
+    parse.add_argument('--dt', default=None, type=float, help=
+                       "Time step in days, for old files without a time "
+                       "column.")
+    parse.add_argument('--poserror', default=None, type=float, help=
+                       "Largest error of the compressed positions in au.")
+    parse.add_argument('--velerror', default=None, type=float, help=
+                       "Largest error of the compressed velocities in au per "
+                       "day, by default the position error per day.")
+    parse.add_argument('--codec', default='zlib', choices=list(codecs), help=
+                       "Compression of the chunks of a compressed file.")
+    args = parse.parse_args()
+
+    if args.velerror is not None and args.poserror is None:
+        sys.exit("The velocity error requires a position error.")
+    velError = args.poserror if args.velerror is None else args.velerror
+    isBinary = open(args.stepfile, 'rb').read(len(magic)) == magic
+    if isBinary and args.poserror is None:
+        sys.exit("A binary step file can only be converted into a compressed "
+                 "step file, give '--poserror'.")
+    suffix  = ".bsteps" if args.poserror is None else ".csteps"
+    outName = args.outfile or path.splitext(args.stepfile)[0] + suffix
+    if isBinary:
+        nSteps = compress_binary(args.stepfile, outName, args.poserror,
+                                 velError, args.codec)
+    else:
+        nSteps = convert_text(args.stepfile, outName, args.dt, args.poserror,
+                              velError, args.codec)
+    print("Converted {0} steps from '{1}' to '{2}'."
+          .format(nSteps, args.stepfile, outName), file=sys.stdout)
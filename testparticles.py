@@ -0,0 +1,97 @@
+# Test particles feel the gravity of the massive bodies but exert none, so
+# that a belt or cloud of T particles around M massive bodies costs M x T
+# interactions rather than (M + T)^2.
+#
+# The massive bodies are always the first in the simulation and the test
+# particles follow them. The accelerations of the massive bodies come from the
+# chosen engine, given only the massive bodies, and those of the particles from
+# a separate kernel over the pairs of particles and massive bodies.
+
+from numpy import add, ascontiguousarray, column_stack, divide, empty, \
+                  flatnonzero, multiply, newaxis, sqrt, subtract
+
+from rknopar import convG
+
+def test_accels(massMasses, massPosits, testPosits, chunkPairs=2**18):
+    """Calculate the gravitational acceleration of test particles from the
+    massive bodies, using NumPy.
+
+    The particles are taken in chunks, each against every massive body, with
+    at most chunkPairs pairs in a chunk.
+
+    Arguments:
+    massMasses -- a NumPy ndarray of the masses of the massive bodies.
+    massPosits -- a NumPy ndarray of the positions of the massive bodies,
+                  each element of which has in turn two dimensions: [x, y].
+    testPosits -- a NumPy ndarray of the positions of the test particles,
+                  each element of which has in turn two dimensions: [x, y].
+
+    Returns:
+    accels -- a NumPy ndarray of the accelerations of the test particles,
+              each element of which has in turn two dimensions: [x, y].
+    """
+
+    nTests = len(testPosits)
+    x, y   = massPosits[:, 0], massPosits[:, 1]
+    testX  = ascontiguousarray(testPosits[:, 0])
+    testY  = ascontiguousarray(testPosits[:, 1])
+    gMass  = convG*massMasses
+    accX, accY = empty(nTests), empty(nTests)
+
+    chunk = max(1, chunkPairs//len(massMasses))
+    for first in range(0, nTests, chunk):
+        last = min(first + chunk, nTests)
+        sepX = subtract(x[newaxis, :], testX[first:last, newaxis])
+        sepY = subtract(y[newaxis, :], testY[first:last, newaxis])
+        rSq  = multiply(sepX, sepX)
+        add(rSq, multiply(sepY, sepY), out=rSq)
+        # invR3[k, j] = G m_j / |r_kj|^3
+        invR3 = sqrt(rSq)
+        multiply(invR3, rSq, out=invR3)
+        divide(gMass[newaxis, :], invR3, out=invR3)
+        multiply(sepX, invR3, out=sepX)
+        multiply(sepY, invR3, out=sepY)
+        sepX.sum(axis=1, out=accX[first:last])
+        sepY.sum(axis=1, out=accY[first:last])
+
+    return column_stack((accX, accY))
+
+def split_accels(calc_accels, numMassive, test_accels=test_accels):
+    """Return a function with the arguments and results of calc_accels, for
+    massive bodies followed by test particles.
+
+    Arguments:
+    calc_accels -- the function of the force engine, which is given only the
+                   massive bodies.
+    numMassive  -- the number of massive bodies, which come first.
+    test_accels -- the function for the accelerations of the test particles,
+                   with the arguments and results of the NumPy test_accels.
+
+    Returns:
+    split -- a function of (numBodies, bodyMasses, posits, targets=None).
+    """
+
+    def split(numBodies, bodyMasses, posits, targets=None):
+        massMasses = bodyMasses[:numMassive]
+        massPosits = posits[:numMassive]
+        if targets is None:
+            accels = empty((numBodies, 2))
+            accels[:numMassive] = calc_accels(numMassive, massMasses, massPosits)
+            accels[numMassive:] = test_accels(massMasses, massPosits,
+                                              posits[numMassive:])
+            return accels
+
+        accels = empty((len(targets), 2))
+        isMassive = targets < numMassive
+        massive   = flatnonzero(isMassive)
+        tests     = flatnonzero(~isMassive)
+        if len(massive):
+            # By keyword, as the engine may be a partial with its options
+            accels[massive] = calc_accels(numMassive, massMasses, massPosits,
+                                          targets=targets[massive])
+        if len(tests):
+            accels[tests] = test_accels(massMasses, massPosits,
+                                        posits[targets[tests]])
+        return accels
+
+    return split